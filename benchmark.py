@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse, os, shutil, tempfile, timeit, logging, time, threading, subprocess, sys, random, math, json, datetime
+import lazysync, ofnotify
+
+results = [] # results of this run, see record()
+
+# record a result of a benchmark, to be written to --results and compared with --compare
+def record(benchmark, measurement, value, unit = 's'):
+  results.append({'benchmark': benchmark, 'measurement': measurement, 'value': value, 'unit': unit})
+
+#
+def make_tree(root, num_dirs, files_per_dir, file_size = 0, links_per_dir = 0):
+  for d in range(num_dirs):
+    dirpath = os.path.join(root, 'd%04d' % d)
+    os.makedirs(dirpath)
+    for f in range(files_per_dir):
+      with open(os.path.join(dirpath, 'f%04d' % f), 'wb') as fh:
+        fh.write(b'x' * file_size)
+    for l in range(links_per_dir):
+      os.symlink(os.path.join(dirpath, 'f%04d' % l), os.path.join(dirpath, 'l%04d' % l))
+
+# create a tree of num_dirs folders with files_per_dir files each, like make_tree(), but the folders are nested up to 
+# depth levels (1 is flat), and the file sizes follow distribution with mean size: fixed, uniform (0 to 2 * size) or 
+# lognormal (many small and few large files, up to 100 * size); random with seed, so that runs are comparable; return 
+# the number of files and their total size
+def make_synthetic_tree(root, num_dirs, files_per_dir, depth = 1, size = 0, distribution = 'fixed', seed = 0):
+  rng = random.Random(seed)
+  sigma = 1.5
+  parents = [(root, 0)] # (path, level) of folders that can have subfolders
+  total_size = 0
+  for d in range(num_dirs):
+    parent, level = rng.choice(parents)
+    dirpath = os.path.join(parent, 'd%04d' % d)
+    os.makedirs(dirpath)
+    if level + 1 < depth:
+      parents.append((dirpath, level + 1))
+    for f in range(files_per_dir):
+      if distribution == 'uniform':
+        file_size = rng.randint(0, 2 * size)
+      elif distribution == 'lognormal' and size > 0:
+        file_size = min(100 * size, int(rng.lognormvariate(math.log(size) - sigma ** 2 / 2, sigma)))
+      else:
+        file_size = size
+      with open(os.path.join(dirpath, 'f%04d' % f), 'wb') as fh:
+        fh.write(b'x' * file_size)
+      total_size += file_size
+  return num_dirs * files_per_dir, total_size
+
+# wraps os.lstat, os.scandir and os.readlink to count (and optionally delay) calls for paths below prefix, to simulate a slow remote
+class remote_call_counter:
+  #
+  def __init__(self, prefix, latency = 0):
+    self.prefix = prefix
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.count = 0
+    self.counts = dict.fromkeys(['lstat', 'scandir', 'readlink'], 0)
+    self.originals = dict((name, getattr(os, name)) for name in self.counts)
+
+  #
+  def call(self, name, path):
+    if str(path).startswith(self.prefix):
+      with self.lock:
+        self.count += 1
+        self.counts[name] += 1
+      if self.latency > 0:
+        time.sleep(self.latency)
+
+  #
+  def wrap(self, name, function):
+    def wrapped(path = '.', *args, **kwargs):
+      self.call(name, path)
+      result = function(path, *args, **kwargs)
+      return scandir_iterator(self, result) if name == 'scandir' else result
+    return wrapped
+
+  #
+  def __enter__(self):
+    for name, function in self.originals.items():
+      setattr(os, name, self.wrap(name, function))
+    return self
+
+  #
+  def __exit__(self, *args):
+    for name, function in self.originals.items():
+      setattr(os, name, function)
+
+# wraps the iterator returned by os.scandir, so that os.DirEntry.stat() is counted like os.lstat
+class scandir_iterator:
+  #
+  def __init__(self, counter, iterator):
+    self.counter = counter
+    self.iterator = iterator
+
+  #
+  def __iter__(self):
+    return self
+
+  #
+  def __next__(self):
+    return counted_entry(self.counter, next(self.iterator))
+
+  #
+  def __enter__(self):
+    return self
+
+  #
+  def __exit__(self, *args):
+    self.iterator.close()
+
+#
+class counted_entry:
+  #
+  def __init__(self, counter, entry):
+    self.counter = counter
+    self.entry = entry
+    self.name = entry.name
+    self.path = entry.path
+
+  #
+  def stat(self, follow_symlinks = True):
+    self.counter.call('lstat', self.path) # on Linux, the stat result is never provided by the directory listing
+    return self.entry.stat(follow_symlinks = follow_symlinks)
+
+  #
+  def __getattr__(self, name):
+    return getattr(self.entry, name)
+
+#
+def new_sync(remote, local, lazy, **config):
+  config.update({'remote': remote, 'local': local, 'lazy': lazy})
+  sync = lazysync.lazysync(lazysync.merge_two_dicts(config, lazysync.get_default_config()))
+  if lazy:
+    sync.notifier.stop() # not needed for benchmarking
+  return sync
+
+# process the queue until it is empty
+def drain(sync):
+  while sync.queue:
+    sync.process_next_change()
+  sync.files.commit()
+
+# time to construct lazysync and do the first scan on an already synced tree, with and without the persisted index
+def benchmark_index(args, root):
+  remote = os.path.join(root, 'remote')
+  local = os.path.join(root, 'local')
+  os.makedirs(remote)
+  os.makedirs(local)
+  make_tree(remote, args.dirs, args.files)
+
+  sync = new_sync(remote, local, True) # initial lazy sync: creates symlinks local -> remote and the index
+  sync.find_changes()
+  drain(sync)
+  sync.files.close()
+
+  for name in ['with index', 'without index']:
+    if name == 'without index':
+      os.remove(os.path.join(local, lazysync.relative_backup_dir, lazysync.index_file))
+    with remote_call_counter(remote, args.latency) as counter:
+      start_time = timeit.default_timer()
+      sync = new_sync(remote, local, True)
+      sync.find_changes()
+      drain(sync)
+      duration = timeit.default_timer() - start_time
+    sync.files.close()
+    print("index: cold start %-13s %8.3fs, %7d remote calls, %d tracked paths"
+          % (name, duration, counter.count, len(sync.files)))
+    record('index', 'cold start ' + name, duration)
+
+# time of a scan of an unchanged, already synced tree, in non-lazy mode, with a full and an incremental scan
+def benchmark_incremental(args, root):
+  remote = os.path.join(root, 'remote')
+  local = os.path.join(root, 'local')
+  os.makedirs(remote)
+  os.makedirs(local)
+  make_tree(remote, args.dirs, args.files)
+
+  for incremental in [False, True]:
+    sync = new_sync(remote, local, False, incremental = incremental)
+    sync.find_changes()
+    drain(sync)
+    for i in range(2): # incremental mode trusts a folder listing after seeing the same mtime twice
+      sync.find_changes()
+    with remote_call_counter(remote, args.latency) as counter:
+      start_time = timeit.default_timer()
+      sync.find_changes()
+      duration = timeit.default_timer() - start_time
+    sync.files.close()
+    print("incremental: scan of unchanged tree %-16s %8.3fs, %7d remote calls" 
+          % ('(incremental)' if incremental else '(full)', duration, counter.count))
+    record('incremental', 'incremental scan' if incremental else 'full scan', duration)
+
+# walk all files and folders recursively starting at root_folder like find_changes() did before relative_scan(); all 
+# files and folders are relative to root_folder
+def relative_walk(root_folder):
+  folders = set()
+  files = set()
+  for dirpath, dirnames, filenames in os.walk(root_folder):
+    relative_dirpath = os.path.relpath(dirpath, root_folder)
+    for dirname in dirnames:
+      folders.add(os.path.normpath(os.path.join(relative_dirpath, dirname)))
+    for filename in filenames: 
+      files.add(os.path.normpath(os.path.join(relative_dirpath, filename)))
+  return folders, files
+
+# walk and lstat a tree with files and symlinks, like find_changes() did before (relative_walk(), then syncfiledata, 
+# islink and realpath per path) and with relative_scan()
+def benchmark_scan(args, root):
+  make_tree(root, args.dirs, args.files, links_per_dir = args.files // 10)
+
+  #
+  def walk_then_stat():
+    folders, files = relative_walk(root)
+    for relative_path in folders | files:
+      path = os.path.join(root, relative_path)
+      lazysync.syncfiledata(path)
+      if os.path.islink(path):
+        os.path.realpath(path)
+
+  for name, function in [('relative_walk + lstat', walk_then_stat), ('relative_scan', lambda: lazysync.relative_scan(root))]:
+    with remote_call_counter(root, args.latency) as counter:
+      start_time = timeit.default_timer()
+      function()
+      duration = timeit.default_timer() - start_time
+    print("scan: %-22s %8.3fs, %7d calls (%s)" % (name, duration, counter.count, 
+          ', '.join('%s=%d' % item for item in sorted(counter.counts.items()))))
+    record('scan', name, duration)
+
+# time of a full scan of a tree where each folder has an ignored subfolder node_modules with --files folders of --files 
+# files, by filtering the paths after the walk (like filter_ignore() did before), and by skipping them during the walk
+def benchmark_ignore(args, root):
+  make_tree(root, args.dirs, args.files)
+  for d in range(args.dirs):
+    make_tree(os.path.join(root, 'd%04d' % d, 'node_modules'), args.files // 10, args.files)
+  ignore = lazysync.ignore_matcher([lazysync.relative_backup_dir, 'node_modules/', '*.o'])
+  
+  #
+  def walk_then_filter():
+    folders, files = lazysync.relative_scan(root)
+    return ignore.filter(set(folders), True), ignore.filter(set(files))
+  
+  for name, function in [('walk, then filter', walk_then_filter), ('skip during walk', 
+                                                                    lambda: lazysync.relative_scan(root, ignore = ignore))]:
+    with remote_call_counter(root, args.latency) as counter:
+      start_time = timeit.default_timer()
+      folders, files = function()
+      duration = timeit.default_timer() - start_time
+    print("ignore: %-18s %8.3fs, %7d remote calls, %d folders and %d files not ignored" 
+          % (name, duration, counter.count, len(folders), len(files)))
+    record('ignore', name, duration)
+
+# time of a full scan (lstat'ing all paths, as in non-lazy mode) with different numbers of scan workers
+def benchmark_parallel(args, root):
+  make_tree(root, args.dirs, args.files)
+  for workers in [1, 2, 4, 8, 16]:
+    with remote_call_counter(root, args.latency) as counter:
+      start_time = timeit.default_timer()
+      lazysync.relative_scan(root, True, workers)
+      duration = timeit.default_timer() - start_time
+    print("parallel: scan with %2d workers %8.3fs, %7d remote calls" % (workers, duration, counter.count))
+    record('parallel', 'scan with %d workers' % workers, duration)
+
+# time to process the tasks of an initial non-lazy sync (download of all files) with different numbers of transfer workers
+def benchmark_transfer(args, root):
+  remote = os.path.join(root, 'remote')
+  make_tree(remote, args.dirs, args.files, args.size)
+  for workers in [1, 4, 16]:
+    local = os.path.join(root, 'local%d' % workers)
+    os.makedirs(local)
+    sync = new_sync(remote, local, False, transfer_workers = workers)
+    sync.find_changes()
+    num_tasks = len(sync.queue)
+    with remote_call_counter(remote, args.latency) as counter:
+      start_time = timeit.default_timer()
+      sync.process_changes() if workers > 1 else drain(sync)
+      duration = timeit.default_timer() - start_time
+    sync.files.close()
+    sync.transfer_executor.shutdown()
+    print("transfer: %d tasks with %2d workers %8.3fs, %7d remote calls" % (num_tasks, workers, duration, counter.count))
+    record('transfer', 'tasks with %d workers' % workers, duration)
+
+# wait time of a download on access, queued after the tasks of an initial lazy sync (symlinking all files)
+def benchmark_priority(args, root):
+  remote = os.path.join(root, 'remote')
+  local = os.path.join(root, 'local')
+  os.makedirs(remote)
+  os.makedirs(local)
+  make_tree(remote, args.dirs, args.files, args.size)
+  sync = new_sync(remote, local, True)
+  sync.find_changes()
+  drain(sync) # symlinks exist now
+  sync.queue.wait_stats.clear()
+  
+  make_tree(os.path.join(remote, 'new'), args.dirs, args.files) # new files to symlink
+  sync.find_changes()
+  num_tasks = len(sync.queue)
+  sync.process_ofnotify_event(ofnotify.event(os.path.join(remote, 'd0000', 'f0000'), ofnotify.event_types.close))
+  with remote_call_counter(remote, args.latency):
+    drain(sync)
+  sync.files.close()
+  for priority, (count, total, maximum) in sorted(sync.queue.wait_stats.items(), key = lambda item: item[0].value):
+    print("priority: %6d %-11s tasks (after %d queued tasks) waited %8.3fs on average, at most %8.3fs" 
+          % (count, priority.name, num_tasks, total / count, maximum))
+    record('priority', 'average wait of %s tasks' % priority.name, total / count)
+
+# time of a scan for open files with psutil and with /proc/<pid>/fd, with --dirs idle processes that each hold --files
+# files open; every 10th process holds one of them in the watched folder
+def benchmark_ofnotify(args, root):
+  make_tree(root, 2, args.files)
+  holder = "import sys, time\nfiles = [open(path) for path in sys.argv[1:]]\nsys.stdout.write('ready\\n')\n" \
+           "sys.stdout.flush()\ntime.sleep(3600)"
+  watched = os.path.join(root, 'd0000')
+  paths = [os.path.join(root, 'd0001', 'f%04d' % f) for f in range(1, args.files)]
+  processes = []
+  try:
+    for p in range(args.dirs):
+      watched_paths = [os.path.join(watched, 'f%04d' % (p % args.files))] if p % 10 == 0 else []
+      process = subprocess.Popen([sys.executable, '-c', holder] + watched_paths + paths, stdout = subprocess.PIPE)
+      process.stdout.readline()
+      processes.append(process)
+
+    for name in ['psutil', 'procfs']:
+      if name == 'psutil' and ofnotify.psutil is None:
+        continue
+      notifier = ofnotify.notifier(ofnotify.event_processor(), [watched])
+      if name == 'psutil':
+        notifier.scanner = None
+      for scan in ['first', 'steady']:
+        start_time = timeit.default_timer()
+        open_files = notifier._open_files()
+        duration = timeit.default_timer() - start_time
+        scanned = notifier.scanner.num_scanned if notifier.scanner else len(ofnotify.psutil.pids())
+        print("ofnotify: %-6s %-6s scan %8.3fs, %5d pids scanned, %5d open watched files"
+              % (name, scan, duration, scanned, len(open_files)))
+        record('ofnotify', '%s %s scan' % (name, scan), duration)
+  finally:
+    for process in processes:
+      process.kill()
+      process.wait()
+
+# time of full and incremental scans, of a bulk download and of downloads on access, on a synthetic tree (see --depth, 
+# --size-distribution) behind a remote with --latency per operation and --bandwidth (see lazysync.shaped_backend)
+def benchmark_remote(args, root):
+  remote = os.path.join(root, 'remote')
+  os.makedirs(remote)
+  num_files, total_size = make_synthetic_tree(remote, args.dirs, args.files, args.depth, args.size, 
+                                              args.size_distribution, args.seed)
+  print("remote: tree of %d folders (depth %d) with %d files, %d bytes (%s sizes)" 
+        % (args.dirs, args.depth, num_files, total_size, args.size_distribution))
+  shape = {'remote_latency': args.latency, 'remote_bandwidth': args.bandwidth}
+  
+  # bulk download: initial non-lazy sync
+  local = os.path.join(root, 'local')
+  os.makedirs(local)
+  sync = new_sync(remote, local, False, transfer_workers = args.workers, **shape)
+  with remote_call_counter(remote) as counter:
+    start_time = timeit.default_timer()
+    sync.find_changes()
+    sync.process_changes() if args.workers > 1 else drain(sync)
+    duration = timeit.default_timer() - start_time
+  sync.files.close()
+  sync.transfer_executor.shutdown()
+  print("remote: bulk download with %2d workers %8.3fs, %7d remote calls, %.2f MB/s" 
+        % (args.workers, duration, counter.count, total_size / duration / 1e6))
+  record('remote', 'bulk download', duration)
+  
+  # scans of the unchanged tree
+  for incremental in [False, True]:
+    sync = new_sync(remote, local, False, incremental = incremental, **shape)
+    for i in range(3): # incremental mode trusts a folder listing after seeing the same mtime twice
+      sync.find_changes()
+    drain(sync)
+    with remote_call_counter(remote) as counter:
+      start_time = timeit.default_timer()
+      sync.find_changes()
+      duration = timeit.default_timer() - start_time
+    sync.files.close()
+    name = 'incremental scan' if incremental else 'full scan'
+    print("remote: %-28s %8.3fs, %7d remote calls" % (name, duration, counter.count))
+    record('remote', name, duration)
+  
+  # downloads on access in lazy mode, from the ofnotify event until the file is local
+  local = os.path.join(root, 'lazy')
+  os.makedirs(local)
+  sync = new_sync(remote, local, True, **shape)
+  sync.find_changes()
+  drain(sync)
+  paths = sorted(sync.files.paths())
+  paths = [path for path in random.Random(args.seed).sample(paths, len(paths)) if os.path.islink(os.path.join(local, path))]
+  latencies = []
+  for relative_path in paths[:args.accesses]:
+    start_time = timeit.default_timer()
+    sync.process_ofnotify_event(ofnotify.event(os.path.join(remote, relative_path), ofnotify.event_types.close))
+    drain(sync)
+    latencies.append(timeit.default_timer() - start_time)
+  sync.files.close()
+  if latencies:
+    latencies.sort()
+    print("remote: %4d accesses in lazy mode, latency %8.3fs on average, median %8.3fs, at most %8.3fs" 
+          % (len(latencies), sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[-1]))
+    record('remote', 'access latency (average)', sum(latencies) / len(latencies))
+    record('remote', 'access latency (max)', latencies[-1])
+
+# syncfiledata and syncfilepair like they were before they were slotted, with a __dict__ per instance
+class dict_syncfiledata:
+  #
+  def __init__(self, is_dir, is_file, is_link, atime, mtime, size):
+    self.is_dir = bool(is_dir)
+    self.is_file = bool(is_file)
+    self.is_link = bool(is_link)
+    self.atime = atime
+    self.mtime = mtime
+    self.size = size
+    self.device = None
+    self.inode = None
+    self.mode = None
+    self.link_target = None
+
+#
+class dict_syncfilepair:
+  #
+  def __init__(self, syncfiledata_remote, syncfiledata_local):
+    self.syncfiledata_remote = syncfiledata_remote
+    self.syncfiledata_local = syncfiledata_local
+
+# return the resident memory of this process in bytes
+def resident_memory():
+  with open('/proc/self/statm') as statm:
+    return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+# call build() in a forked child and return the increase of its resident memory in bytes and the result of 
+# measure(built), or None if the child ran out of memory; the child exits afterwards, so the memory is given back
+def measure_in_child(build, measure):
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    try:
+      memory = resident_memory()
+      built = build()
+      memory = resident_memory() - memory
+      os.write(write_fd, json.dumps([memory, measure(built)]).encode('utf-8'))
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  output = b''
+  chunk = os.read(read_fd, 4096)
+  while chunk:
+    output += chunk
+    chunk = os.read(read_fd, 4096)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  return json.loads(output.decode('utf-8')) if output else None
+
+# memory of the tracking information of --entries paths, kept like syncindex did before (a syncfilepair with two 
+# syncfiledata with a __dict__ per path) and in syncindex (a packed syncrecord per path), and the time to look up the 
+# remote values of an entry (with syncindex.remote_data(), like compare_changes()); each is measured in a child process, so they do not influence each other
+def benchmark_memory(args, root):
+  rng = random.Random(args.seed)
+  # 1000 files per folder in folders of depth 3
+  path = lambda i: os.path.join('d%03d' % (i // 1000000), 'd%03d' % (i // 1000 % 1000), 'f%03d.dat' % (i % 1000))
+  values = lambda i: (0, 1, 0, 1.5e9 + i * 0.25, 1.5e9 + i * 0.125, i % 100000)
+  #
+  def build_dicts(num_entries):
+    entries = {}
+    for i in range(num_entries):
+      entries[path(i)] = dict_syncfilepair(dict_syncfiledata(*values(i)), dict_syncfiledata(*values(i)))
+    return entries
+  #
+  def build_syncindex(num_entries):
+    index = lazysync.syncindex(os.path.join(root, 'index')) # not opened, so entries are only kept in memory
+    for i in range(num_entries):
+      index[path(i)] = lazysync.syncfilepair(lazysync.syncfiledata.from_values(*values(i)), 
+                                             lazysync.syncfiledata.from_values(*values(i)))
+    return index
+  #
+  def measure_lookup(entries):
+    paths = [path(rng.randrange(len(entries))) for i in range(100000)]
+    start_time = timeit.default_timer()
+    if isinstance(entries, lazysync.syncindex):
+      for relative_path in paths:
+        entries.remote_data(relative_path).mtime
+    else:
+      for relative_path in paths:
+        entries[relative_path].syncfiledata_remote.mtime
+    return (timeit.default_timer() - start_time) / len(paths)
+  
+  for num_entries in args.entries or [1000000, 5000000]:
+    for name, build in [('dict per entry', build_dicts), ('syncindex', build_syncindex)]:
+      result = measure_in_child(lambda: build(num_entries), measure_lookup)
+      if result is None:
+        print("memory: %9d entries %-16s out of memory" % (num_entries, name))
+        continue
+      memory, lookup_time = result
+      print("memory: %9d entries %-16s %9.1f MiB, %6.1f bytes per entry, lookup %6.3fus" 
+            % (num_entries, name, memory / 1024.0 ** 2, memory / float(num_entries), lookup_time * 1e6))
+      record('memory', '%d entries %s' % (num_entries, name), memory, 'B')
+      record('memory', '%d entries %s lookup' % (num_entries, name), lookup_time)
+
+# bytes uploaded (by the metric), bytes over the network and time of uploads of changes of a file of --delta-size MiB 
+# with full copies and with delta transfers (with and without numpy), behind a remote with --latency per operation and 
+# --bandwidth (see lazysync.shaped_backend); delta transfers need a server-side copy, without it they are full copies; 
+# the metric has to count the bytes over the network, which also include a few bytes of other operations (e.g. the 
+# record of the source of a resumable copy)
+def benchmark_delta(args, root):
+  size = args.delta_size * 1024 * 1024
+  rnd = random.Random(args.seed)
+  contents = rnd.randbytes(size) if hasattr(rnd, 'randbytes') else os.urandom(size) # randbytes is python 3.9
+  changes = [('change 1 byte', lambda data: data[:size // 2] + b'x' + data[size // 2 + 1:]), 
+             ('insert 100 bytes', lambda data: data[:size // 3] + b'y' * 100 + data[size // 3:]), 
+             ('append 1 MiB', lambda data: data + os.urandom(1024 * 1024)), 
+             ('rewrite', lambda data: os.urandom(len(data)))]
+  modes = [('full copy', False, lazysync.numpy, False), ('delta no server-side', True, lazysync.numpy, False)]
+  if lazysync.numpy is not None:
+    modes.append(('delta', True, lazysync.numpy, True))
+  modes.append(('delta without numpy', True, None, True))
+  numpy = lazysync.numpy
+  try:
+    for mode, delta, lazysync.numpy, server_side_copy in modes:
+      remote = os.path.join(root, mode.replace(' ', '-'), 'remote')
+      local = os.path.join(root, mode.replace(' ', '-'), 'local')
+      os.makedirs(remote)
+      os.makedirs(local)
+      path = os.path.join(local, 'file')
+      with open(path, 'wb') as f:
+        f.write(contents)
+      sync = new_sync(remote, local, False, delta = delta, remote_latency = args.latency, 
+                      remote_bandwidth = args.bandwidth, remote_server_side_copy = server_side_copy)
+      # a shaped_backend also without --latency and --bandwidth, to count the bytes over the network
+      sync.remote_backend = lazysync.shaped_backend(args.latency, args.bandwidth, server_side_copy)
+      sync.remote_walker.backend = sync.remote_backend
+      sync.find_changes()
+      drain(sync)
+      data = contents
+      for i, (change, modify) in enumerate(changes):
+        data = modify(data)
+        with open(path, 'wb') as f:
+          f.write(data)
+        os.utime(path, (time.time(), time.time() + i + 1)) # a new mtime, even within its resolution
+        uploaded = sync.metrics.values['lazysync_transfer_bytes_total'][(('direction', 'upload'),)]
+        transferred = sync.remote_backend.transferred
+        start_time = timeit.default_timer()
+        sync.find_changes()
+        drain(sync)
+        duration = timeit.default_timer() - start_time
+        uploaded = sync.metrics.values['lazysync_transfer_bytes_total'][(('direction', 'upload'),)] - uploaded
+        transferred = sync.remote_backend.transferred - transferred
+        print("delta: %-20s %-17s %8.3fs, %10d of %10d bytes uploaded (%5.1f%%), %10d bytes over the network (%5.1f%%), "
+              "difference %+d" % (mode, change, duration, uploaded, len(data), 100.0 * uploaded / len(data), 
+                                    transferred, 100.0 * transferred / len(data), uploaded - transferred))
+        record('delta', '%s %s' % (mode, change), duration)
+        record('delta', '%s %s uploaded' % (mode, change), uploaded, 'B')
+        record('delta', '%s %s over the network' % (mode, change), transferred, 'B')
+        record('delta', '%s %s difference' % (mode, change), uploaded - transferred, 'B')
+      sync.files.close()
+  finally:
+    lazysync.numpy = numpy
+
+# return the commit of the working tree of benchmark.py, with '+' if it has uncommitted changes, or None without git
+def current_commit():
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = cwd).decode().strip()
+    dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd = cwd) != 0
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return commit + ('+' if dirty else '')
+
+# append the results of this run to path, one json object per result
+def write_results(path, args):
+  run = {'commit': current_commit(), 'time': datetime.datetime.now().isoformat(), 
+         'args': dict((key, value) for key, value in vars(args).items() if key not in ('results', 'compare'))}
+  with open(path, 'a') as f:
+    for result in results:
+      result = dict(result)
+      result.update(run)
+      f.write(json.dumps(result, sort_keys = True) + '\n')
+
+# print the results of this run next to the last recorded results of the commit starting with revision in path
+def compare_results(path, revision):
+  if not os.path.isfile(path):
+    print("compare: no results in '%s'" % path)
+    return
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  try:
+    revision = subprocess.check_output(['git', 'rev-parse', revision], cwd = cwd).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    pass # compare with a recorded commit prefix
+  previous = {}
+  with open(path) as f:
+    for line in f:
+      result = json.loads(line)
+      if (result.get('commit') or '').startswith(revision):
+        previous[(result['benchmark'], result['measurement'])] = result['value']
+  for result in results:
+    old = previous.get((result['benchmark'], result['measurement']))
+    if old is None:
+      continue
+    change = '%+7.1f%%' % (100.0 * (result['value'] - old) / old) if old else '       '
+    print("compare: %-12s %-40s %10.4f%s -> %10.4f%s %s" % (result['benchmark'], result['measurement'], old, 
+          result['unit'], result['value'], result['unit'], change))
+
+# main
+if __name__ == "__main__":
+  benchmarks = {'index': benchmark_index, 'incremental': benchmark_incremental, 'scan': benchmark_scan, 
+                'parallel': benchmark_parallel, 'transfer': benchmark_transfer, 'ofnotify': benchmark_ofnotify, 
+                'priority': benchmark_priority, 'ignore': benchmark_ignore, 'remote': benchmark_remote, 
+                'memory': benchmark_memory, 'delta': benchmark_delta}
+  parser = argparse.ArgumentParser(description = 'Benchmarks for lazysync')
+  parser.add_argument('benchmark', nargs = '*', help = 'Benchmarks to run: %s (default: all)' % ', '.join(sorted(benchmarks)))
+  parser.add_argument('--dirs', type = int, default = 100, help = 'Number of directories in the synthetic tree')
+  parser.add_argument('--files', type = int, default = 100, help = 'Number of files per directory')
+  parser.add_argument('--size', type = int, default = 1024, help = 'Size of each file in bytes')
+  parser.add_argument('--latency', type = float, default = 0, help = 'Simulated latency per remote lstat/scandir/readlink in seconds')
+  parser.add_argument('--bandwidth', type = float, default = 0, 
+                      help = 'Simulated bandwidth of the remote in KiB/s for the remote benchmark; 0 is unlimited')
+  parser.add_argument('--depth', type = int, default = 1, help = 'Maximum depth of the folders of the synthetic tree')
+  parser.add_argument('--size-distribution', choices = ['fixed', 'uniform', 'lognormal'], default = 'fixed', 
+                      help = 'Distribution of the file sizes of the synthetic tree, with --size as mean')
+  parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the synthetic tree')
+  parser.add_argument('--workers', type = int, default = 1, help = 'Number of transfer workers for the bulk download')
+  parser.add_argument('--accesses', type = int, default = 20, help = 'Number of files accessed in lazy mode')
+  parser.add_argument('--entries', type = int, action = 'append', 
+                      help = 'Number of tracked paths for the memory benchmark; can be given several times (default: '
+                             '1000000 and 5000000)')
+  parser.add_argument('--delta-size', type = int, default = 64, help = 'Size of the file of the delta benchmark in MiB')
+  parser.add_argument('--results', metavar = 'FILE', help = 'Append the results to FILE, with the current commit')
+  parser.add_argument('--compare', metavar = 'REV', help = 'Compare the results with the last ones of commit REV in --results')
+  args = parser.parse_args()
+  args.bandwidth *= 1024 # bytes per second
+  if args.compare and not args.results:
+    parser.error("--compare requires --results")
+  for name in args.benchmark:
+    if name not in benchmarks:
+      parser.error("unknown benchmark '%s'" % name)
+  lazysync.logger.setLevel(logging.WARNING)
+
+  for name in args.benchmark or sorted(benchmarks):
+    root = tempfile.mkdtemp(prefix = 'lazysync-benchmark-')
+    try:
+      benchmarks[name](args, root)
+    finally:
+      shutil.rmtree(root)
+  if args.compare:
+    compare_results(args.results, args.compare)
+  if args.results:
+    write_results(args.results, args)
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-from collections import deque, defaultdict
-import logging, argparse, os, sys, datetime, time, timeit, signal, stat, math, shutil, hashlib, errno, filecmp
-import jsonpickle, subprocess, ofnotify, enum # enum is enum34
+from collections import deque, defaultdict, Counter, OrderedDict
+import logging, argparse, os, sys, datetime, time, timeit, signal, stat, math, shutil, hashlib, errno, heapq, bisect, re
+import struct, zlib, array
+import concurrent.futures, threading
+import jsonpickle, subprocess, sqlite3, ofnotify, enum
+import json, socket, socketserver
+import contextlib, asyncio
+try:
+  import numpy # only used to find the matching blocks of delta transfers faster
+except ImportError:
+  numpy = None
 
 # global variables
 sigint = False # variable to check for sigint
@@ -11,6 +19,44 @@ min_sleep = 2.8 # seconds
 app_identifier = "lazysync" # used for all paths
 relative_backup_dir = '.%s' % (app_identifier) # to store old files for specific sync paths
 data_file = 'data' # to store the information about the different backup files
+index_file = 'index' # to store the tracking information (self.files) between runs
+hash_file = 'hashes' # to store the content hashes of files between runs
+journal_file = 'journal' # to append changes of the backup files to, until they are saved in data_file
+socket_file = 'socket' # unix socket for lazysyncctl in local
+log_file = 'log' # log in local in daemon mode
+metadata_files = (data_file, index_file, hash_file, journal_file, socket_file, log_file) # prefixes of files in 
+                                     # relative_backup_dir that are no backup files (including sqlite journals, temp files)
+journal_compaction_interval = 1000 # records
+relative_partial_dir = os.path.join(relative_backup_dir, 'partial') # to store partially copied files
+copy_chunk_size = 1024 * 1024 # bytes
+task_priorities = enum.Enum('task_priorities', 'interactive upload small bulk') # in order of processing
+small_file_size = 1024 * 1024 # bytes; copies of files up to this size have priority small, larger ones bulk
+delta_min_size = 1024 * 1024 # bytes; with --delta, files from this size on are copied with a delta transfer
+signature_max_age = 30 * 24 * 3600 # seconds; cached signatures for delta transfers unused for longer are removed
+metric_descriptions = ( # name, type and help of the exported metrics; see metrics
+  ('lazysync_scans_total', 'counter', 'Number of scans for changes, including rescans of folders'),
+  ('lazysync_scan_seconds', 'summary', 'Duration of scans for changes'),
+  ('lazysync_scan_phase_seconds', 'summary', 'Duration of the phases of scans: walk_remote and walk_local (listing and '
+                                             'lstat in one pass), stat (remote paths not lstat\'ed during the walk) '
+                                             'and compare'),
+  ('lazysync_scan_stats_total', 'counter', 'Number of remote paths lstat\'ed outside of the walk'),
+  ('lazysync_tracked_paths', 'gauge', 'Number of synced paths'),
+  ('lazysync_queue_tasks', 'gauge', 'Number of queued sync tasks'),
+  ('lazysync_task_wait_seconds', 'summary', 'Time sync tasks waited in the queue'),
+  ('lazysync_task_seconds', 'summary', 'Duration of sync tasks'),
+  ('lazysync_transfer_files_total', 'counter', 'Number of copied files'),
+  ('lazysync_transfer_bytes_total', 'counter', 'Number of bytes transferred to and from remote by copies, without '
+                                              'bytes of resumed copies copied before'),
+  ('lazysync_transfer_delta_saved_bytes_total', 'counter', 'Number of bytes of delta transfers that were copied from the '
+                                                           'old version of the file on the server instead of being '
+                                                           'transferred'),
+  ('lazysync_transfer_seconds', 'summary', 'Duration of copies of files, including interrupted ones'),
+  ('lazysync_transfer_throughput_bytes_per_second', 'gauge', 'Throughput of the last copy'),
+  ('lazysync_transfers', 'gauge', 'Number of running copies'),
+  ('lazysync_ofnotify_scans_total', 'counter', 'Number of scans for open files'),
+  ('lazysync_ofnotify_scan_seconds_total', 'counter', 'Time spent in scans for open files'),
+  ('lazysync_ofnotify_pids_scanned_total', 'counter', 'Number of processes whose open files were read'),
+  ('lazysync_prefetch_hit_rate', 'gauge', 'Share of prefetched files that were accessed'))
 
 #
 def add_logging_level(logger, debug_level, debug_level_name):
@@ -31,7 +77,7 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
 logger.addHandler(console_handler)
 
-# catch sigint to interupt the inotify processing loop
+# catch sigint (and sigterm, e.g. of systemctl stop or kill) to interupt the inotify processing loop
 def sigint_handler(signal, frame):
   logger.debug("sigint_handler()")
   global sigint
@@ -41,7 +87,32 @@ def sigint_handler(signal, frame):
 def get_default_config():
   logger.trace("get_default_config()")
   return {
-    'ignore' : [relative_backup_dir] # relative paths
+    'ignore' : ['/' + relative_backup_dir], # patterns like in .gitignore, see ignore_matcher; anchored to the root
+    'incremental': False,
+    'scan_workers': 1,
+    'transfer_workers': 1,
+    'engine': 'loop', # loop alternates scans and transfers, asyncio runs them concurrently
+    'upload_limit': 0, # bytes per second, 0 is unlimited
+    'download_limit': 0, # bytes per second, 0 is unlimited
+    'full_scan_interval': 20,
+    'unreliable_mtime': False,
+    'detect_moves': True,
+    'delta': False,
+    'background_reconcile': False,
+    'min_interval': 1.4, # seconds between scans after changes were found
+    'max_interval': 60, # seconds between scans when idle
+    'min_notify_interval': ofnotify.default_min_sleep_time, # seconds between scans for open files while accessed
+    'max_notify_interval': ofnotify.default_max_sleep_time, # seconds between scans for open files when idle
+    'prefetch_count': 0, # files per access, 0 is disabled
+    'prefetch_bytes': 64 * 1024 * 1024, # bytes per access
+    'cache_size': 0, # bytes of local files in lazy mode, 0 is unlimited
+    'priority_aging': 60, # seconds a task waits until it is taken before tasks of the next higher priority
+    'daemon': False,
+    'socket': None, # path of the control socket; None is socket_file in relative_backup_dir in local
+    'metrics_file': None, # path to write the metrics to after each scan; None is disabled
+    'remote_latency': 0, # seconds per remote operation, simulated for testing
+    'remote_bandwidth': 0, # bytes per second of remote file contents, simulated for testing; 0 is unlimited
+    'remote_server_side_copy': False # if the remote mount copies ranges of files on the server; needed for delta
   }
 
 # parse the folders to sync from the command line arguments
@@ -52,11 +123,112 @@ def parse_command_line():
   parser.add_argument('-l', '--local', metavar = 'LC', required = True, help = 'Path where the local data is located')
   parser.add_argument('-L', '--lazy', choices = ['y', 'n'], default = 'n', 
                       help = 'Sync lazily (on access) or not (always download)')
+  parser.add_argument('-i', '--ignore', metavar = 'PATTERN', action = 'append', default = [], 
+                      help = 'Ignore paths matching PATTERN like in .gitignore (e.g. node_modules/, *.o, /build); can be '
+                             'given several times')
+  parser.add_argument('--ignore-file', metavar = 'FILE', 
+                      help = 'Ignore paths matching the patterns in FILE, one per line like in .gitignore')
+  parser.add_argument('-I', '--incremental', choices = ['y', 'n'], default = 'n', 
+                      help = 'Only list remote folders whose mtime changed, and only lstat remote paths in them')
+  parser.add_argument('-w', '--scan-workers', metavar = 'N', type = int, default = 1, 
+                      help = 'Number of threads to scan remote concurrently (default: %(default)s)')
+  parser.add_argument('-t', '--transfer-workers', metavar = 'N', type = int, default = 1, 
+                      help = 'Number of threads to process sync tasks concurrently (default: %(default)s)')
+  parser.add_argument('-E', '--engine', choices = ['loop', 'asyncio'], default = 'loop', 
+                      help = 'Alternate scanning and processing sync tasks (loop), or scan, process sync tasks and '
+                             'open file events concurrently (asyncio) (default: %(default)s)')
+  parser.add_argument('--upload-limit', metavar = 'KB/S', type = float, default = 0, 
+                      help = 'Limit the rate of copying local to remote in KiB/s; 0 is unlimited (default: %(default)s)')
+  parser.add_argument('--download-limit', metavar = 'KB/S', type = float, default = 0, 
+                      help = 'Limit the rate of copying remote to local in KiB/s, except for files downloaded on '
+                             'access in lazy mode; 0 is unlimited (default: %(default)s)')
+  parser.add_argument('-U', '--unreliable-mtime', choices = ['y', 'n'], default = 'n', 
+                      help = 'Compare files with equal size but different mtime by content hash, e.g. for davfs')
+  parser.add_argument('--delta', choices = ['y', 'n'], default = 'n', 
+                      help = 'Upload files of at least %d MiB that changed with a delta transfer like rsync: only the '
+                             'blocks that are not in the old version are transferred, the others are copied from it '
+                             'on the server; only with --server-side-copy y, and not with -U y' 
+                             % (delta_min_size // 1024 // 1024))
+  parser.add_argument('--server-side-copy', choices = ['y', 'n'], default = 'n', 
+                      help = 'The remote mount copies ranges of files on the server without transferring them (e.g. '
+                             'nfs 4.2, smb 3), which cannot be detected; with --simulate-bandwidth, such copies do not '
+                             'use the bandwidth')
+  parser.add_argument('-M', '--detect-moves', choices = ['y', 'n'], default = 'y', 
+                      help = 'Rename files on the other side that were moved or renamed, instead of copying and removing '
+                             'them (default: %(default)s)')
+  parser.add_argument('--background-reconcile', choices = ['y', 'n'], default = 'n', 
+                      help = 'Check that the backup files are consistent with their data in the background on start')
+  parser.add_argument('--full-scan-interval', metavar = 'N', type = int, default = 20, 
+                      help = 'In incremental mode, do a full scan of remote every N scans (default: %(default)s)')
+  parser.add_argument('--min-interval', metavar = 'S', type = float, default = 1.4, 
+                      help = 'Seconds between scans after changes were found (default: %(default)s)')
+  parser.add_argument('--max-interval', metavar = 'S', type = float, default = 60, 
+                      help = 'Seconds between scans when idle; the interval doubles after each scan without changes '
+                             '(default: %(default)s)')
+  parser.add_argument('--min-notify-interval', metavar = 'S', type = float, default = ofnotify.default_min_sleep_time, 
+                      help = 'In lazy mode, seconds between scans for open files while files are accessed '
+                             '(default: %(default)s)')
+  parser.add_argument('--max-notify-interval', metavar = 'S', type = float, default = ofnotify.default_max_sleep_time, 
+                      help = 'In lazy mode, seconds between scans for open files when idle (default: %(default)s)')
+  parser.add_argument('--prefetch-count', metavar = 'N', type = int, default = 0, 
+                      help = 'In lazy mode, download up to N files that are likely accessed next, after a file was '
+                             'accessed; 0 is disabled (default: %(default)s)')
+  parser.add_argument('--prefetch-size', metavar = 'MB', type = float, default = 64, 
+                      help = 'Maximum size in MiB of the files downloaded ahead after an access (default: %(default)s)')
+  parser.add_argument('--cache-size', metavar = 'MB', type = float, default = 0, 
+                      help = 'In lazy mode, replace the least recently used local files that are unchanged with symlinks '
+                             'again, if local files take more than MB MiB; 0 is unlimited (default: %(default)s)')
+  parser.add_argument('-D', '--daemon', choices = ['y', 'n'], default = 'n', 
+                      help = 'Run in the background and log to %s in the local folder' 
+                             % os.path.join(relative_backup_dir, log_file))
+  parser.add_argument('--socket', metavar = 'PATH', 
+                      help = 'Path of the unix socket to control lazysync with lazysyncctl.py (default: %s in the local '
+                             'folder)' % os.path.join(relative_backup_dir, socket_file))
+  parser.add_argument('--priority-aging', metavar = 'S', type = float, default = 60, 
+                      help = 'Seconds a sync task has to wait longer than a task of the next higher priority to be '
+                             'processed before it (default: %(default)s)')
+  parser.add_argument('--simulate-latency', metavar = 'S', type = float, default = 0, 
+                      help = 'For testing, add S seconds to each operation on remote (default: %(default)s)')
+  parser.add_argument('--simulate-bandwidth', metavar = 'KB/S', type = float, default = 0, 
+                      help = 'For testing, limit reading and writing remote files to KB/S KiB/s in total; 0 is unlimited '
+                             '(default: %(default)s)')
+  parser.add_argument('--metrics-file', metavar = 'PATH', 
+                      help = 'Write metrics in the text format of prometheus to PATH after each scan, e.g. for the '
+                             'textfile collector of the node exporter')
   args = parser.parse_args()
+  ignore = list(args.ignore)
+  if args.ignore_file:
+    ignore += read_file_contents(args.ignore_file).splitlines()
   return {
     'remote': os.path.abspath(args.remote), 
     'local': os.path.abspath(args.local),
-    'lazy': args.lazy == 'y'
+    'lazy': args.lazy == 'y',
+    'ignore': ignore,
+    'incremental': args.incremental == 'y',
+    'scan_workers': max(1, args.scan_workers),
+    'transfer_workers': max(1, args.transfer_workers),
+    'engine': args.engine,
+    'upload_limit': max(0, args.upload_limit * 1024), # bytes per second
+    'download_limit': max(0, args.download_limit * 1024), # bytes per second
+    'full_scan_interval': max(1, args.full_scan_interval),
+    'unreliable_mtime': args.unreliable_mtime == 'y',
+    'detect_moves': args.detect_moves == 'y',
+    'delta': args.delta == 'y',
+    'background_reconcile': args.background_reconcile == 'y',
+    'min_interval': max(0, args.min_interval),
+    'max_interval': max(0, args.max_interval),
+    'min_notify_interval': max(0.01, args.min_notify_interval),
+    'max_notify_interval': max(0.01, args.max_notify_interval),
+    'prefetch_count': max(0, args.prefetch_count),
+    'prefetch_bytes': max(0, args.prefetch_size * 1024 * 1024),
+    'cache_size': max(0, args.cache_size * 1024 * 1024),
+    'priority_aging': max(0, args.priority_aging),
+    'daemon': args.daemon == 'y',
+    'socket': os.path.abspath(args.socket) if args.socket else None,
+    'metrics_file': os.path.abspath(args.metrics_file) if args.metrics_file else None,
+    'remote_latency': max(0, args.simulate_latency),
+    'remote_bandwidth': max(0, args.simulate_bandwidth * 1024), # bytes per second
+    'remote_server_side_copy': args.server_side_copy == 'y'
   }
 
 # merge two dicts; if key is in both and data is list or dict, merge; else overwrite default_dct with dct
@@ -76,24 +248,254 @@ def merge_two_dicts(dct, default_dct):
       final_dct[k] = default_dct[k]
   return final_dct
 
-# walk all files and folders recursively starting at root_folder; all files and folders are relative to root_folder
-def relative_walk(root_folder):
-  logger.trace("relative_walk()")
-  folders = set()
-  files = set()
-  for dirpath, dirnames, filenames in os.walk(root_folder):
-    relative_dirpath = os.path.relpath(dirpath, root_folder)
-    for dirname in dirnames:
-      folders.add(os.path.normpath(os.path.join(relative_dirpath, dirname)))
-    for filename in filenames: 
-      files.add(os.path.normpath(os.path.join(relative_dirpath, filename)))
+# translate a pattern like in .gitignore (without '!' and trailing '/') to a regular expression for relative paths: '*' 
+# and '?' do not match '/', '**' matches any number of folders, '[...]' matches a character class; a pattern without 
+# '/' matches a name at any depth, a pattern with '/' matches relative to the root folder
+def glob_to_regex(pattern):
+  anchored = '/' in pattern
+  pattern = pattern.lstrip('/')
+  regex = ''
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith('**/', i):
+      regex += '(?:.*/)?'
+      i += 3
+    elif pattern.startswith('**', i):
+      regex += '.*'
+      i += 2
+    elif pattern[i] == '*':
+      regex += '[^/]*'
+      i += 1
+    elif pattern[i] == '?':
+      regex += '[^/]'
+      i += 1
+    elif pattern[i] == '[' and pattern.find(']', i + 2) > 0:
+      end = pattern.find(']', i + 2)
+      characters = pattern[i + 1:end].replace('\\', '\\\\')
+      regex += '[' + ('^' + characters[1:] if characters.startswith('!') else characters) + ']'
+      i = end + 1
+    else:
+      regex += re.escape(pattern[i])
+      i += 1
+  return ('' if anchored else '(?:.*/)?') + regex + '$'
+
+# ignore rules like in .gitignore: a path is ignored if the last pattern matching it is not negated with '!', or if one 
+# of its parent folders is ignored; patterns ending with '/' only match folders; empty patterns and patterns starting 
+# with '#' are skipped; without negated patterns, all patterns are compiled into one regular expression per kind of path
+class ignore_matcher:
+  #
+  def __init__(self, patterns):
+    logger.trace("ignore_matcher::__init__() patterns=%s", patterns)
+    self.rules = [] # (compiled regex, negated, only matches folders)
+    for pattern in patterns:
+      pattern = pattern.strip()
+      if not pattern or pattern.startswith('#'):
+        continue
+      negated = pattern.startswith('!')
+      only_dirs = pattern.endswith('/')
+      pattern = pattern.lstrip('!').rstrip('/')
+      if pattern:
+        self.rules.append((re.compile(glob_to_regex(pattern)), negated, only_dirs))
+    self.negated = any(negated for regex, negated, only_dirs in self.rules)
+    self.dir_regex = self.compile_rules([regex for regex, negated, only_dirs in self.rules])
+    self.file_regex = self.compile_rules([regex for regex, negated, only_dirs in self.rules if not only_dirs])
+  
+  # return one regular expression matching any of regexes, or None if there are none
+  def compile_rules(self, regexes):
+    if not regexes:
+      return None
+    return re.compile('|'.join('(?:%s)' % regex.pattern for regex in regexes))
+    
+  # return if relative_path is ignored, without checking its parent folders (while walking, they are not descended into)
+  def ignored(self, relative_path, is_dir = False):
+    if not self.negated:
+      regex = self.dir_regex if is_dir else self.file_regex
+      return regex is not None and regex.match(relative_path) is not None
+    for regex, negated, only_dirs in reversed(self.rules): # the last matching rule decides
+      if (is_dir or not only_dirs) and regex.match(relative_path):
+        return not negated
+    return False
+  
+  # return the set of relative paths in paths that are not ignored, including their parent folders
+  def filter(self, paths, is_dir = False):
+    ignored_dirs = {'': False} # relative dirpath -> if it or one of its parent folders is ignored
+    #
+    def dir_ignored(relative_dirpath):
+      if relative_dirpath not in ignored_dirs:
+        ignored_dirs[relative_dirpath] = dir_ignored(os.path.dirname(relative_dirpath)) or \
+                                         self.ignored(relative_dirpath, True)
+      return ignored_dirs[relative_dirpath]
+    return set(path for path in paths if not dir_ignored(os.path.dirname(path)) and not self.ignored(path, is_dir))
+
+# call scan_dir(relative_dirpath) for start (by default the root folder, os.curdir) and, recursively, for all relative 
+# subfolders it returns; with more than one worker, up to workers folders are scanned concurrently in a thread pool, b/c 
+# listing and lstat'ing a network filesystem is bound by latency, not cpu
+def walk_dirs(scan_dir, workers = 1, start = os.curdir):
+  logger.trace("walk_dirs() workers=%d", workers)
+  if workers <= 1:
+    stack = [start]
+    while stack:
+      stack.extend(scan_dir(stack.pop()))
+    return
+  
+  with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+    pending = set([executor.submit(scan_dir, start)])
+    while pending:
+      done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        for relative_dirpath in future.result():
+          pending.add(executor.submit(scan_dir, relative_dirpath))
+
+# walk all files and folders recursively starting at root_folder in a single pass with os.scandir; return dicts of 
+# relative folders and relative files -> syncfiledata created from the stat results of the walk (including the link 
+# target for symlinks); if with_stat is False, no path is lstat'ed and all values are None; paths ignored by the 
+# ignore_matcher ignore are skipped before they are lstat'ed, and ignored folders are not descended into; see 
+# walk_dirs() for workers; if subtree is given, only the paths inside the relative path subtree are walked, and subtree 
+# and its parent folders are included if they exist (so that they can be created if they are missing on the other side);
+# the folder is accessed with backend (default: posix_backend)
+def relative_scan(root_folder, with_stat = True, workers = 1, ignore = None, subtree = os.curdir, backend = None):
+  logger.trace("relative_scan() root_folder='%s' with_stat=%s workers=%d subtree='%s'", root_folder, with_stat, workers, 
+               subtree)
+  backend = backend or posix
+  folders = {}
+  files = {}
+  parent = subtree if subtree != os.curdir else ''
+  while parent:
+    path = os.path.join(root_folder, parent)
+    try:
+      data = backend.stat(path)
+      if data.is_link:
+        data.link_target = backend.readlink(path)
+      is_dir = backend.isdir(path)
+    except OSError: # does not exist
+      is_dir = None
+    if is_dir is not None:
+      (folders if is_dir else files)[parent] = data if with_stat else None
+    parent = os.path.dirname(parent)
+  if subtree != os.curdir and (subtree not in folders or backend.islink(os.path.join(root_folder, subtree))):
+    return folders, files # symlinks to folders are not descended into
+  
+  # scan one folder; the dicts are only updated with distinct keys, which is safe from several threads
+  def scan_dir(relative_dirpath):
+    subdirs = []
+    #
+    def skip(name, is_dir):
+      return ignore is not None and ignore.ignored(os.path.normpath(os.path.join(relative_dirpath, name)), is_dir)
+    try:
+      entries = backend.list_dir(os.path.join(root_folder, relative_dirpath), with_stat, skip)
+    except OSError: # directory was removed during the walk
+      return subdirs
+    for name, is_dir, is_link, data in entries:
+      relative_path = os.path.normpath(os.path.join(relative_dirpath, name))
+      if is_dir:
+        folders[relative_path] = data
+        if not is_link:
+          subdirs.append(relative_path)
+      else:
+        files[relative_path] = data
+    return subdirs
+  
+  walk_dirs(scan_dir, workers, subtree)
   return folders, files
 
+# walks all files and folders like relative_scan(), but remembers the mtime and listing of each directory; a directory 
+# is only listed again if its mtime changed; every directory is still lstat'ed, b/c the mtime of a directory only 
+# changes if its direct entries change; paths ignored by the ignore_matcher ignore are skipped like in relative_scan(); 
+# the folder is accessed with backend (default: posix_backend)
+class incremental_walker:
+  #
+  def __init__(self, root_folder, ignore = None, backend = None):
+    logger.trace("incremental_walker::__init__() root_folder='%s'", root_folder)
+    self.root_folder = root_folder
+    self.ignore = ignore
+    self.backend = backend or posix
+    self.dirs = {} # relative dirpath -> (mtime, stable, dirnames, linked_dirnames, filenames)
+    
+  # list a directory like os.walk(): symlinks to directories are in dirnames, but are not descended into
+  def list_dir(self, dirpath, relative_dirpath):
+    logger.trace("incremental_walker::list_dir() dirpath='%s'", dirpath)
+    dirnames = []
+    linked_dirnames = set()
+    filenames = []
+    #
+    def skip(name, is_dir):
+      return self.ignore is not None and self.ignore.ignored(os.path.normpath(os.path.join(relative_dirpath, name)), 
+                                                             is_dir)
+    for name, is_dir, is_link, data in self.backend.list_dir(dirpath, False, skip):
+      if is_dir:
+        dirnames.append(name)
+        if is_link:
+          linked_dirnames.add(name)
+      else:
+        filenames.append(name)
+    return dirnames, linked_dirnames, filenames
+    
+  # return the sets of relative folders and files, and the set of relative dirpaths that were listed; if full is True, 
+  # all directories are listed
+  def walk(self, full = False, workers = 1):
+    logger.trace("incremental_walker::walk() full=%s workers=%d", full, workers)
+    folders = set()
+    files = set()
+    listed_dirs = set()
+    new_dirs = {}
+    
+    # scan one folder; the sets and dicts are only updated with distinct keys, which is safe from several threads
+    def scan_dir(relative_dirpath):
+      subdirs = []
+      dirpath = os.path.join(self.root_folder, relative_dirpath)
+      try:
+        mtime = self.backend.stat(dirpath).mtime
+        cached = self.dirs.get(relative_dirpath)
+        # the listing is only reused if the same mtime was seen before in two walks; this avoids missing a change that 
+        # happens within the mtime resolution right after the directory was listed
+        if not full and cached is not None and cached[0] == mtime and cached[1]:
+          dirnames, linked_dirnames, filenames = cached[2:]
+        else:
+          dirnames, linked_dirnames, filenames = self.list_dir(dirpath, relative_dirpath)
+          listed_dirs.add(relative_dirpath)
+      except OSError: # directory was removed during the walk
+        return subdirs
+      new_dirs[relative_dirpath] = (mtime, cached is not None and cached[0] == mtime, dirnames, linked_dirnames, 
+                                    filenames)
+      for dirname in dirnames:
+        relative_path = os.path.normpath(os.path.join(relative_dirpath, dirname))
+        folders.add(relative_path)
+        if dirname not in linked_dirnames:
+          subdirs.append(relative_path)
+      for filename in filenames:
+        files.add(os.path.normpath(os.path.join(relative_dirpath, filename)))
+      return subdirs
+    
+    walk_dirs(scan_dir, workers)
+    logger.debug("incremental_walker::walk() listed %d of %d directories", len(listed_dirs), len(new_dirs))
+    self.dirs = new_dirs
+    return folders, files, listed_dirs
+
+# return if relative_path is in busy, is a parent folder of a path in busy (i.e. in busy_parents), or if one of its 
+# parent folders is in busy
+def path_conflicts(relative_path, busy, busy_parents):
+  if relative_path in busy or relative_path in busy_parents:
+    return True
+  parent = os.path.dirname(relative_path)
+  while parent:
+    if parent in busy:
+      return True
+    parent = os.path.dirname(parent)
+  return False
+
+# add relative_path to busy and all its parent folders to busy_parents
+def add_busy_path(relative_path, busy, busy_parents):
+  busy.add(relative_path)
+  parent = os.path.dirname(relative_path)
+  while parent and parent not in busy_parents:
+    busy_parents.add(parent)
+    parent = os.path.dirname(parent)
+
 #
 def list_files(path):
   logger.trace("list_files() path='%s'", path)
   if(os.path.exists(path)):
-    return [os.path.join(path, f) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))] 
+    return [entry.path for entry in os.scandir(path) if entry.is_file()] # usually without lstat'ing each file
   else:
     return []
 
@@ -123,30 +525,1009 @@ def write_file_contents(path, contents):
   f.write(contents)
   f.close()
 
+# token bucket to limit the rate of copied bytes across several threads; rate in bytes per second; up to capacity bytes 
+# can be consumed at once without waiting
+class tokenbucket:
+  #
+  def __init__(self, rate, capacity = None):
+    logger.trace("tokenbucket::__init__() rate=%f", rate)
+    self.rate = float(rate)
+    self.capacity = capacity if capacity is not None else max(self.rate, copy_chunk_size)
+    self.tokens = self.capacity
+    self.last_time = timeit.default_timer()
+    self.lock = threading.Lock()
+    
+  # take n tokens and wait until they would have been available; tokens are reserved before waiting, so waiting threads 
+  # are served in order; interactive transfers do not wait, but take tokens on credit (at most capacity), which slows 
+  # down the other transfers accordingly
+  def consume(self, n, interactive = False):
+    with self.lock:
+      now = timeit.default_timer()
+      self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+      self.last_time = now
+      if interactive:
+        self.tokens = max(self.tokens - n, min(self.tokens, -self.capacity))
+        return
+      self.tokens -= n
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+      
+  # number of bytes to copy at once, so that a single wait is short
+  def chunk_size(self):
+    return int(max(4096, min(copy_chunk_size, self.rate / 4)))
+
+# the operations of lazysync on the files of a synced folder, with full paths; posix_backend does them directly on a
+# mounted folder; another backend can implement them differently (e.g. list a folder with stat in a single request),
+# but the folder still has to be mounted for the symlinks local -> remote in lazy mode; raises OSError like os; 
+# server_side_copy is True if copy_range() copies on the server of the mount without transferring the bytes (e.g. nfs 
+# 4.2, smb 3), which cannot be detected; only then delta transfers to it are used
+class posix_backend:
+  #
+  def __init__(self, server_side_copy = False):
+    self.server_side_copy = server_side_copy
+
+  # return a list of (name, is_dir, is_link, syncfiledata) of the entries of a folder; like os.walk(), symlinks to
+  # folders are folders; syncfiledata is None if with_stat is False; entries for which skip(name, is_dir) returns True
+  # are left out before they are lstat'ed, and so are entries removed during the listing
+  def list_dir(self, path, with_stat = True, skip = None):
+    entries = []
+    for entry in os.scandir(path):
+      try:
+        is_dir = entry.is_dir()
+        if skip is not None and skip(entry.name, is_dir):
+          continue
+        is_link = entry.is_symlink()
+        data = None
+        if with_stat:
+          data = syncfiledata(entry.path, entry.stat(follow_symlinks = False),
+                              os.readlink(entry.path) if is_link else None)
+      except OSError:
+        continue
+      entries.append((entry.name, is_dir, is_link, data))
+    return entries
+
+  # return the syncfiledata of path, without following symlinks
+  def stat(self, path):
+    return syncfiledata(path, os.lstat(path))
+
+  #
+  def lexists(self, path):
+    return os.path.lexists(path)
+
+  #
+  def isdir(self, path):
+    return os.path.isdir(path)
+
+  #
+  def isfile(self, path):
+    return os.path.isfile(path)
+
+  #
+  def islink(self, path):
+    return os.path.islink(path)
+
+  #
+  def readlink(self, path):
+    return os.readlink(path)
+
+  #
+  def realpath(self, path):
+    return os.path.realpath(path)
+
+  # return up to size bytes of path, starting at offset; path is opened for this read only, see open_read()
+  def read_range(self, path, offset, size):
+    with open(path, 'rb') as f:
+      f.seek(offset)
+      return f.read(size)
+
+  # return a file object to read path, e.g. in chunks, without opening it for each chunk like read_range()
+  def open_read(self, path):
+    return open(path, 'rb')
+
+  # return a file object to write path from offset on; the contents after offset are removed
+  def open_write(self, path, offset = 0):
+    f = open(path, 'r+b' if offset > 0 else 'wb')
+    f.seek(offset)
+    f.truncate()
+    return f
+
+  # copy size bytes at offset of from_path to the current position of to_file (returned by open_write()); both are on 
+  # this backend; with os.copy_file_range(), the bytes are not read into python, and a network filesystem that supports 
+  # server-side copies (e.g. nfs 4.2, smb 3) copies them without transferring them; return the number of bytes that 
+  # were transferred to and from the backend for the copy: none with server_side_copy, otherwise read and written back
+  def copy_range(self, from_path, offset, size, to_file):
+    to_file.flush()
+    to_offset = to_file.tell()
+    copied = 0
+    with open(from_path, 'rb') as from_file:
+      if hasattr(os, 'copy_file_range'): # python 3.8 on linux
+        try:
+          while copied < size:
+            num_copied = os.copy_file_range(from_file.fileno(), to_file.fileno(), size - copied, offset + copied, 
+                                            to_offset + copied)
+            if num_copied == 0:
+              break
+            copied += num_copied
+        except OSError as e: # not supported between these files, copy the rest below
+          logger.debug("posix_backend::copy_range() copy_file_range() failed: %s", e)
+      to_file.seek(to_offset + copied)
+      from_file.seek(offset + copied)
+      while copied < size:
+        chunk = from_file.read(min(copy_chunk_size, size - copied))
+        if not chunk:
+          break
+        to_file.write(chunk)
+        copied += len(chunk)
+    to_file.seek(to_offset + copied)
+    return 0 if self.server_side_copy else 2 * copied
+
+  # rename from_path to to_path, replacing to_path; both are on this backend; like shutil.move(), a path is copied if 
+  # it is on a different filesystem
+  def rename(self, from_path, to_path):
+    shutil.move(from_path, to_path)
+
+  #
+  def remove(self, path):
+    os.remove(path)
+
+  #
+  def rmdir(self, path):
+    os.rmdir(path)
+
+  #
+  def makedirs(self, path):
+    make_sure_path_exists(path)
+
+  #
+  def symlink(self, target, path):
+    os.symlink(target, path)
+
+  # set the permissions and times of path to the ones of data, like shutil.copystat()
+  def copystat(self, data, path):
+    if data.mode is not None:
+      os.chmod(path, stat.S_IMODE(data.mode))
+    os.utime(path, (data.atime, data.mtime))
+
+# posix_backend with a simulated latency per operation (and per lstat'ed entry of a listing, like a mounted remote
+# filesystem), and file contents transferred over a link with bandwidth (bytes per second, 0 is unlimited) that is
+# shared by all operations; copies of ranges between remote files are transferred twice (read and written back), like 
+# on most mounts, unless server_side_copy is True (like on nfs 4.2 or smb 3); for testing and benchmarking
+class shaped_backend(posix_backend):
+  #
+  def __init__(self, latency = 0, bandwidth = 0, server_side_copy = False):
+    logger.trace("shaped_backend::__init__() latency=%f bandwidth=%f", latency, bandwidth)
+    posix_backend.__init__(self, server_side_copy)
+    self.latency = latency
+    self.link = tokenbucket(bandwidth, 0) if bandwidth > 0 else None # no burst
+    self.transferred = 0 # bytes transferred over the link
+    self.lock = threading.Lock()
+
+  # wait for one operation
+  def delay(self, operations = 1):
+    if self.latency > 0:
+      time.sleep(self.latency * operations)
+
+  # wait until n bytes are transferred
+  def transfer(self, n):
+    with self.lock:
+      self.transferred += n
+    if self.link is not None and n > 0:
+      self.link.consume(n)
+
+  #
+  def list_dir(self, path, with_stat = True, skip = None):
+    entries = posix_backend.list_dir(self, path, with_stat, skip)
+    self.delay(1 + (len(entries) if with_stat else 0))
+    return entries
+
+  #
+  def read_range(self, path, offset, size):
+    self.delay()
+    data = posix_backend.read_range(self, path, offset, size)
+    self.transfer(len(data))
+    return data
+
+  #
+  def open_read(self, path):
+    self.delay()
+    return shaped_file(self, posix_backend.open_read(self, path))
+
+  #
+  def open_write(self, path, offset = 0):
+    self.delay()
+    return shaped_file(self, posix_backend.open_write(self, path, offset))
+
+  #
+  def copy_range(self, from_path, offset, size, to_file):
+    self.delay()
+    if not self.server_side_copy:
+      self.transfer(2 * size)
+    return posix_backend.copy_range(self, from_path, offset, size, to_file.file) # not transferred again by to_file
+
+  #
+  def stat(self, path):
+    self.delay()
+    return posix_backend.stat(self, path)
+
+  #
+  def lexists(self, path):
+    self.delay()
+    return posix_backend.lexists(self, path)
+
+  #
+  def isdir(self, path):
+    self.delay()
+    return posix_backend.isdir(self, path)
+
+  #
+  def isfile(self, path):
+    self.delay()
+    return posix_backend.isfile(self, path)
+
+  #
+  def islink(self, path):
+    self.delay()
+    return posix_backend.islink(self, path)
+
+  #
+  def readlink(self, path):
+    self.delay()
+    return posix_backend.readlink(self, path)
+
+  #
+  def realpath(self, path):
+    self.delay()
+    return posix_backend.realpath(self, path)
+
+  #
+  def rename(self, from_path, to_path):
+    self.delay()
+    return posix_backend.rename(self, from_path, to_path)
+
+  #
+  def remove(self, path):
+    self.delay()
+    return posix_backend.remove(self, path)
+
+  #
+  def rmdir(self, path):
+    self.delay()
+    return posix_backend.rmdir(self, path)
+
+  #
+  def makedirs(self, path):
+    self.delay()
+    return posix_backend.makedirs(self, path)
+
+  #
+  def symlink(self, target, path):
+    self.delay()
+    return posix_backend.symlink(self, target, path)
+
+  #
+  def copystat(self, data, path):
+    self.delay()
+    return posix_backend.copystat(self, data, path)
+
+# a file opened by shaped_backend, whose reads and writes are transferred over its link; a read that does not continue 
+# the previous one waits for another operation, like a read_range()
+class shaped_file:
+  #
+  def __init__(self, backend, f):
+    self.backend = backend
+    self.file = f
+    self.position = f.tell() # after the previous read
+
+  #
+  def read(self, size = -1):
+    if self.file.tell() != self.position:
+      self.backend.delay()
+    data = self.file.read(size)
+    self.backend.transfer(len(data))
+    self.position = self.file.tell()
+    return data
+
+  #
+  def write(self, data):
+    self.backend.transfer(len(data))
+    return self.file.write(data)
+
+  #
+  def __enter__(self):
+    return self
+
+  #
+  def __exit__(self, *args):
+    self.file.close()
+
+  #
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+posix = posix_backend() # for local, and for remote unless a different backend is configured
+
+# predicts the files that are accessed next after an access in lazy mode: files that were accessed together with it 
+# before (within window seconds), then its siblings following it in name order, then the preceding ones; the history 
+# of accesses is only kept in memory
+class prefetcher:
+  #
+  def __init__(self, max_count, max_bytes, window = 60, history_size = 8, max_prefetched = 10000):
+    logger.trace("prefetcher::__init__() max_count=%d max_bytes=%d", max_count, max_bytes)
+    self.max_count = max_count
+    self.max_bytes = max_bytes
+    self.window = window
+    self.recent = deque(maxlen = history_size) # (time, relative path) of the last accesses
+    self.co_accesses = defaultdict(Counter) # relative path -> relative paths accessed together with it -> count
+    self.prefetched = OrderedDict() # relative paths that were prefetched and not accessed yet, oldest first
+    self.max_prefetched = max_prefetched
+    self.num_prefetched = 0
+    self.num_hits = 0
+    self.lock = threading.Lock()
+    
+  # remember an access of relative_path; return True if it was prefetched before
+  def record_access(self, relative_path):
+    logger.trace("prefetcher::record_access() '%s'", relative_path)
+    now = timeit.default_timer()
+    with self.lock:
+      for access_time, other_path in self.recent:
+        if other_path != relative_path and now - access_time <= self.window:
+          self.co_accesses[other_path][relative_path] += 1
+          self.co_accesses[relative_path][other_path] += 1
+      self.recent.append((now, relative_path))
+      if relative_path not in self.prefetched:
+        return False
+      del self.prefetched[relative_path]
+      self.num_hits += 1
+      return True
+
+  # forget that relative_path was prefetched, b/c it is a symlink again (e.g. evicted), so that a later access is not 
+  # counted as a hit
+  def forget(self, relative_path):
+    with self.lock:
+      self.prefetched.pop(relative_path, None)
+  
+  # return the relative paths to prefetch after an access of relative_path, within the count and byte budgets; siblings 
+  # are the relative paths in the same folder; size_of returns the size of a relative path that can be prefetched, or 
+  # None if it cannot be prefetched (e.g. it was already downloaded)
+  def select(self, relative_path, siblings, size_of):
+    logger.trace("prefetcher::select() '%s'", relative_path)
+    with self.lock:
+      co_accessed = [path for path, count in self.co_accesses[relative_path].most_common()]
+    siblings = sorted(siblings)
+    following = [path for path in siblings if path > relative_path]
+    preceding = [path for path in reversed(siblings) if path < relative_path]
+    
+    selected = []
+    num_bytes = 0
+    for path in co_accessed + following + preceding:
+      if len(selected) >= self.max_count:
+        break
+      if path == relative_path or path in selected or path in self.prefetched:
+        continue
+      size = size_of(path)
+      if size is None or num_bytes + size > self.max_bytes:
+        continue
+      selected.append(path)
+      num_bytes += size
+      
+    with self.lock:
+      for path in selected:
+        self.prefetched[path] = True
+        self.num_prefetched += 1
+      while len(self.prefetched) > self.max_prefetched:
+        self.prefetched.popitem(last = False)
+    logger.debug("prefetcher::select() '%s' -> %d paths, %d bytes", relative_path, len(selected), num_bytes)
+    return selected
+  
+  # fraction of prefetched files that were accessed afterwards
+  def hit_rate(self):
+    return float(self.num_hits) / self.num_prefetched if self.num_prefetched > 0 else 0.0
+
+# metrics in the text format of prometheus; descriptions is a sequence of (name, type, help) in the order of the export;
+# counters and gauges have one value per set of labels, summaries a count and a sum; thread-safe
+class metrics:
+  #
+  def __init__(self, descriptions):
+    logger.trace("metrics::__init__()")
+    self.descriptions = OrderedDict((name, (metric_type, help_text)) for name, metric_type, help_text in descriptions)
+    self.values = defaultdict(dict) # name -> labels -> value, or [count, sum] for summaries
+    self.lock = threading.Lock()
+
+  # add value to a counter
+  def inc(self, name, value = 1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[name][key] = self.values[name].get(key, 0) + value
+
+  # set a gauge, or a counter that is counted elsewhere
+  def set(self, name, value, **labels):
+    with self.lock:
+      self.values[name][tuple(sorted(labels.items()))] = value
+
+  # add an observation to a summary
+  def observe(self, name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      summary = self.values[name].setdefault(key, [0, 0.0])
+      summary[0] += 1
+      summary[1] += value
+
+  # observe the duration of a with block in a summary
+  @contextlib.contextmanager
+  def time(self, name, **labels):
+    start_time = timeit.default_timer()
+    try:
+      yield
+    finally:
+      self.observe(name, timeit.default_timer() - start_time, **labels)
+
+  # return all metrics in the text format of prometheus
+  def text(self):
+    #
+    def format_labels(key):
+      if not key:
+        return ''
+      return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                            .replace('\n', '\\n')) for label, value in key)
+    lines = []
+    with self.lock:
+      for name, (metric_type, help_text) in self.descriptions.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for key, value in sorted(self.values.get(name, {}).items()):
+          if metric_type == 'summary':
+            lines.append('%s_count%s %d' % (name, format_labels(key), value[0]))
+            lines.append('%s_sum%s %r' % (name, format_labels(key), float(value[1])))
+          else:
+            lines.append('%s%s %r' % (name, format_labels(key), float(value)))
+    return '\n'.join(lines) + '\n'
+
+# return a new hash object to hash file contents
+def new_content_hash():
+  return hashlib.sha256()
+
+# return offset if the chunk before offset is equal in both files (returned by open_read()), otherwise 0
+def verified_offset(from_file, partial_file, offset):
+  logger.trace("verified_offset() offset=%d", offset)
+  if offset == 0:
+    return 0
+  from_file.seek(offset - copy_chunk_size)
+  partial_file.seek(offset - copy_chunk_size)
+  if from_file.read(copy_chunk_size) == partial_file.read(copy_chunk_size):
+    return offset
+  logger.info("verified_offset() last chunk of '%s' differs, not resuming", partial_file.name)
+  return 0
+
+# copy from_path to partial_path in chunks; the size and mtime of from_path are kept in partial_path + '.source', so an 
+# interrupted copy of the same version of from_path is resumed from the last complete chunk, if that chunk is verified 
+# to be equal; the copy rate is limited by bucket, if given; the contents are hashed while copying, and signature (a 
+# blocksignature) is updated with them, if given; progress is called with the number of bytes in partial_path before 
+# the first and after each chunk, if given; from_path is read with from_backend and partial_path written with 
+# to_backend (default: posix_backend); return the content hash, or None if the copy was interrupted by ctrl-c
+def copy_file_resumable(from_path, partial_path, bucket = None, interactive = False, progress = None, 
+                        from_backend = None, to_backend = None, signature = None):
+  logger.trace("copy_file_resumable() from='%s' partial='%s'", from_path, partial_path)
+  from_backend = from_backend or posix
+  to_backend = to_backend or posix
+  source_path = partial_path + '.source'
+  from_data = from_backend.stat(from_path)
+  source = [from_data.size, from_data.mtime]
+  resume = to_backend.isfile(partial_path) and to_backend.isfile(source_path) \
+           and jsonpickle.decode(to_backend.read_range(source_path, 0, -1).decode('utf-8')) == source
+  if not resume:
+    to_backend.makedirs(os.path.dirname(partial_path))
+    with to_backend.open_write(source_path) as source_file:
+      source_file.write(jsonpickle.encode(source).encode('utf-8'))
+    
+  start_time = timeit.default_timer()
+  content_hash = new_content_hash()
+  offset = 0
+  with from_backend.open_read(from_path) as from_file:
+    if resume:
+      with to_backend.open_read(partial_path) as partial_file:
+        offset = verified_offset(from_file, partial_file, 
+                                 to_backend.stat(partial_path).size // copy_chunk_size * copy_chunk_size)
+        partial_file.seek(0)
+        hashed = 0
+        while hashed < offset: # hash what was copied before, as it is in partial_path
+          chunk = partial_file.read(min(copy_chunk_size, offset - hashed))
+          content_hash.update(chunk)
+          if signature is not None:
+            signature.update(chunk)
+          hashed += len(chunk)
+    if offset > 0:
+      logger.info("copy_file_resumable() resuming copy of '%s' at %d of %d bytes", from_path, offset, from_data.size)
+    if progress is not None:
+      progress(offset)
+    
+    from_file.seek(offset)
+    with to_backend.open_write(partial_path, offset) as partial_file:
+      copied = 0
+      read_size = copy_chunk_size if bucket is None else bucket.chunk_size()
+      while True:
+        if sigint: # keep the partial file to resume later
+          logger.info("copy_file_resumable() copy of '%s' interrupted at %d bytes", from_path, offset + copied)
+          return None
+        chunk = from_file.read(read_size)
+        if not chunk:
+          break
+        if bucket is not None:
+          bucket.consume(len(chunk), interactive)
+        content_hash.update(chunk)
+        if signature is not None:
+          signature.update(chunk)
+        partial_file.write(chunk)
+        copied += len(chunk)
+        if progress is not None:
+          progress(offset + copied)
+      partial_file.flush()
+      os.fsync(partial_file.fileno())
+  to_backend.remove(source_path)
+  
+  duration = timeit.default_timer() - start_time
+  logger.info("copy_file_resumable() copied %d bytes of '%s' in %.3fs (%.2f MB/s)%s", copied, from_path, duration, 
+              copied / max(duration, 1e-6) / 1e6, ' after resuming at %d bytes' % offset if offset > 0 else '')
+  return content_hash.hexdigest()
+
+# return the block size of delta transfers for a file of size bytes: a power of 2 near its square root like in rsync, 
+# so that the signature and the number of blocks grow slowly with the size
+def delta_block_size(size):
+  block_size = 4096
+  while block_size < 1024 * 1024 and block_size * block_size < size:
+    block_size *= 2
+  return block_size
+
+# the signature of a file for delta transfers like in rsync: the weak (adler-32) and strong (md5) checksums of its 
+# blocks of block_size bytes; the last block may be shorter; it is built with update() with the contents in order and 
+# finish() at the end
+class blocksignature:
+  #
+  def __init__(self, block_size):
+    self.block_size = block_size
+    self.size = 0
+    self.weak = array.array('I')
+    self.strong = [] # md5 digests
+    self.pending = b'' # contents after the last complete block
+    self.by_weak = None # weak checksum -> indexes of the complete blocks with it; see lookup()
+
+  #
+  def update(self, data):
+    self.size += len(data)
+    if self.pending:
+      data = self.pending + data
+    view = memoryview(data)
+    end = len(data) // self.block_size * self.block_size
+    for offset in range(0, end, self.block_size):
+      block = view[offset:offset + self.block_size]
+      self.weak.append(zlib.adler32(block))
+      self.strong.append(hashlib.md5(block).digest())
+    self.pending = bytes(view[end:])
+
+  # add the shorter last block, if any; can be called more than once
+  def finish(self):
+    if self.pending:
+      self.weak.append(zlib.adler32(self.pending))
+      self.strong.append(hashlib.md5(self.pending).digest())
+      self.pending = b''
+
+  # return a dict weak checksum -> indexes of the complete blocks with it
+  def lookup(self):
+    if self.by_weak is None:
+      self.by_weak = {}
+      for index in range(self.size // self.block_size):
+        self.by_weak.setdefault(self.weak[index], []).append(index)
+    return self.by_weak
+
+  # return block_size, size and the checksums as bytes, to store them; see from_values()
+  def values(self):
+    self.finish()
+    return self.block_size, self.size, self.weak.tobytes(), b''.join(self.strong)
+
+  # return a blocksignature from the values returned by values()
+  @classmethod
+  def from_values(cls, block_size, size, weak, strong):
+    signature = cls(block_size)
+    signature.size = size
+    signature.weak.frombytes(weak)
+    signature.strong = [strong[offset:offset + 16] for offset in range(0, len(strong), 16)]
+    return signature
+
+# return the offsets and the weak checksums (adler-32) of the windows of size bytes of data whose lower 16 bits are 
+# True in the numpy array known, as numpy arrays; the rolling sums are computed from the prefix sums of the bytes and 
+# of the bytes times their offset, the upper 16 bits only for the windows that pass the filter
+def rolling_checksums(data, size, known):
+  x = numpy.frombuffer(data, dtype = numpy.uint8).astype(numpy.int64)
+  s1 = numpy.concatenate(([0], numpy.cumsum(x)))
+  n = len(x) - size + 1
+  a = (s1[size:] - s1[:n] + 1) % 65521
+  offsets = numpy.flatnonzero(known[a])
+  s2 = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x)))))
+  b = ((offsets + size) * (s1[offsets + size] - s1[offsets]) - (s2[offsets + size] - s2[offsets]) + size) % 65521
+  return offsets, a[offsets] | (b << 16)
+
+# yield the delta of a file against its old version with blocksignature signature: (offset, size) of a range to copy 
+# from the old version, or the bytes that are not in it; the file is read with read(offset, size), and update is called 
+# with each chunk that is read, if given; like in rsync, the blocks of the old version are found at any offset with a 
+# rolling weak checksum, and confirmed with the strong one; with numpy, the weak checksums of all offsets in a chunk are 
+# computed at once; without it, they are rolled in python only for 4 blocks after a match, and after that only offsets 
+# of whole blocks are checked until the next match, so that a rewritten file is not rolled over byte by byte
+def delta_ranges(read, signature, update = None):
+  logger.trace("delta_ranges() block_size=%d size=%d", signature.block_size, signature.size)
+  block_size = signature.block_size
+  lookup = signature.lookup()
+  if numpy is not None:
+    weak_checksums = numpy.array(sorted(lookup), dtype = numpy.int64)
+    weak_low = numpy.zeros(65536, dtype = bool) # the lower 16 bits of the weak checksums, to filter quickly
+    weak_low[weak_checksums & 0xffff] = True
+  buffer = b''
+  base = 0 # offset of buffer in the file
+  pos = 0 # offset in buffer of the next window to check
+  literal_start = 0 # offset in buffer of the bytes that are not yielded yet
+  candidates = None # numpy: offsets in buffer of the windows with a known weak checksum, and the checksums
+  rolled = 0 # without numpy: bytes rolled over since the last match
+  eof = False
+
+  # return the index of the complete block of the old version equal to the window at offset in buffer, or None; weak 
+  # is the weak checksum of the window, if known
+  def match(offset, weak = None):
+    window = memoryview(buffer)[offset:offset + block_size]
+    indexes = lookup.get(zlib.adler32(window) if weak is None else weak)
+    if indexes:
+      strong = hashlib.md5(window).digest()
+      for index in indexes:
+        if signature.strong[index] == strong:
+          return index
+    return None
+
+  while True:
+    if len(buffer) - pos < block_size and not eof:
+      chunk = read(base + len(buffer), copy_chunk_size)
+      eof = not chunk
+      if update is not None and chunk:
+        update(chunk)
+      buffer = buffer[literal_start:] + chunk
+      base += literal_start
+      pos -= literal_start
+      literal_start = 0
+      candidates = None
+      continue
+    if len(buffer) - pos < block_size:
+      break
+    index = match(pos)
+    if index is None and numpy is not None:
+      if candidates is None:
+        offsets, checksums = rolling_checksums(memoryview(buffer)[pos:], block_size, weak_low)
+        found = numpy.isin(checksums, weak_checksums)
+        candidates = (offsets[found] + pos, checksums[found])
+      for i in range(numpy.searchsorted(candidates[0], pos + 1), len(candidates[0])):
+        index = match(int(candidates[0][i]), int(candidates[1][i]))
+        if index is not None:
+          pos = int(candidates[0][i])
+          break
+      else:
+        pos = len(buffer) - block_size + 1 # no match in buffer
+    elif index is None and rolled < 4 * block_size:
+      end = min(len(buffer) - block_size, pos + 4 * block_size - rolled)
+      a = zlib.adler32(memoryview(buffer)[pos:pos + block_size])
+      a, b = a & 0xffff, a >> 16
+      start = pos
+      while pos < end:
+        removed = buffer[pos]
+        added = buffer[pos + block_size]
+        a = (a - removed + added) % 65521
+        b = (b - block_size * removed + a - 1) % 65521
+        pos += 1
+        weak = a | (b << 16)
+        if weak in lookup:
+          index = match(pos, weak)
+          if index is not None:
+            break
+      rolled += pos - start
+      if index is None:
+        pos += 1
+    elif index is None:
+      pos += block_size
+    if index is None:
+      if pos - literal_start >= copy_chunk_size:
+        yield buffer[literal_start:pos]
+        literal_start = pos
+      continue
+    if pos > literal_start:
+      yield buffer[literal_start:pos]
+    yield (index * block_size, block_size)
+    pos += block_size
+    literal_start = pos
+    rolled = 0
+
+  # the shorter last block of the old version can only match at the end
+  last_size = signature.size % block_size
+  if last_size and len(buffer) - pos == last_size and hashlib.md5(buffer[pos:]).digest() == signature.strong[-1]:
+    if pos > literal_start:
+      yield buffer[literal_start:pos]
+    yield (signature.size - last_size, last_size)
+  elif len(buffer) > literal_start:
+    yield buffer[literal_start:]
+
+# copy from_path to partial_path with a delta transfer against old_path, the old version of from_path on the side of 
+# partial_path with blocksignature old_signature: the ranges of from_path that are in old_path are copied from old_path 
+# with to_backend.copy_range(), and only the other bytes are written; the rate of the written bytes is limited by 
+# bucket, if given; the contents are hashed while copying, and new_signature is updated with them, if given; progress is 
+# called with the number of bytes in partial_path and the number of bytes transferred to to_backend (written, and moved 
+# by copy_range()) before the first and after each range, if given; from_path is read with from_backend and 
+# partial_path written with to_backend (default: posix_backend); unlike copy_file_resumable(), an interrupted copy 
+# starts over; like the hash cache, old_signature is trusted to match old_path as long as its size and mtime are 
+# unchanged, b/c reading the copied ranges back to verify them would transfer them; return the content hash, or None if 
+# the copy was interrupted by ctrl-c
+def copy_file_delta(from_path, old_path, old_signature, partial_path, bucket = None, interactive = False, 
+                    progress = None, new_signature = None, from_backend = None, to_backend = None):
+  logger.trace("copy_file_delta() from='%s' old='%s' partial='%s'", from_path, old_path, partial_path)
+  from_backend = from_backend or posix
+  to_backend = to_backend or posix
+  source_path = partial_path + '.source'
+  if to_backend.isfile(source_path): # of an interrupted copy_file_resumable(), which is not resumed after this copy
+    to_backend.remove(source_path)
+  to_backend.makedirs(os.path.dirname(partial_path))
+  if progress is not None:
+    progress(0, 0)
+
+  start_time = timeit.default_timer()
+  content_hash = new_content_hash()
+  #
+  def update(chunk):
+    content_hash.update(chunk)
+    if new_signature is not None:
+      new_signature.update(chunk)
+  copied = [0, 0] # bytes in partial_path, transferred bytes
+  pending = [0, 0] # offset and size of the range to copy from old_path, merged with the following adjacent ranges
+  read_size = copy_chunk_size if bucket is None else bucket.chunk_size()
+  with from_backend.open_read(from_path) as from_file, to_backend.open_write(partial_path) as partial_file:
+    #
+    def read(offset, size):
+      from_file.seek(offset)
+      return from_file.read(size)
+    # copy the pending range from old_path
+    def copy_pending():
+      if pending[1] > 0:
+        copied[1] += to_backend.copy_range(old_path, pending[0], pending[1], partial_file)
+        copied[0] += pending[1]
+        pending[1] = 0
+        if progress is not None:
+          progress(copied[0], copied[1])
+    for delta in delta_ranges(read, old_signature, update):
+      if sigint:
+        logger.info("copy_file_delta() copy of '%s' interrupted at %d bytes", from_path, copied[0])
+        return None
+      if isinstance(delta, tuple):
+        if pending[1] > 0 and pending[0] + pending[1] == delta[0]:
+          pending[1] += delta[1]
+        else:
+          copy_pending()
+          pending[:] = delta
+        continue
+      copy_pending()
+      for offset in range(0, len(delta), read_size):
+        chunk = delta[offset:offset + read_size]
+        if bucket is not None:
+          bucket.consume(len(chunk), interactive)
+        partial_file.write(chunk)
+      copied[0] += len(delta)
+      copied[1] += len(delta)
+      if progress is not None:
+        progress(copied[0], copied[1])
+    copy_pending()
+    partial_file.flush()
+    os.fsync(partial_file.fileno())
+
+  duration = timeit.default_timer() - start_time
+  logger.info("copy_file_delta() copied %d bytes of '%s' in %.3fs, %d bytes transferred (%.2f MB/s)", copied[0], 
+              from_path, duration, copied[1], copied[1] / max(duration, 1e-6) / 1e6)
+  return content_hash.hexdigest()
+
 #
 class synctask:
   #
-  def __init__(self, relative_path, action):
+  def __init__(self, relative_path, action, priority = task_priorities.small):
     logger.trace("synctask::__init__()")
     self.relative_path = relative_path
     self.action = action
+    self.priority = priority
+    self.queued = False
+    self.in_heap = False # if it is in the heap of syncqueue, which removes taken tasks and old keys lazily
+    self.seq = None # order in which tasks were queued
+    self.key = None # order in which tasks are processed
+    self.queue_time = None
+    self.wait_time = None # seconds between queueing and taking it from the queue
+
+# queue of synctasks, ordered by priority and age: a task is taken before tasks of lower priority, unless they were 
+# queued more than aging seconds per priority level earlier, so that no task waits forever; a task is never taken before 
+# a task on the same path, on a parent folder or on a path inside it that was queued before it, so that related tasks 
+# keep their order (e.g. mkdir before cp of a file inside); thread-safe
+class syncqueue:
+  #
+  def __init__(self, aging):
+    logger.trace("syncqueue::__init__() aging=%f", aging)
+    self.aging = aging
+    self.heap = [] # (key, seq, synctask); contains tasks that were already taken
+    self.at_path = {} # relative path -> list of (seq, synctask) queued on it
+    self.below = {} # relative path -> heap of (seq, synctask) queued inside it; contains tasks that were already taken
+    self.num_below = Counter() # relative path -> number of tasks queued inside it
+    self.num_queued = 0
+    self.num_by_priority = Counter() # priority -> number of queued tasks
+    self.next_seq = 0
+    self.wait_stats = defaultdict(lambda: [0, 0.0, 0.0]) # priority -> [number of tasks, total wait time, max wait time]
+    self.lock = threading.Lock()
+  
+  #
+  def __len__(self):
+    return self.num_queued
+  
+  #
+  def __bool__(self):
+    return self.num_queued > 0
+  
+  # return if a task on relative_path is queued
+  def __contains__(self, relative_path):
+    return relative_path in self.at_path
+  
+  # queued tasks in the order they would be taken, ignoring the order of related tasks
+  def __iter__(self):
+    with self.lock:
+      return iter([task for key, seq, task in sorted(self.heap) if task.queued and key == task.key])
+  
+  #
+  def _insert(self, task):
+    task.queued = True
+    if not task.in_heap: # a requeued task may still be in the heap
+      heapq.heappush(self.heap, (task.key, task.seq, task))
+      task.in_heap = True
+    bisect.insort(self.at_path.setdefault(task.relative_path, []), (task.seq, task))
+    parent = os.path.dirname(task.relative_path)
+    while parent:
+      heapq.heappush(self.below.setdefault(parent, []), (task.seq, task))
+      self.num_below[parent] += 1
+      parent = os.path.dirname(parent)
+    self.num_queued += 1
+    self.num_by_priority[task.priority] += 1
+  
+  #
+  def append(self, task):
+    with self.lock:
+      task.seq = self.next_seq
+      self.next_seq += 1
+      task.queue_time = timeit.default_timer()
+      task.key = task.queue_time + (task.priority.value - 1) * self.aging
+      self._insert(task)
+
+  # raise the priority of the queued tasks with action on relative_path to priority, e.g. of a prefetch when the file 
+  # is accessed; return if such a task is queued
+  def upgrade(self, relative_path, action, priority):
+    with self.lock:
+      found = False
+      for seq, task in self.at_path.get(relative_path, []):
+        if task.action != action:
+          continue
+        found = True
+        if task.priority.value > priority.value:
+          self.num_by_priority[task.priority] -= 1
+          self.num_by_priority[priority] += 1
+          task.priority = priority
+          task.key = task.queue_time + (priority.value - 1) * self.aging
+          heapq.heappush(self.heap, (task.key, task.seq, task)) # the entry with the old key is removed lazily
+          task.in_heap = True
+      return found
+      
+  # queue a task again that was taken, but not processed, keeping its order
+  def requeue(self, task):
+    with self.lock:
+      self._insert(task)
+  
+  # return the queued task that was queued first, of relative_path, its parent folders and the paths inside it
+  def _first_related(self, relative_path):
+    first = self.at_path.get(relative_path, [None])[0]
+    parent = os.path.dirname(relative_path)
+    while parent:
+      if parent in self.at_path and (first is None or self.at_path[parent][0] < first):
+        first = self.at_path[parent][0]
+      parent = os.path.dirname(parent)
+    below = self.below.get(relative_path, [])
+    while below and not below[0][1].queued: # remove tasks that were already taken
+      heapq.heappop(below)
+    if below and (first is None or below[0] < first):
+      first = below[0]
+    return first[1]
+  
+  # return the next task without taking it; raises IndexError if the queue is empty
+  def _next(self):
+    while self.heap and (not self.heap[0][2].queued or self.heap[0][0] != self.heap[0][2].key): # taken or old key
+      key, seq, task = heapq.heappop(self.heap)
+      if key == task.key:
+        task.in_heap = False
+    task = self.heap[0][2] # raises IndexError
+    # if a related task was queued before, take that; its related tasks were queued even before, so this terminates
+    first = self._first_related(task.relative_path)
+    while first is not task:
+      task = first
+      first = self._first_related(task.relative_path)
+    return task
+  
+  # return the task that popleft() would take, without taking it; raises IndexError if the queue is empty
+  def peek(self):
+    with self.lock:
+      return self._next()
+  
+  # take the next task; raises IndexError if the queue is empty
+  def popleft(self):
+    with self.lock:
+      task = self._next()
+      task.queued = False
+      self.at_path[task.relative_path].pop(0)
+      if not self.at_path[task.relative_path]:
+        del self.at_path[task.relative_path]
+      parent = os.path.dirname(task.relative_path)
+      while parent:
+        self.num_below[parent] -= 1
+        if self.num_below[parent] == 0:
+          del self.num_below[parent]
+          del self.below[parent]
+        parent = os.path.dirname(parent)
+      self.num_queued -= 1
+      self.num_by_priority[task.priority] -= 1
+      
+      task.wait_time = timeit.default_timer() - task.queue_time
+      stats = self.wait_stats[task.priority]
+      stats[0] += 1
+      stats[1] += task.wait_time
+      stats[2] = max(stats[2], task.wait_time)
+      return task
     
-# stores the metadata for one file; contains no path
+# stores the metadata for one file; contains no path; slotted, b/c a scan creates one per path
 class syncfiledata:
+  __slots__ = ('is_dir', 'is_file', 'is_link', 'atime', 'mtime', 'size', 'device', 'inode', 'mode', 'link_target')
+  
   #
-  def __init__(self, path):
+  def __init__(self, path, statinfo = None, link_target = None):
     logger.trace("syncfiledata::__init__()")
-    statinfo = os.lstat(path)
-    # TODO add content hash
+    if statinfo is None:
+      statinfo = os.lstat(path)
+    # content hashes are kept in a hashcache, with device, inode, size and mtime as key
     self.is_dir = stat.S_ISDIR(statinfo.st_mode)
     self.is_file = stat.S_ISREG(statinfo.st_mode)
     self.is_link = stat.S_ISLNK(statinfo.st_mode)
     self.atime = statinfo.st_atime
     self.mtime = statinfo.st_mtime
     self.size = statinfo.st_size
+    self.device = statinfo.st_dev
+    self.inode = statinfo.st_ino
+    self.mode = statinfo.st_mode # only used to copy the permissions, not compared
+    self.link_target = link_target # only set if known without an extra readlink(), e.g. from relative_scan()
     
-  # return if two syncfiledatas are equal without looking at the atime; don't look at mtime or size for dirs and links
-  def equal_without_atime(self, other):
+  # create a syncfiledata from stored values without accessing the filesystem; device, inode and mode are None if they 
+  # are unknown
+  @classmethod
+  def from_values(cls, is_dir, is_file, is_link, atime, mtime, size, device = None, inode = None, mode = None):
+    data = cls.__new__(cls)
+    data.is_dir = bool(is_dir)
+    data.is_file = bool(is_file)
+    data.is_link = bool(is_link)
+    data.atime = atime
+    data.mtime = mtime
+    data.size = size
+    data.device = device
+    data.inode = inode
+    data.mode = mode
+    data.link_target = None
+    return data
+    
+  # return values in the order expected by from_values()
+  def values(self):
+    return (self.is_dir, self.is_file, self.is_link, self.atime, self.mtime, self.size, self.device, self.inode, 
+            self.mode)
+    
+  # return if two syncfiledatas are equal without looking at the atime; don't look at mtime or size for dirs and links; 
+  # if given, equal_content() is called for files with equal size but different mtime, and if it returns True, the 
+  # mtime is considered equal (for filesystems with unreliable mtimes)
+  def equal_without_atime(self, other, equal_content = None):
     logger.trace("syncfiledata::equal_without_atime() self={%s}", self)
     logger.trace("syncfiledata::equal_without_atime() other={%s}", other)
     
@@ -157,6 +1538,8 @@ class syncfiledata:
     # comparing mtime for dirs
     equal_mtime = math.floor(self.mtime) == math.floor(other.mtime) or self.is_dir or self.is_link
     equal_size = self.size == other.size or self.is_dir or self.is_link
+    if not equal_mtime and equal_size and self.is_file and other.is_file and equal_content is not None:
+      equal_mtime = equal_content()
     all_equal = equal_is_dir and equal_is_file and equal_is_link and equal_mtime and equal_size
     
     logger.trace("syncfiledata::equal_without_atime() equal=%s (is_dir=%s, is_file=%s, is_link=%s, mtime=%s, size=%s)", 
@@ -173,19 +1556,297 @@ class syncfiledata:
       
 # stores the metadata for a pair of synced files; contains no path
 class syncfilepair:
+  __slots__ = ('syncfiledata_remote', 'syncfiledata_local')
+  
   #
   def __init__(self, syncfiledata_remote, syncfiledata_local):
     logger.trace("syncfilepair::__init__()")
     self.syncfiledata_remote = syncfiledata_remote
     self.syncfiledata_local = syncfiledata_local
 
-#
-class backupfiledata:
+# the values of a syncfilepair that are tracked (see syncfiledata.values()), packed into 89 bytes: the flags is_dir, 
+# is_file and is_link of remote (bits 0-2) and of local (bits 3-5), followed by the other values of remote and of local 
+# (see syncrecord_values)
+syncrecord = struct.Struct('=B2dq2QI2dq2QI')
+# atime, mtime, size, device, inode and mode of one side in a syncrecord, at offset 1 for remote and 45 for local; 
+# device, inode and mode are 0 if unknown, b/c none of them is 0 for an existing file
+syncrecord_values = struct.Struct('=2dq2QI')
+
+# pack the values of remote and local (see syncfiledata.values()) into a syncrecord
+def pack_syncrecord(remote_values, local_values):
+  flags = (bool(remote_values[0]) | bool(remote_values[1]) << 1 | bool(remote_values[2]) << 2 
+           | bool(local_values[0]) << 3 | bool(local_values[1]) << 4 | bool(local_values[2]) << 5)
+  return syncrecord.pack(flags, *[value or 0 for value in remote_values[3:] + local_values[3:]])
+
+# unpack the values of one side from a syncrecord, in the order of syncfiledata.values(); local is False for remote
+def unpack_syncrecord_side(record, local):
+  flags = record[0] >> 3 if local else record[0]
+  atime, mtime, size, device, inode, mode = syncrecord_values.unpack_from(record, 45 if local else 1)
+  return (flags & 1, flags >> 1 & 1, flags >> 2 & 1, atime, mtime, size, device or None, inode or None, mode or None)
+
+# unpack a syncrecord into the values of remote and local, in the order of syncfiledata.values()
+def unpack_syncrecord(record):
+  return unpack_syncrecord_side(record, False), unpack_syncrecord_side(record, True)
+
+# the columns of the values of remote and local in the database of a syncindex, in the order of syncfiledata.values()
+syncindex_columns = ', '.join(side + '_' + value for side in ['remote', 'local'] for value in 
+                              ['is_dir', 'is_file', 'is_link', 'atime', 'mtime', 'size', 'device', 'inode', 'mode'])
+
+# dictionary of path -> syncfilepair that is persisted in an sqlite database; all entries are kept in memory, changed 
+# entries are written through to the database and made durable with commit(); to track millions of paths, each entry 
+# is kept as a syncrecord (about a third of the memory of a syncfilepair with two syncfiledata), and a new syncfilepair 
+# is created on each access: it is read-only, b/c changing it does not change the entry; to change an entry, assign a 
+# new syncfilepair
+class syncindex:
+  #
+  def __init__(self, path):
+    logger.trace("syncindex::__init__() path='%s'", path)
+    self.path = path
+    self.entries = {} # relative path -> syncrecord
+    self.connection = None
+    self.lock = threading.Lock() # serializes writes from several transfer workers
+    
+  # open (or create) the database and load all entries
+  def open(self):
+    logger.debug("syncindex::open() path='%s'", self.path)
+    make_sure_path_exists(os.path.dirname(self.path))
+    self.connection = sqlite3.connect(self.path, check_same_thread = False)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, "
+                            "remote_is_dir INTEGER, remote_is_file INTEGER, remote_is_link INTEGER, "
+                            "remote_atime REAL, remote_mtime REAL, remote_size INTEGER, "
+                            "local_is_dir INTEGER, local_is_file INTEGER, local_is_link INTEGER, "
+                            "local_atime REAL, local_mtime REAL, local_size INTEGER, "
+                            "remote_device INTEGER, remote_inode INTEGER, remote_mode INTEGER, "
+                            "local_device INTEGER, local_inode INTEGER, local_mode INTEGER)")
+    if 'remote_device' not in [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]: # older database
+      for column in ['remote_device', 'remote_inode', 'remote_mode', 'local_device', 'local_inode', 'local_mode']:
+        self.connection.execute("ALTER TABLE files ADD COLUMN %s INTEGER" % column)
+    for row in self.connection.execute("SELECT path, %s FROM files" % syncindex_columns):
+      self.entries[row[0]] = pack_syncrecord(row[1:10], row[10:19])
+    logger.info("syncindex::open() loaded %d tracked paths from '%s'", len(self.entries), self.path)
+    
+  # write pending changes to disk
+  def commit(self):
+    with self.lock:
+      if self.connection is not None:
+        self.connection.commit()
+      
+  #
+  def close(self):
+    logger.debug("syncindex::close() path='%s'", self.path)
+    with self.lock:
+      if self.connection is not None:
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+      
+  #
+  def __contains__(self, relative_path):
+    return relative_path in self.entries
+  
+  # return a new (read-only, see above) syncfilepair of relative_path
+  def __getitem__(self, relative_path):
+    remote_values, local_values = unpack_syncrecord(self.entries[relative_path])
+    return syncfilepair(syncfiledata.from_values(*remote_values), syncfiledata.from_values(*local_values))
+  
+  # return a new (read-only) syncfiledata of remote of relative_path, without creating the syncfilepair and the 
+  # syncfiledata of local, e.g. for scans that compare millions of paths
+  def remote_data(self, relative_path):
+    return syncfiledata.from_values(*unpack_syncrecord_side(self.entries[relative_path], False))
+  
+  #
+  def __setitem__(self, relative_path, pair):
+    remote_values, local_values = pair.syncfiledata_remote.values(), pair.syncfiledata_local.values()
+    with self.lock:
+      self.entries[relative_path] = pack_syncrecord(remote_values, local_values)
+      if self.connection is not None:
+        self.connection.execute("INSERT OR REPLACE INTO files (path, %s) VALUES (?%s)" 
+                                % (syncindex_columns, ', ?' * 18), (relative_path,) + remote_values + local_values)
+  
+  #
+  def __delitem__(self, relative_path):
+    with self.lock:
+      del self.entries[relative_path]
+      if self.connection is not None:
+        self.connection.execute("DELETE FROM files WHERE path = ?", (relative_path,))
+      
+  #
+  def __len__(self):
+    return len(self.entries)
+  
+  #
+  def __iter__(self):
+    return iter(self.entries)
+  
+  #
+  def keys(self):
+    return self.entries.keys()
+  
+  # list of all relative paths; safe to call while other threads change entries
+  def paths(self):
+    with self.lock:
+      return list(self.entries)
+
+# persistent cache of content hashes in an sqlite database, with (device, inode, size, mtime) of the file as key, so that 
+# a file only needs to be read again if it changed
+class hashcache:
   #
   def __init__(self, path):
+    logger.trace("hashcache::__init__() path='%s'", path)
+    self.path = path
+    self.connection = None
+    self.lock = threading.Lock() # serializes access from several transfer workers
+    
+  # open (or create) the database
+  def open(self):
+    logger.debug("hashcache::open() path='%s'", self.path)
+    make_sure_path_exists(os.path.dirname(self.path))
+    self.connection = sqlite3.connect(self.path, check_same_thread = False)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode INTEGER, size INTEGER, "
+                            "mtime REAL, hash TEXT, PRIMARY KEY (device, inode, size, mtime))")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS signatures (hash TEXT PRIMARY KEY, block_size INTEGER, "
+                            "size INTEGER, weak BLOB, strong BLOB, used REAL)")
+    if 'used' not in [row[1] for row in self.connection.execute("PRAGMA table_info(signatures)")]: # older database
+      self.connection.execute("ALTER TABLE signatures ADD COLUMN used REAL")
+      self.connection.execute("UPDATE signatures SET used = ?", (time.time(),))
+
+  # remove the signatures that were not stored or used for signature_max_age; a signature is shared by all files with 
+  # the same contents (e.g. a file and its backup), so it is not removed when one of them is replaced; called on close
+  def compact_signatures(self):
+    with self.lock:
+      num_removed = self.connection.execute("DELETE FROM signatures WHERE used < ?", 
+                                            (time.time() - signature_max_age,)).rowcount
+    logger.debug("hashcache::compact_signatures() removed %d signatures", num_removed)
+    
+  # write pending changes to disk
+  def commit(self):
+    with self.lock:
+      if self.connection is not None:
+        self.connection.commit()
+      
+  #
+  def close(self):
+    logger.debug("hashcache::close() path='%s'", self.path)
+    if self.connection is not None:
+      self.compact_signatures()
+    with self.lock:
+      if self.connection is not None:
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+      
+  # return the cached hash for the file with the given syncfiledata, or None
+  def get(self, data):
+    with self.lock:
+      if self.connection is None or data.inode is None:
+        return None
+      row = self.connection.execute("SELECT hash FROM hashes WHERE device = ? AND inode = ? AND size = ? AND mtime = ?", 
+                                    (data.device, data.inode, data.size, data.mtime)).fetchone()
+    return row[0] if row is not None else None
+  
+  # store the hash for the file with the given syncfiledata
+  def put(self, data, content_hash):
+    with self.lock:
+      if self.connection is not None and data.inode is not None:
+        self.connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", 
+                                (data.device, data.inode, data.size, data.mtime, content_hash))
+
+  # return the cached blocksignature of the contents with content_hash for delta transfers, or None
+  def get_signature(self, content_hash):
+    with self.lock:
+      if self.connection is None or content_hash is None:
+        return None
+      row = self.connection.execute("SELECT block_size, size, weak, strong FROM signatures WHERE hash = ?", 
+                                    (content_hash,)).fetchone()
+      if row is not None:
+        self.connection.execute("UPDATE signatures SET used = ? WHERE hash = ?", (time.time(), content_hash))
+    return blocksignature.from_values(*row) if row is not None else None
+
+  # store the blocksignature of the contents with content_hash
+  def put_signature(self, content_hash, signature):
+    values = signature.values()
+    with self.lock:
+      if self.connection is not None:
+        self.connection.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?, ?)", 
+                                (content_hash,) + values + (time.time(),))
+  
+  # return the content hash of the file at path, reading it only if it is not cached; data is the syncfiledata of the 
+  # file, if it is already known and has an inode; the file is read with backend (default: posix_backend)
+  def hash_file(self, path, data = None, backend = None):
+    logger.trace("hashcache::hash_file() path='%s'", path)
+    backend = backend or posix
+    if data is None or data.inode is None:
+      data = backend.stat(path)
+    content_hash = self.get(data)
+    if content_hash is None:
+      logger.debug("hashcache::hash_file() reading '%s'", path)
+      hash_object = new_content_hash()
+      with backend.open_read(path) as f:
+        while True:
+          chunk = f.read(copy_chunk_size)
+          if not chunk:
+            break
+          hash_object.update(chunk)
+      content_hash = hash_object.hexdigest()
+      self.put(data, content_hash)
+    return content_hash
+
+# stores one backed up version of a file; path is the backup file, which is shared by all versions with the same 
+# content_hash (content-addressed), or unique if content_hash is not known
+class backupfiledata:
+  content_hash = None # default for data saved before content hashes were introduced
+  
+  #
+  def __init__(self, path, content_hash = None):
     logger.trace("backupfiledata::__init__()")
     self.path = path
     self.time = datetime.datetime.now()
+    self.content_hash = content_hash
+
+# detach from the terminal into the background (double fork) and log to log_path instead of the console
+def daemonize(log_path):
+  logger.trace("daemonize() log_path='%s'", log_path)
+  if os.fork() > 0:
+    os._exit(0)
+  os.setsid() # new session without controlling terminal
+  if os.fork() > 0:
+    os._exit(0) # not a session leader, so it can never get a controlling terminal again
+  os.chdir('/')
+  make_sure_path_exists(os.path.dirname(log_path))
+  file_handler = logging.FileHandler(log_path)
+  file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+  logger.addHandler(file_handler)
+  logger.removeHandler(console_handler)
+  with open(os.devnull, 'r+') as devnull:
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+      os.dup2(devnull.fileno(), stream.fileno())
+  logger.info("daemonize() running in the background with pid %d", os.getpid())
+
+# handles the requests of one connection to the control socket: one json object per line, answered by one json object 
+# per line; see lazysync.handle_control_request()
+class control_handler(socketserver.StreamRequestHandler):
+  #
+  def handle(self):
+    for line in self.rfile:
+      try:
+        response = self.server.sync.handle_control_request(json.loads(line.decode('utf-8')))
+      except Exception as e: # report any error to the client instead of closing the connection
+        logger.info("control_handler::handle() request failed: %s", e)
+        response = {'error': str(e)}
+      self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+      self.wfile.flush()
+
+# serves the control socket, each connection in its own thread
+class control_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True # do not wait for open connections on exit
+  
+  #
+  def __init__(self, path, sync):
+    logger.trace("control_server::__init__() path='%s'", path)
+    if os.path.exists(path): # left over from a previous run that was killed
+      os.remove(path)
+    socketserver.UnixStreamServer.__init__(self, path, control_handler)
+    self.sync = sync
 
 # lazily syncs two folders with the given config parameters
 class lazysync(ofnotify.event_processor):
@@ -193,23 +1854,87 @@ class lazysync(ofnotify.event_processor):
   def __init__(self, config):
     self.config = config
     logger.info("lazysync::__init__() Using %slazy mode.", '' if config['lazy'] else 'non-')
-    self.queue = deque() # queue of synctasks
-    self.files = {} # dictionary of path -> syncfilepair to keep track of atimes and deleted files
+    if(config['delta'] and config['unreliable_mtime']):
+      logger.warning("lazysync::__init__() no delta transfers with unreliable mtimes, b/c the signature of the old "
+                     "version of a file is found by its size and mtime")
+    elif(config['delta'] and not config['remote_server_side_copy']):
+      logger.warning("lazysync::__init__() no delta transfers without server-side copies, b/c the mount would read "
+                     "the blocks of the old version and write them back, which transfers more than a full copy")
+    self.queue = syncqueue(self.config['priority_aging']) # queue of synctasks
+    # dictionary of path -> syncfilepair to keep track of atimes and deleted files; persisted between runs
+    self.files = syncindex(os.path.join(self.config['local'], relative_backup_dir, index_file))
+    self.hashes = hashcache(os.path.join(self.config['local'], relative_backup_dir, hash_file))
     self.remote_backup_files = defaultdict(list) # dict original_path -> [backupfiledata] to keep deleted files
     self.local_backup_files = defaultdict(list) # dict original_path -> [backupfiledata] to keep deleted files
-    self.sleep_time = 0
-    self.syncactions = enum.Enum('syncactions', 'cp_local cp_remote ln_remote rm_local rm_remote')
+    self.backup_lock = threading.RLock() # protects both backup dicts and their data files from several transfer workers
+    self.backup_file_refs = Counter() # backup file path -> number of backupfiledata using it
+    self.journals = {} # prefix -> open journal file
+    self.journal_records = Counter() # prefix -> number of records in the journal since the data was saved
+    self.reconcile_thread = None # only used to reconcile backup files in the background
+    # rate limits shared by all copies in each direction; None if unlimited
+    self.upload_bucket = tokenbucket(self.config['upload_limit']) if self.config['upload_limit'] > 0 else None
+    self.download_bucket = tokenbucket(self.config['download_limit']) if self.config['download_limit'] > 0 else None
+    self.interactive_paths = set() # relative paths whose download was triggered by an access, not limited by rate
+    self.move_sources = {} # relative path -> relative path it was moved from, for the queued mv tasks
+    self.moving_paths = set() # relative paths moved from, of the queued and running mv tasks; see task_pending()
+    self.prefetcher = None # only used in lazy mode if enabled
+    if self.config['prefetch_count'] > 0:
+      self.prefetcher = prefetcher(self.config['prefetch_count'], self.config['prefetch_bytes'])
+    self.cache_access = {} # relative path -> time of the last access of a local file; only used with cache_size
+    self.cache_checked = True # if the cache size was checked since the last scan
+    # the interval between scans adapts to how often changes are found; ofnotify events wake up the loop early
+    self.scan_interval = ofnotify.adaptive_interval(self.config['min_interval'], self.config['max_interval'])
+    self.next_scan_time = 0
+    self.wakeup = threading.Event()
+    self.ignore = ignore_matcher(self.config['ignore'])
+    # all operations on the files of remote and local go through their backend
+    self.remote_backend = posix_backend(self.config['remote_server_side_copy'])
+    if self.config['remote_latency'] > 0 or self.config['remote_bandwidth'] > 0:
+      self.remote_backend = shaped_backend(self.config['remote_latency'], self.config['remote_bandwidth'], 
+                                           self.config['remote_server_side_copy'])
+    self.local_backend = posix
+    # only used in incremental mode
+    self.remote_walker = incremental_walker(self.config['remote'], self.ignore, self.remote_backend)
+    self.scan_count = 0
+    # with the asyncio engine, one more worker is reserved for downloads of accessed files, see transfer_forever()
+    num_transfer_threads = self.config['transfer_workers'] + (1 if self.config['engine'] == 'asyncio' else 0)
+    self.transfer_executor = concurrent.futures.ThreadPoolExecutor(max_workers = num_transfer_threads)
+    self.transfers = {} # relative path -> progress of a running copy, for the status of the control socket
+    self.transfers_lock = threading.Lock()
+    self.running_paths = Counter() # relative path -> number of tasks on it taken from the queue and not finished
+    self.task_finish_times = {} # relative path -> time the last task on it finished; pruned by compare_changes()
+    self.running_lock = threading.Lock() # protects running_paths, task_finish_times and taking tasks from the queue
+    self.rescan_requests = deque() # relative paths to rescan, requested via the control socket
+    self.control_server = None # only created in loop() or run_async()
+    # only used by the asyncio engine; the events are set from other threads via call_soon_threadsafe()
+    self.event_loop = None
+    self.wakeup_event = None # like wakeup, wakes up scan_forever()
+    self.queued_event = None # set when a task is queued, wakes up transfer_forever()
+    self.metrics = metrics(metric_descriptions)
+    self.syncactions = enum.Enum('syncactions', 'cp_local cp_remote ln_remote rm_local rm_remote mv_local mv_remote')
     self.syncaction_functions = {self.syncactions.cp_local: self.action_cp_local,
                                  self.syncactions.cp_remote: self.action_cp_remote,
                                  self.syncactions.ln_remote: self.action_ln_remote,
                                  self.syncactions.rm_local: self.action_rm_local,
-                                 self.syncactions.rm_remote: self.action_rm_remote}
+                                 self.syncactions.rm_remote: self.action_rm_remote,
+                                 self.syncactions.mv_local: self.action_mv_local,
+                                 self.syncactions.mv_remote: self.action_mv_remote}
 
     self.load_data()
+    self.files.open()
+    self.hashes.open()
     
-    self.notifier = ofnotify.threaded_notifier(self, [self.config['remote']])
-    if self.config['lazy']:
-      self.notifier.start()
+    # local is only watched to count accesses of prefetched files and to find the least recently used files
+    watch_local = self.prefetcher is not None or self.config['cache_size'] > 0
+    watch_paths = [self.config['remote']] + ([self.config['local'] + os.sep] if watch_local else [])
+    if self.config['engine'] == 'asyncio': # started by run_async()
+      self.notifier = ofnotify.asyncio_notifier(self, watch_paths, self.config['min_notify_interval'], 
+                                                self.config['max_notify_interval'])
+    else:
+      self.notifier = ofnotify.threaded_notifier(self, watch_paths, self.config['min_notify_interval'], 
+                                                 self.config['max_notify_interval'])
+      if self.config['lazy']:
+        self.notifier.start()
       
   #
   def wait_for_paths_available(self, paths):
@@ -234,7 +1959,7 @@ class lazysync(ofnotify.event_processor):
     self.wait_for_paths_available([self.config['remote'], self.config['local']])
     self.save_data()
     
-  #
+  # return the backup files of prefix from its data and journal, or None if there is neither
   def load_path_data(self, prefix):
     logger.debug("lazysync::load_path_data() prefix='%s'", prefix)
     backup_dir = os.path.join(prefix, relative_backup_dir)
@@ -242,50 +1967,136 @@ class lazysync(ofnotify.event_processor):
     self.wait_for_paths_available([backup_dir]) # make sure backup path is available
     if sigint: # exit here if ctrl-c was pressed while we were waiting and not try to read the files below
       sys.exit(0)
-    if not os.path.isfile(backup_data_file):
-      return defaultdict(list)
-
-    logger.debug("lazysync::load_path_data() reading config from '%s'", backup_data_file)
-    expected_backup_files = jsonpickle.decode(read_file_contents(backup_data_file))[0]
-    existing_backup_files = list_files(backup_dir)
-    logger.trace("lazysync::load_path_data() expected_backup_files=%s", expected_backup_files)
-    logger.trace("lazysync::load_path_data() existing_backup_files=%s", existing_backup_files)
-    # make sure expected_backup_files is consistent with existing_backup_files: figure out which expected_backup_files 
-    # are existing (remove them from existing_backup_files) and which are not (add them to backup_files_to_be_deleted)
-    backup_files_to_be_deleted = defaultdict(list)
-    for original_path in expected_backup_files:
-      for backup_file_data in expected_backup_files[original_path]:
-        if os.path.isfile(backup_file_data.path): # check that backup file exists
-          existing_backup_files.remove(backup_file_data.path) # remove it from existing_backup_files
-          logger.info("lazysync::load_path_data() found backup file '%s' -> '%s' (%s)", original_path, 
-                      backup_file_data.path, backup_file_data.time)
-        else: # file does not exist
-          backup_files_to_be_deleted[original_path].append(backup_file_data) # store to remove after iteration
-    # remove expected_backup_files that have missing files      
-    for original_path in backup_files_to_be_deleted:
-      for backup_file_data in backup_files_to_be_deleted[original_path]:
-        expected_backup_files[original_path].remove(backup_file_data)
-        logger.info("lazysync::load_path_data() removing data for '%s' -> '%s' (%s), backup file is missing", 
-                    original_path, backup_file_data.path, backup_file_data.time)
-    # remove existing_backup_files that have no data in backup_files
-    for file in existing_backup_files:
-      if not file == backup_data_file: # do not delete the data file
-        logger.info("lazysync::load_path_data() removing backup file '%s', backup data is missing", file)
-        os.remove(file)
-      
+    if not os.path.isfile(backup_data_file) and not os.path.isfile(os.path.join(backup_dir, journal_file)):
+      return None
+
+    expected_backup_files = defaultdict(list)
+    if os.path.isfile(backup_data_file):
+      logger.debug("lazysync::load_path_data() reading config from '%s'", backup_data_file)
+      expected_backup_files.update(jsonpickle.decode(read_file_contents(backup_data_file))[0])
+    self.replay_journal(prefix, expected_backup_files)
     return expected_backup_files
     
+  # make backup_files consistent with the backup dir of prefix, based on a single listing of it: remove entries whose 
+  # backup file is missing, and remove backup files without entries
+  def reconcile_backup_files(self, prefix, backup_files):
+    logger.debug("lazysync::reconcile_backup_files() prefix='%s'", prefix)
+    backup_dir = os.path.join(prefix, relative_backup_dir)
+    with self.backup_lock: # no backup files are added or removed meanwhile
+      existing_backup_files = set(list_files(backup_dir))
+      used_backup_files = set()
+      num_versions = 0
+      for original_path in backup_files:
+        versions = []
+        for backup_file_data in backup_files[original_path]:
+          if backup_file_data.path in existing_backup_files:
+            logger.debug("lazysync::reconcile_backup_files() found backup file '%s' -> '%s' (%s)", original_path, 
+                         backup_file_data.path, backup_file_data.time)
+            versions.append(backup_file_data)
+            used_backup_files.add(backup_file_data.path)
+          else:
+            logger.info("lazysync::reconcile_backup_files() removing data for '%s' -> '%s' (%s), backup file is missing", 
+                        original_path, backup_file_data.path, backup_file_data.time)
+            self.backup_file_refs[backup_file_data.path] -= 1
+            if self.backup_file_refs[backup_file_data.path] <= 0:
+              del self.backup_file_refs[backup_file_data.path]
+        backup_files[original_path] = versions
+        num_versions += len(versions)
+      for file in existing_backup_files - used_backup_files: # remove backup files that have no data in backup_files
+        if not os.path.basename(file).startswith(metadata_files): # do not delete the data, index, hash and journal files
+          logger.info("lazysync::reconcile_backup_files() removing backup file '%s', backup data is missing", file)
+          os.remove(file)
+      self.save_path_data(prefix, backup_files) # save after making sure backup files are consistent
+    logger.info("lazysync::reconcile_backup_files() %d versions of %d files in %d backup files in '%s'", num_versions, 
+                len(backup_files), len(used_backup_files), backup_dir)
+    
+  # reconcile the backup files of the given prefixes, and save the data of the others
+  def reconcile_data(self, prefixes):
+    logger.trace("lazysync::reconcile_data() prefixes=%s", prefixes)
+    for prefix, backup_files in [(self.config['remote'], self.remote_backup_files), 
+                                 (self.config['local'], self.local_backup_files)]:
+      if prefix in prefixes:
+        self.reconcile_backup_files(prefix, backup_files)
+      else:
+        self.save_path_data(prefix, backup_files)
+    
+  # apply the records of the journal of prefix to backup_files; records that were already applied (after a crash between 
+  # saving the data and truncating the journal) are skipped; an incomplete last record (after a crash while appending) 
+  # is ignored
+  def replay_journal(self, prefix, backup_files):
+    journal_path = os.path.join(prefix, relative_backup_dir, journal_file)
+    if not os.path.isfile(journal_path):
+      return
+    logger.debug("lazysync::replay_journal() reading journal '%s'", journal_path)
+    records = 0
+    for line in read_file_contents(journal_path).splitlines():
+      try:
+        operation, original_path, backup_file_data = jsonpickle.decode(line)
+      except Exception: # the type of the error depends on the backend used by jsonpickle
+        logger.warning("lazysync::replay_journal() ignoring incomplete record '%s'", line)
+        break
+      versions = backup_files[original_path]
+      applied = [b for b in versions if b.path == backup_file_data.path and b.time == backup_file_data.time]
+      if operation == 'add' and not applied:
+        versions.append(backup_file_data)
+      elif operation == 'remove':
+        for b in applied:
+          versions.remove(b)
+      records += 1
+    logger.info("lazysync::replay_journal() replayed %d records from '%s'", records, journal_path)
+    
+  # append a record of a change to the backup files of prefix (operation is 'add' or 'remove') to its journal; the data 
+  # is saved and the journal truncated every journal_compaction_interval records
+  def journal_backup_change(self, prefix, operation, original_path, backup_file_data):
+    logger.trace("lazysync::journal_backup_change() prefix='%s' operation=%s '%s' -> '%s'", prefix, operation, 
+                 original_path, backup_file_data.path)
+    with self.backup_lock:
+      if prefix not in self.journals:
+        self.journals[prefix] = open(os.path.join(prefix, relative_backup_dir, journal_file), 'a')
+      self.journals[prefix].write(jsonpickle.encode([operation, original_path, backup_file_data]) + '\n')
+      self.journals[prefix].flush()
+      self.journal_records[prefix] += 1
+      if self.journal_records[prefix] >= journal_compaction_interval:
+        backup_files = self.remote_backup_files if prefix == self.config['remote'] else self.local_backup_files
+        self.save_path_data(prefix, backup_files)
+        
+  #
+  def close_journals(self):
+    logger.trace("lazysync::close_journals()")
+    with self.backup_lock:
+      for prefix in self.journals:
+        self.journals[prefix].close()
+      self.journals = {}
+    
   #
   def load_data(self):
     logger.trace("lazysync::load_data()")
     local_backup_dir = os.path.join(self.config['local'], relative_backup_dir)
-    if not os.path.isdir(local_backup_dir): # assume the local backup dir is always available
+    # assume the local backup dir is always available; it can exist without data, e.g. with the log in daemon mode
+    if not any(os.path.isfile(os.path.join(local_backup_dir, name)) for name in (data_file, journal_file)):
       self.first_time_setup()
       return 
     
-    self.remote_backup_files = self.load_path_data(self.config['remote'])
-    self.local_backup_files = self.load_path_data(self.config['local'])
-    self.save_data() # save after making sure backup files are consistent
+    prefixes = [] # prefixes with backup data, only these are reconciled
+    for prefix in [self.config['remote'], self.config['local']]:
+      backup_files = self.load_path_data(prefix)
+      if backup_files is not None:
+        prefixes.append(prefix)
+      else:
+        backup_files = defaultdict(list)
+      if prefix == self.config['remote']:
+        self.remote_backup_files = backup_files
+      else:
+        self.local_backup_files = backup_files
+    for backup_files in [self.remote_backup_files, self.local_backup_files]:
+      for original_path in backup_files:
+        for backup_file_data in backup_files[original_path]:
+          self.backup_file_refs[backup_file_data.path] += 1
+    if self.config['background_reconcile']: # start syncing right away
+      self.reconcile_thread = threading.Thread(target = self.reconcile_data, args = (prefixes,))
+      self.reconcile_thread.start()
+    else:
+      self.reconcile_data(prefixes)
     
   #
   def save_path_data(self, prefix, backup_files_dict):
@@ -294,29 +2105,36 @@ class lazysync(ofnotify.event_processor):
     backup_data_file = os.path.join(backup_dir, data_file)
     make_sure_path_exists(backup_dir)
     logger.debug("lazysync::save_path_data() writing data to '%s' data=%s", backup_data_file, backup_files_dict)
-    write_file_contents(backup_data_file, jsonpickle.encode([backup_files_dict]))
+    with self.backup_lock:
+      write_file_contents(backup_data_file + '.tmp', jsonpickle.encode([backup_files_dict]))
+      os.rename(backup_data_file + '.tmp', backup_data_file) # replace atomically
+      # the journal is included in the data now; if this is interrupted, the journal is replayed again, which is safe
+      if prefix in self.journals:
+        self.journals.pop(prefix).close()
+      write_file_contents(os.path.join(backup_dir, journal_file), '')
+      self.journal_records[prefix] = 0
   
   #
   def save_data(self):
-    logger.trace("lazysync::save_data() self.remote_backup_files=%s self.local_backup_files=%s", 
-                 self.remote_backup_files, self.local_backup_files)
-    self.save_path_data(self.config['remote'], self.remote_backup_files)
-    self.save_path_data(self.config['local'], self.local_backup_files)
+    with self.backup_lock:
+      logger.trace("lazysync::save_data() self.remote_backup_files=%s self.local_backup_files=%s", 
+                   self.remote_backup_files, self.local_backup_files)
+      self.save_path_data(self.config['remote'], self.remote_backup_files)
+      self.save_path_data(self.config['local'], self.local_backup_files)
   
-  #
-  def filter_ignore(self, paths):
-    logger.trace("lazysync::filter_ignore()")
-    filtered = set()
-    ignored = set()
-    for p in paths:
-      for i in self.config['ignore']:
-        ignored.add(p) if p.startswith(i) else filtered.add(p)
-    
-    logger.debug("lazysync::filter_ignore() ignored=%s", ignored)
-    return filtered
-
   #    
   def process_ofnotify_event(self, event):
+    if(event.path.startswith(self.config['local'] + os.sep)): # only watched with prefetching or cache_size
+      relative_path = os.path.relpath(event.path, self.config['local'])
+      if(relative_path.startswith(relative_backup_dir)):
+        return
+      if(self.config['cache_size'] > 0):
+        self.cache_access[relative_path] = time.time()
+      if(event.type == ofnotify.event_types.open and self.prefetcher is not None 
+         and self.prefetcher.record_access(relative_path)):
+        logger.info("lazysync::process_event() '%s': prefetched file has been accessed, hit rate %.2f", relative_path, 
+                    self.prefetcher.hit_rate())
+      return
     relative_path = os.path.relpath(event.path, self.config['remote'])
     path_local = os.path.join(self.config['local'], relative_path)
     path_remote = event.path
@@ -325,88 +2143,407 @@ class lazysync(ofnotify.event_processor):
        and os.path.realpath(path_local) == path_remote):
       logger.info("lazysync::process_event() '%s': symlinked remote has been accessed, downloading; task: cp remote local", 
                   relative_path)
-      self.queue.append(synctask(relative_path, self.syncactions.cp_remote))
+      self.interactive_paths.add(relative_path)
+      if(self.prefetcher is not None and self.prefetcher.record_access(relative_path)):
+        logger.info("lazysync::process_event() '%s': prefetched file has been accessed, hit rate %.2f", relative_path, 
+                    self.prefetcher.hit_rate())
+      # a file accessed before its prefetch was processed is already queued, but with a lower priority
+      if(not self.queue.upgrade(relative_path, self.syncactions.cp_remote, task_priorities.interactive)):
+        self.queue_task(relative_path, self.syncactions.cp_remote)
+      if(self.prefetcher is not None):
+        self.queue_prefetch(relative_path)
+      self.scan_interval.reset() # files are in use, changes are likely
+      self.wake()
+  
+  # return the size of the remote file at relative_path if it is symlinked locally and not queued, otherwise None
+  def prefetch_size(self, relative_path):
+    if(relative_path not in self.files or relative_path in self.queue):
+      return None
+    remote_data = self.files.remote_data(relative_path)
+    path_local = os.path.join(self.config['local'], relative_path)
+    if(not remote_data.is_file or not os.path.islink(path_local) 
+       or os.readlink(path_local) != os.path.join(self.config['remote'], relative_path)):
+      return None
+    return remote_data.size
+  
+  # queue downloads of the files that are likely accessed after relative_path; they are limited by --download-limit and 
+  # queued after the accessed file
+  def queue_prefetch(self, relative_path):
+    logger.trace("lazysync::queue_prefetch() '%s'", relative_path)
+    folder = os.path.dirname(relative_path)
+    try:
+      siblings = [os.path.join(folder, entry.name) for entry in os.scandir(os.path.join(self.config['local'], folder))]
+    except OSError:
+      siblings = []
+    for path in self.prefetcher.select(relative_path, siblings, self.prefetch_size):
+      logger.info("lazysync::queue_prefetch() '%s': likely accessed next; task: cp remote local", path)
+      self.queue_task(path, self.syncactions.cp_remote, priority = task_priorities.bulk)
+    logger.debug("lazysync::queue_prefetch() hit rate %.2f of %d prefetched files", self.prefetcher.hit_rate(), 
+                 self.prefetcher.num_prefetched)
 
+  # queue a synctask; unless given, the priority is: interactive for downloads of accessed files, upload for changes to 
+  # local, small for copies of files up to small_file_size and for all other actions, bulk for all other copies; data is 
+  # the syncfiledata of the path to copy from, if known
+  def queue_task(self, relative_path, action, data = None, priority = None):
+    if(priority is None):
+      copies = action in (self.syncactions.cp_remote, self.syncactions.cp_local) or \
+               (action == self.syncactions.ln_remote and not self.config['lazy'])
+      if(action == self.syncactions.cp_remote and relative_path in self.interactive_paths):
+        priority = task_priorities.interactive
+      elif(action in (self.syncactions.cp_local, self.syncactions.rm_remote, self.syncactions.mv_remote)):
+        priority = task_priorities.upload
+      elif(not copies or (data is not None and (not data.is_file or data.size <= small_file_size))):
+        priority = task_priorities.small
+      else:
+        priority = task_priorities.bulk
+    self.queue.append(synctask(relative_path, action, priority))
+    if(self.event_loop is not None):
+      self.event_loop.call_soon_threadsafe(self.queued_event.set)
+  
   #
-  def queue_change_for_remote(self, relative_path):
+  def queue_change_for_remote(self, relative_path, data = None):
     logger.trace("lazysync::queue_change_for_remote() '%s'", relative_path)
     if(relative_path in self.files):
       logger.info("lazysync::find_changes() '%s': locally removed path; task: rm remote", relative_path)
-      self.queue.append(synctask(relative_path, self.syncactions.rm_remote))
+      self.queue_task(relative_path, self.syncactions.rm_remote)
     else:
       logger.info("lazysync::find_changes() '%s': new remote path; task: ln remote local", relative_path)
-      self.queue.append(synctask(relative_path, self.syncactions.ln_remote))
+      self.queue_task(relative_path, self.syncactions.ln_remote, data)
   
   #
   def queue_change_for_local(self, relative_path):
     logger.trace("lazysync::queue_change_for_local()")
     if(relative_path in self.files):
       logger.info("lazysync::find_changes() '%s': remotely removed path; task: rm local", relative_path)
-      self.queue.append(synctask(relative_path, self.syncactions.rm_local))
+      self.queue_task(relative_path, self.syncactions.rm_local)
     else:
       logger.info("lazysync::find_changes() '%s': new local path; task: cp local remote", relative_path)
-      self.queue.append(synctask(relative_path, self.syncactions.cp_local))
+      self.queue_task(relative_path, self.syncactions.cp_local)
   
-  # 
-  def find_changes(self):
-    logger.trace("lazysync::find_changes()")
-    remote_folder_set, remote_file_set = relative_walk(self.config['remote']) 
-    local_folder_set, local_file_set = relative_walk(self.config['local'])
-    
-    # create sets of folders and files in both sets or in one set only; filter out ignored paths
-    folders_both = self.filter_ignore(remote_folder_set & local_folder_set) # check they are equal
-    folders_remote_only = self.filter_ignore(remote_folder_set - local_folder_set) # need to be copied
-    folders_local_only = self.filter_ignore(local_folder_set - remote_folder_set) # need to be copied
-    files_both = self.filter_ignore(remote_file_set & local_file_set) # check they are equal
-    files_remote_only = self.filter_ignore(remote_file_set - local_file_set) # need to be copied/symlinked
-    files_local_only = self.filter_ignore(local_file_set - remote_file_set) # need to be copied
+  # walk remote; return the sets of relative folders and files, the set of relative folders that were listed (None if 
+  # all were), and a dict relative path -> syncfiledata of the paths that were lstat'ed during the walk
+  def walk_remote(self, subtree = None):
+    logger.trace("lazysync::walk_remote() subtree=%s", subtree)
+    # in incremental mode, only remote folders with changed mtime are listed, and only remote paths in those are lstat'ed;
+    # a full scan is done regularly to find files that were changed in place (which does not change the folder mtime)
+    listed_remote_dirs = None
+    remote_data = {} # relative path -> syncfiledata of remote paths that were already lstat'ed during the walk
+    with self.metrics.time('lazysync_scan_phase_seconds', phase = 'walk_remote'):
+      if self.config['incremental'] and subtree is None:
+        full_scan = self.scan_count % self.config['full_scan_interval'] == 0
+        remote_folder_set, remote_file_set, listed_remote_dirs = self.remote_walker.walk(full_scan, 
+                                                                                        self.config['scan_workers'])
+      else:
+        # in lazy mode, most remote files are symlinked and their remote path does not need to be lstat'ed at all
+        remote_folders, remote_files = relative_scan(self.config['remote'], not self.config['lazy'], 
+                                                     self.config['scan_workers'], self.ignore, subtree or os.curdir, 
+                                                     self.remote_backend)
+        remote_folder_set, remote_file_set = set(remote_folders), set(remote_files)
+        if not self.config['lazy']:
+          remote_data.update(remote_folders)
+          remote_data.update(remote_files)
+    return remote_folder_set, remote_file_set, listed_remote_dirs, remote_data
+  
+  # walk local; return the sets of relative folders and files, and a dict relative path -> syncfiledata of all paths
+  def walk_local(self, subtree = None):
+    logger.trace("lazysync::walk_local() subtree=%s", subtree)
+    # local paths are always lstat'ed
+    with self.metrics.time('lazysync_scan_phase_seconds', phase = 'walk_local'):
+      local_data, local_files = relative_scan(self.config['local'], ignore = self.ignore, 
+                                              subtree = subtree or os.curdir, backend = self.local_backend)
+    local_folder_set, local_file_set = set(local_data), set(local_files)
+    local_data.update(local_files)
+    return local_folder_set, local_file_set, local_data
+  
+  # return if a task on relative_path is queued (or a mv task from it), or if a task on it or on one of its parent folders 
+  # was taken from the queue (running, or waiting for a worker) or finished after since; such paths are not compared, 
+  # b/c the walks may have seen them before or during the change
+  def task_pending(self, relative_path, since):
+    if(relative_path in self.moving_paths):
+      return True
+    with self.running_lock: # a task leaves the queue and is counted in running_paths at once, see take_task()
+      if(relative_path in self.queue):
+        return True
+      if(not self.running_paths and not self.task_finish_times): # always with the loop engine, scanning between tasks
+        return False
+      path = relative_path
+      while(path):
+        if(path in self.running_paths or self.task_finish_times.get(path, since) > since):
+          return True
+        path = os.path.dirname(path)
+    return False
+  
+  # walk remote and local, compare them with the tracked paths, and queue tasks for the differences; if subtree is 
+  # given, only paths inside it are compared; paths outside are neither in remote nor in local, so no tasks are queued 
+  # for them
+  def find_changes(self, subtree = None):
+    logger.trace("lazysync::find_changes() subtree=%s", subtree)
+    start_time = timeit.default_timer()
+    self.compare_changes(subtree, self.walk_remote(subtree), self.walk_local(subtree), start_time)
+  
+  # compare the results of walk_remote() and walk_local() with the tracked paths, and queue tasks for the differences; 
+  # start_time is when the scan started
+  def compare_changes(self, subtree, remote_walk, local_walk, start_time):
+    logger.trace("lazysync::compare_changes() subtree=%s", subtree)
+    remote_folder_set, remote_file_set, listed_remote_dirs, remote_data = remote_walk
+    local_folder_set, local_file_set, local_data = local_walk
+    if subtree is None:
+      self.scan_count += 1
+    with self.running_lock: # tasks that finished before the scan started are seen by the walks
+      self.task_finish_times = dict((path, finish_time) for path, finish_time in self.task_finish_times.items() 
+                                    if finish_time > start_time)
+    
+    # create sets of folders and files in both sets or in one set only; ignored paths were already skipped by the walks
+    folders_both = remote_folder_set & local_folder_set # check they are equal
+    folders_remote_only = remote_folder_set - local_folder_set # need to be copied
+    folders_local_only = local_folder_set - remote_folder_set # need to be copied
+    files_both = remote_file_set & local_file_set # check they are equal
+    files_remote_only = remote_file_set - local_file_set # need to be copied/symlinked
+    files_local_only = local_file_set - remote_file_set # need to be copied
+    
+    # remote paths that were not lstat'ed during the walk are lstat'ed while comparing; their time is not compare time
+    compare_start_time = timeit.default_timer()
+    stat_time = [0.0]
+    num_stats = [0]
+    #
+    def stat_remote(path_remote):
+      stat_start_time = timeit.default_timer()
+      data = self.remote_backend.stat(path_remote)
+      stat_time[0] += timeit.default_timer() - stat_start_time
+      num_stats[0] += 1
+      return data
     
     # folders_both and files_both need to be compared against self.files, and, if different, added to self.queue
     for relative_path in folders_both | files_both: # for existing folders and files ordering them is not needed
+      if(self.task_pending(relative_path, start_time)):
+        continue
       logger.debug("lazysync::find_changes() '%s': found path in both", relative_path)
       path_remote = os.path.join(self.config['remote'], relative_path)
       path_local = os.path.join(self.config['local'], relative_path)
-      new_syncfiledata_remote = syncfiledata(path_remote)
-      new_syncfiledata_local = syncfiledata(path_local)
+      new_syncfiledata_local = local_data[relative_path]
       
-      if(os.path.islink(path_local) and os.path.realpath(path_local) == path_remote): # always to file, never to dir
+      # symlinks local -> remote are created with the absolute remote path, so the link target is sufficient and, 
+      # unlike realpath(), does not access the remote path
+      if(new_syncfiledata_local.is_link and new_syncfiledata_local.link_target == path_remote): # always to file
         # if a symlink local -> remote is found in non-lazy mode, download the file
         if(not self.config['lazy']):
           logger.info("lazysync::find_changes() '%s': found symlink in non-lazy mode, downloading; task: cp remote local", 
                       relative_path)
-          self.queue.append(synctask(relative_path, self.syncactions.cp_remote))
-        else: # otherwise just update if it was not tracked before
+          self.queue_task(relative_path, self.syncactions.cp_remote, remote_data.get(relative_path))
+        else: # otherwise just update if it was not tracked before; only then the remote path needs to be accessed
           logger.debug("lazysync::find_changes() '%s': path_local is a symlink to path_remote, no changes needed", 
                        relative_path)
           if(relative_path not in self.files):
+            new_syncfiledata_remote = remote_data.get(relative_path) or stat_remote(path_remote)
             self.files[relative_path] = syncfilepair(new_syncfiledata_remote, new_syncfiledata_local)
-      elif(new_syncfiledata_remote.equal_without_atime(new_syncfiledata_local)):
+        continue
+      
+      if(listed_remote_dirs is not None and relative_path in self.files 
+         and (os.path.dirname(relative_path) or os.curdir) not in listed_remote_dirs):
+        new_syncfiledata_remote = self.files.remote_data(relative_path) # remote folder unchanged, use tracked
+      else:
+        new_syncfiledata_remote = remote_data.get(relative_path) or stat_remote(path_remote)
+      equal_content = None
+      if self.config['unreliable_mtime']: # compare files of equal size but different mtime by content hash
+        equal_content = lambda: (self.hashes.hash_file(path_remote, new_syncfiledata_remote, self.remote_backend) == 
+                                 self.hashes.hash_file(path_local, new_syncfiledata_local, self.local_backend))
+      if(new_syncfiledata_remote.equal_without_atime(new_syncfiledata_local, equal_content)):
         logger.debug("lazysync::find_changes() '%s': equal", relative_path)
         if(relative_path not in self.files):
           self.files[relative_path] = syncfilepair(new_syncfiledata_remote, new_syncfiledata_local)
       else:
         if(new_syncfiledata_remote.mtime > new_syncfiledata_local.mtime):
           logger.info("lazysync::find_changes() '%s': NOT equal; task: ln remote local", relative_path)
-          self.queue.append(synctask(relative_path, self.syncactions.ln_remote))
+          self.queue_task(relative_path, self.syncactions.ln_remote, new_syncfiledata_remote)
         else:
           logger.info("lazysync::find_changes() '%s': NOT equal; task: cp local remote", relative_path)
-          self.queue.append(synctask(relative_path, self.syncactions.cp_local))
+          self.queue_task(relative_path, self.syncactions.cp_local, new_syncfiledata_local)
       
+    # files moved on one side are moved on the other side, instead of copying the new path and removing the old one; 
+    # the folders they were moved out of are only removed by the next scan, after the files were moved
+    files_remote_only = set(relative_path for relative_path in files_remote_only 
+                            if not self.task_pending(relative_path, start_time))
+    files_local_only = set(relative_path for relative_path in files_local_only 
+                           if not self.task_pending(relative_path, start_time))
+    moved_to = set() # relative paths files were moved to
+    moved_from = set() # relative paths files were moved from, including the ones of mv tasks queued before
+    moved_from_parents = set() # all parent folders of moved_from
+    with self.running_lock:
+      for relative_path in self.moving_paths:
+        add_busy_path(relative_path, moved_from, moved_from_parents)
+    if(self.config['detect_moves']):
+      walked = {self.config['remote']: remote_data, self.config['local']: local_data}
+      stat_functions = {self.config['remote']: stat_remote, self.config['local']: self.local_backend.stat}
+      moves = [(self.config['local'], self.syncactions.mv_remote, files_local_only, files_remote_only), 
+               (self.config['remote'], self.syncactions.mv_local, files_remote_only, files_local_only)]
+      for prefix, action, new, gone in moves:
+        for relative_path, source in sorted(self.find_moves(prefix, gone, new, walked, stat_functions).items()):
+          logger.info("lazysync::find_changes() '%s': moved from '%s' in '%s'; task: %s", relative_path, source, prefix, 
+                      action.name)
+          with self.running_lock:
+            self.move_sources[relative_path] = source
+            self.moving_paths.add(source)
+          self.queue_task(relative_path, action)
+          moved_to.add(relative_path)
+          add_busy_path(source, moved_from, moved_from_parents)
+      files_remote_only -= moved_to | moved_from
+      files_local_only -= moved_to | moved_from
+    
     # *_only has to be added to self.queue, either to cp/ln if new, or to rm if old
     for relative_path in folders_remote_only: # for creating, do folders first, then files
-      self.queue_change_for_remote(relative_path)
+      if(not self.task_pending(relative_path, start_time) and relative_path not in moved_from_parents):
+        self.queue_change_for_remote(relative_path, remote_data.get(relative_path))
     for relative_path in files_remote_only:
-      self.queue_change_for_remote(relative_path)
+      self.queue_change_for_remote(relative_path, remote_data.get(relative_path))
     for relative_path in folders_local_only:
-      self.queue_change_for_local(relative_path)
+      if(not self.task_pending(relative_path, start_time) and relative_path not in moved_from_parents):
+        self.queue_change_for_local(relative_path)
     for relative_path in files_local_only:
       self.queue_change_for_local(relative_path)
+    self.cache_checked = False
+    
+    end_time = timeit.default_timer()
+    self.metrics.observe('lazysync_scan_phase_seconds', stat_time[0], phase = 'stat')
+    self.metrics.observe('lazysync_scan_phase_seconds', end_time - compare_start_time - stat_time[0], phase = 'compare')
+    self.metrics.inc('lazysync_scan_stats_total', num_stats[0])
+    self.metrics.inc('lazysync_scans_total')
+    self.metrics.observe('lazysync_scan_seconds', end_time - start_time)
+  
+  # return the content hash of the file at path with syncfiledata data in prefix; local files are hashed if needed, but 
+  # for remote files only a cached hash is used, to avoid reading them over the network; None if unknown
+  def content_hash(self, prefix, path, data):
+    if(prefix == self.config['local']):
+      return self.hashes.hash_file(path, data, self.local_backend)
+    return self.hashes.get(data)
+  
+  # find files that were moved in prefix since the last scan; gone are the relative paths of files that are only on the 
+  # other side, new the ones that are only in prefix; a tracked path in gone was moved to an untracked path in new, if 
+  # it has the tracked size and mtime in prefix, and its content hash in prefix (by device and inode usually cached 
+  # for the path it was moved from) equals the one of the unchanged file on the other side; in lazy mode, a moved 
+  # symlink local -> remote still points to the path it was moved from; walked and stat_functions are dicts prefix -> 
+  # syncfiledata of the walked paths and prefix -> function to lstat a path; return a dict relative path -> relative 
+  # path moved from
+  def find_moves(self, prefix, gone, new, walked, stat_functions):
+    logger.trace("lazysync::find_moves() prefix='%s'", prefix)
+    other_prefix = self.config['remote'] if prefix == self.config['local'] else self.config['local']
+    is_local = prefix == self.config['local']
+    tracked = {} # relative path in gone -> (tracked syncfiledata in prefix, tracked syncfiledata on the other side)
+    gone_by_key = defaultdict(list) # (size, mtime) -> relative paths in gone
+    gone_by_link = {} # link target -> relative path in gone of a symlink local -> remote
+    for relative_path in gone:
+      if(relative_path not in self.files):
+        continue
+      pair = self.files[relative_path]
+      if(is_local):
+        tracked[relative_path] = (pair.syncfiledata_local, pair.syncfiledata_remote)
+      else:
+        tracked[relative_path] = (pair.syncfiledata_remote, pair.syncfiledata_local)
+      data, other_data = tracked[relative_path]
+      if(data.is_file and other_data.is_file):
+        gone_by_key[(data.size, data.mtime)].append(relative_path)
+      elif(is_local and data.is_link and other_data.is_file and self.config['lazy']):
+        gone_by_link[os.path.join(self.config['remote'], relative_path)] = relative_path
+    if(not gone_by_key and not gone_by_link):
+      return {}
+    
+    moves = {}
+    other_hashes = {} # relative path in gone -> content hash of the file on the other side, None if unknown or changed
+    for relative_path in sorted(new):
+      if(relative_path in self.files):
+        continue
+      path = os.path.join(prefix, relative_path)
+      try:
+        data = walked[prefix].get(relative_path) or stat_functions[prefix](path)
+        if(data.is_link and data.link_target in gone_by_link):
+          moves[relative_path] = gone_by_link.pop(data.link_target)
+          continue
+        candidates = gone_by_key.get((data.size, data.mtime)) if data.is_file else None
+        if(not candidates):
+          continue
+        content_hash = self.content_hash(prefix, path, data)
+        for source in candidates:
+          if(source not in other_hashes):
+            other_path = os.path.join(other_prefix, source)
+            other_data = walked[other_prefix].get(source) or stat_functions[other_prefix](other_path)
+            unchanged = (other_data.size, other_data.mtime) == (tracked[source][1].size, tracked[source][1].mtime)
+            other_hashes[source] = self.content_hash(other_prefix, other_path, other_data) if unchanged else None
+          if(content_hash is not None and other_hashes[source] == content_hash):
+            moves[relative_path] = source
+            candidates.remove(source)
+            break
+      except OSError as e: # changed meanwhile, the next scan handles it
+        logger.debug("lazysync::find_moves() '%s': %s", relative_path, e)
+    return moves
+      
+  # if local files take more than config['cache_size'], replace the least recently used ones with symlinks local -> 
+  # remote again, like action_ln_remote() creates them; only files whose contents are unchanged since they were synced 
+  # and that are not open are replaced, so no local change is lost; the contents are not backed up, b/c they are remote
+  def evict_cache(self):
+    logger.trace("lazysync::evict_cache()")
+    local_folders, local_files = relative_scan(self.config['local'], ignore = self.ignore, backend = self.local_backend)
+    local_files = dict((relative_path, data) for relative_path, data in local_files.items() if not data.is_link)
+    cache_size = sum(data.size for data in local_files.values())
+    if(cache_size <= self.config['cache_size']):
+      logger.debug("lazysync::evict_cache() %d bytes in %d local files, within cache size", cache_size, len(local_files))
+      return
+    
+    # the last access is the time of the download (ctime) or of the last open, or the atime if it is updated
+    open_paths = set(path for pid, path in self.notifier.tracked_files)
+    #
+    def last_access(relative_path):
+      path_local = os.path.join(self.config['local'], relative_path)
+      statinfo = os.lstat(path_local) # the ctime is not in syncfiledata
+      return max(self.cache_access.get(relative_path, 0), statinfo.st_atime, statinfo.st_ctime)
+    
+    for relative_path in sorted(local_files, key = last_access):
+      if(cache_size <= self.config['cache_size'] or sigint):
+        break
+      path_remote = os.path.join(self.config['remote'], relative_path)
+      path_local = os.path.join(self.config['local'], relative_path)
+      local_data = local_files[relative_path]
+      if(relative_path not in self.files or path_local in open_paths):
+        continue
+      tracked = self.files[relative_path]
+      # compare the exact mtime, b/c a change within the same second must not be lost
+      if((local_data.size, local_data.mtime) != (tracked.syncfiledata_local.size, tracked.syncfiledata_local.mtime)
+         or not tracked.syncfiledata_local.is_file # changed locally, not uploaded yet
+         or not tracked.syncfiledata_remote.equal_without_atime(tracked.syncfiledata_local)):
+        continue
+      remote_data = self.remote_backend.stat(path_remote) if self.remote_backend.lexists(path_remote) else None
+      if(remote_data is None or not remote_data.is_file or not remote_data.equal_without_atime(local_data)):
+        continue # remote changed, the next scan handles it
+      logger.info("lazysync::evict_cache() '%s': least recently used, ln -s remote='%s' local='%s'", relative_path, 
+                  path_remote, path_local)
+      self.replace_with_symlink(relative_path, path_remote)
+      self.files[relative_path] = syncfilepair(remote_data, self.local_backend.stat(path_local))
+      self.cache_access.pop(relative_path, None)
+      if(self.prefetcher is not None):
+        self.prefetcher.forget(relative_path)
+      cache_size -= local_data.size
+    logger.info("lazysync::evict_cache() %d bytes in local files after eviction", cache_size)
       
+  # replace the local file at relative_path with a symlink to target atomically: the symlink is created next to the 
+  # partial files first, where it cannot collide with a file of the user, and is not synced if it is left by a crash
+  def replace_with_symlink(self, relative_path, target):
+    path_local = os.path.join(self.config['local'], relative_path)
+    link_path = os.path.join(self.config['local'], relative_partial_dir, 
+                             hashlib.sha1(relative_path.encode()).hexdigest() + '.link')
+    if(self.local_backend.lexists(link_path)): # left by a crash
+      self.local_backend.remove(link_path)
+    else:
+      self.local_backend.makedirs(os.path.dirname(link_path))
+    self.local_backend.symlink(target, link_path)
+    self.local_backend.rename(link_path, path_local)
+  
+  # return the backend of remote or local
+  def backend(self, prefix):
+    return self.remote_backend if prefix == self.config['remote'] else self.local_backend
+  
   #
   def update_file_tracking(self, relative_path):
     logger.trace("lazysync::update_file_tracking() relative_path='%s'", relative_path)
-    new_syncfiledata_remote = syncfiledata(os.path.join(self.config['remote'], relative_path))
-    new_syncfiledata_local = syncfiledata(os.path.join(self.config['local'], relative_path))
+    new_syncfiledata_remote = self.remote_backend.stat(os.path.join(self.config['remote'], relative_path))
+    new_syncfiledata_local = self.local_backend.stat(os.path.join(self.config['local'], relative_path))
     self.files[relative_path] = syncfilepair(new_syncfiledata_remote, new_syncfiledata_local)
     logger.trace("lazysync::update_file_tracking() remote=%s", new_syncfiledata_remote)
     logger.trace("lazysync::update_file_tracking() local=%s", new_syncfiledata_local)
@@ -416,9 +2553,10 @@ class lazysync(ofnotify.event_processor):
     logger.trace("lazysync::get_last_backup_file_data() '%s'", original_path)
     backup_files = self.remote_backup_files if original_path.startswith(self.config['remote']) else self.local_backup_files
     last_backup_file_data = None
-    for backup_file_data in backup_files[original_path]:
-      if last_backup_file_data == None or backup_file_data.time > last_backup_file_data.time:
-        last_backup_file_data = backup_file_data
+    with self.backup_lock:
+      for backup_file_data in backup_files.get(original_path, []):
+        if last_backup_file_data == None or backup_file_data.time > last_backup_file_data.time:
+          last_backup_file_data = backup_file_data
     if last_backup_file_data == None:
       logger.debug("lazysync::get_last_backup_file_data() no backup file found")
     else:
@@ -430,43 +2568,120 @@ class lazysync(ofnotify.event_processor):
   def remove_backup_file(self, original_path, backup_file_data):
     logger.trace("lazysync::remove_backup_file() '%s' -> '%s' (%s)", original_path, backup_file_data.path, 
                  backup_file_data.time)
-    if original_path.startswith(self.config['remote']): # remove from backup_file_data from dict, either remote or local
-      self.remote_backup_files[original_path].remove(backup_file_data)
-    else:
-      self.local_backup_files[original_path].remove(backup_file_data)
-    os.remove(backup_file_data.path) # remove backup file
-    self.save_data() # save data
+    with self.backup_lock:
+      if original_path.startswith(self.config['remote']): # remove backup_file_data from dict, either remote or local
+        self.remote_backup_files[original_path].remove(backup_file_data)
+        self.journal_backup_change(self.config['remote'], 'remove', original_path, backup_file_data)
+      else:
+        self.local_backup_files[original_path].remove(backup_file_data)
+        self.journal_backup_change(self.config['local'], 'remove', original_path, backup_file_data)
+      self.backup_file_refs[backup_file_data.path] -= 1
+      if self.backup_file_refs[backup_file_data.path] <= 0: # remove backup file if no other version uses it
+        del self.backup_file_refs[backup_file_data.path]
+        prefix = self.config['remote'] if original_path.startswith(self.config['remote']) else self.config['local']
+        self.backend(prefix).remove(backup_file_data.path)
 
   #
   def action_cp(self, from_prefix, to_prefix, relative_path):
     logger.debug("lazysync::action_cp() from='%s' to='%s' relative_path='%s'", from_prefix, to_prefix, relative_path)
     from_path = os.path.join(from_prefix, relative_path)
     to_path = os.path.join(to_prefix, relative_path)
-    if(os.path.islink(from_path)):
-      link_target = os.path.realpath(from_path)
-      if(os.path.realpath(from_path).startswith(from_prefix)): # if link is inside from_prefix
+    from_backend = self.backend(from_prefix)
+    to_backend = self.backend(to_prefix)
+    if(from_backend.islink(from_path)):
+      link_target = from_backend.realpath(from_path)
+      if(link_target.startswith(from_prefix)): # if link is inside from_prefix
         link_target = os.path.join(to_prefix, os.path.relpath(link_target, from_prefix)) # set new link target inside to_prefix
       logger.info("lazysync::action_cp() relative_path is symlink, ln -s target='%s' to='%s'", link_target, to_path)
-      if(os.path.lexists(to_path)):
+      if(to_backend.lexists(to_path)):
         if to_prefix == self.config['remote']:
           self.action_rm_remote(relative_path)
         else:
           self.action_rm_local(relative_path)
-      os.symlink(link_target, to_path)
-    elif(os.path.isdir(from_path)):
+      to_backend.symlink(link_target, to_path)
+    elif(from_backend.isdir(from_path)):
       logger.info("lazysync::action_cp() relative_path is dir, mkdir to='%s'", to_path)
-      make_sure_path_exists(to_path)
-      shutil.copystat(from_path, to_path)
+      to_backend.makedirs(to_path)
+      to_backend.copystat(from_backend.stat(from_path), to_path)
     else:
       logger.info("lazysync::action_cp() relative_path is file, cp from='%s' to='%s'", from_path, to_path)
-      if os.path.lexists(to_path): # remove an old file it it exists
+      # copy to a partial file next to the backup files first, so that to_path is replaced atomically when complete
+      partial_path = os.path.join(to_prefix, relative_partial_dir, hashlib.sha1(relative_path.encode()).hexdigest())
+      bucket = self.upload_bucket if to_prefix == self.config['remote'] else self.download_bucket
+      interactive = relative_path in self.interactive_paths and to_prefix == self.config['local']
+      self.interactive_paths.discard(relative_path)
+      from_data = from_backend.stat(from_path)
+      direction = 'upload' if to_prefix == self.config['remote'] else 'download'
+      progress = {'path': relative_path, 'direction': direction, 'copied': 0, 'size': from_data.size}
+      #
+      def update_progress(copied, transferred = None):
+        progress.setdefault('resumed', copied) # the first call is before any chunk is copied
+        progress['copied'] = copied
+        if transferred is not None: # delta transfer
+          progress['transferred'] = transferred
+      # with --delta, the signature of the copied version is kept for a delta transfer against it when it changes; only 
+      # uploads are delta transfers, b/c a download would read the whole new version over the network anyway, and only 
+      # with server-side copies, b/c otherwise the mount reads and writes back the blocks copied from the old version
+      signature = None
+      old_data = old_hash = old_signature = None
+      if(self.config['delta'] and not self.config['unreliable_mtime'] and self.remote_backend.server_side_copy and 
+         from_data.size >= delta_min_size):
+        signature = blocksignature(delta_block_size(from_data.size))
+        if(to_prefix == self.config['remote'] and to_backend.lexists(to_path)):
+          old_data = to_backend.stat(to_path)
+          old_hash = self.hashes.get(old_data) if old_data.is_file else None
+          old_signature = self.hashes.get_signature(old_hash)
+      with self.transfers_lock:
+        self.transfers[relative_path] = progress
+      start_time = timeit.default_timer()
+      try:
+        if old_signature is not None:
+          content_hash = copy_file_delta(from_path, to_path, old_signature, partial_path, bucket, interactive, 
+                                         update_progress, signature, from_backend, to_backend)
+          new_old_data = to_backend.stat(to_path) if to_backend.lexists(to_path) else None
+          if content_hash is not None and (new_old_data is None or (new_old_data.size, new_old_data.mtime) 
+                                                                   != (old_data.size, old_data.mtime)):
+            logger.info("lazysync::action_cp() old version of to='%s' changed during the delta transfer", to_path)
+            to_backend.remove(partial_path)
+            content_hash = None # the next scan finds the changes again
+        else:
+          content_hash = copy_file_resumable(from_path, partial_path, bucket, interactive, update_progress, 
+                                             from_backend, to_backend, signature)
+      finally:
+        with self.transfers_lock:
+          del self.transfers[relative_path]
+        duration = timeit.default_timer() - start_time
+        copied = progress['copied'] - progress.get('resumed', 0)
+        if 'transferred' in progress:
+          self.metrics.inc('lazysync_transfer_delta_saved_bytes_total', max(0, copied - progress['transferred']), 
+                           direction = direction)
+          copied = progress['transferred']
+        self.metrics.inc('lazysync_transfer_bytes_total', copied, direction = direction)
+        self.metrics.observe('lazysync_transfer_seconds', duration, direction = direction)
+        self.metrics.set('lazysync_transfer_throughput_bytes_per_second', copied / max(duration, 1e-6), 
+                         direction = direction)
+      if content_hash is None:
+        return # interrupted; the next scan finds the change again and the copy is resumed
+      self.metrics.inc('lazysync_transfer_files_total', direction = direction)
+      new_from_data = from_backend.stat(from_path)
+      to_backend.copystat(new_from_data, partial_path)
+      if to_backend.lexists(to_path): # remove an old file it it exists
         if to_prefix == self.config['remote']:
           self.action_rm_remote(relative_path)
         else:
           self.action_rm_local(relative_path)
-      shutil.copy2(from_path, to_path)
+      to_backend.rename(partial_path, to_path)
+      self.hashes.put(to_backend.stat(to_path), content_hash)
+      if signature is not None: # the one of the old version is kept for other files with its contents
+        self.hashes.put_signature(content_hash, signature)
+      # only if not changed meanwhile; reading the file changes its atime, which is not part of the key of the hashes
+      if (new_from_data.size, new_from_data.mtime) == (from_data.size, from_data.mtime):
+        self.hashes.put(from_data, content_hash)
       last_backup_file_data = self.get_last_backup_file_data(to_path) # get last backed up version
-      if last_backup_file_data is not None and filecmp.cmp(to_path, last_backup_file_data.path, shallow = False):
+      # the hash of a content-addressed backup is known; otherwise it is usually cached, b/c the backup file was moved
+      if last_backup_file_data is not None and (last_backup_file_data.content_hash or 
+                                                self.hashes.hash_file(last_backup_file_data.path, None, to_backend)) \
+                                               == content_hash:
         logger.info("lazysync::action_cp() files to='%s' and to_backup='%s' are identical, not keeping to_backup", 
                     to_path, last_backup_file_data.path)
         self.remove_backup_file(to_path, last_backup_file_data) # remove the previous version
@@ -489,54 +2704,122 @@ class lazysync(ofnotify.event_processor):
     path_remote = os.path.join(self.config['remote'], relative_path)
     path_local = os.path.join(self.config['local'], relative_path)
     
-    if(os.path.islink(path_remote) or os.path.isdir(path_remote)) or not self.config['lazy']:
+    if(self.remote_backend.islink(path_remote) or self.remote_backend.isdir(path_remote)) or not self.config['lazy']:
       self.action_cp_remote(relative_path)
     else:
       logger.info("lazysync::action_ln_remote() relative_path is file, ln -s remote='%s' local='%s'", path_remote, 
                    path_local)
-      if(os.path.lexists(path_local)):
+      if(self.local_backend.lexists(path_local)):
         self.action_rm_local(relative_path)
-      os.symlink(path_remote, path_local)
+      self.local_backend.symlink(path_remote, path_local)
+      if(self.prefetcher is not None):
+        self.prefetcher.forget(relative_path)
       self.update_file_tracking(relative_path)
       
+  # move the file at move_sources[relative_path] to relative_path in prefix, b/c it was moved on the other side; in lazy 
+  # mode, the moved symlink local -> remote is pointed to the new remote path; if the file changed since the scan, it 
+  # is copied from the other side instead, and the path it was moved from is handled by the next scan
+  def action_mv(self, prefix, relative_path):
+    with self.running_lock:
+      source = self.move_sources.pop(relative_path)
+    try:
+      self.move_file(prefix, relative_path, source)
+    finally:
+      with self.running_lock: # source is not compared by scans that walked it before it was moved
+        self.moving_paths.discard(source)
+        self.task_finish_times[source] = timeit.default_timer()
+  
+  # see action_mv()
+  def move_file(self, prefix, relative_path, source):
+    logger.debug("lazysync::move_file() prefix='%s' relative_path='%s' source='%s'", prefix, relative_path, source)
+    other_prefix = self.config['remote'] if prefix == self.config['local'] else self.config['local']
+    backend = self.backend(prefix)
+    from_path = os.path.join(prefix, source)
+    to_path = os.path.join(prefix, relative_path)
+    path_local = os.path.join(self.config['local'], relative_path)
+    relink = (prefix == self.config['remote'] and self.local_backend.islink(path_local) 
+              and self.local_backend.readlink(path_local) == from_path)
+    
+    current = backend.stat(from_path) if backend.lexists(from_path) else None
+    tracked = None
+    if(source in self.files):
+      pair = self.files[source]
+      tracked = pair.syncfiledata_remote if prefix == self.config['remote'] else pair.syncfiledata_local
+    if(current is None or tracked is None or not current.is_file or backend.lexists(to_path) 
+       or (not relink and (current.size, current.mtime) != (tracked.size, tracked.mtime))):
+      logger.info("lazysync::move_file() '%s' changed since the scan, not moving it to '%s'", from_path, to_path)
+      if(not relink):
+        self.action_cp(other_prefix, prefix, relative_path)
+      return
+    
+    logger.info("lazysync::move_file() mv from='%s' to='%s'", from_path, to_path)
+    if(not backend.isdir(os.path.dirname(to_path))):
+      backend.makedirs(os.path.dirname(to_path))
+    backend.rename(from_path, to_path)
+    if(relink):
+      logger.info("lazysync::move_file() ln -s remote='%s' local='%s'", to_path, path_local)
+      self.replace_with_symlink(relative_path, to_path)
+    del self.files[source]
+    self.update_file_tracking(relative_path)
+  
+  #
+  def action_mv_local(self, relative_path):
+    logger.debug("lazysync::action_mv_local() relative_path='%s'", relative_path)
+    self.action_mv(self.config['local'], relative_path)
+  
+  #
+  def action_mv_remote(self, relative_path):
+    logger.debug("lazysync::action_mv_remote() relative_path='%s'", relative_path)
+    self.action_mv(self.config['remote'], relative_path)
+  
   #
   def action_rm(self, prefix, relative_path):
     logger.debug("lazysync::action_rm() prefix='%s' relative_path='%s'", prefix, relative_path)
     original_path = os.path.join(prefix, relative_path)
+    backend = self.backend(prefix)
     
-    if(os.path.islink(original_path)):
+    if(backend.islink(original_path)):
       logger.info("lazysync::action_rm() rm symlink")
-      os.remove(original_path) # symlinks are not backed up
+      backend.remove(original_path) # symlinks are not backed up
       if relative_path in self.files: # check, b/c an old file can exist from a previous run, but no entry in self.files
         del self.files[relative_path]
-    elif(os.path.isdir(original_path)):
+    elif(backend.isdir(original_path)):
       logger.debug("lazysync::action_rm() rm dir")
-      # remove dir contents recursively
-      for dirpath, dirnames, filenames in os.walk(original_path):
-        relative_dirpath = os.path.relpath(dirpath, prefix)
-        for dirname in dirnames:
-          logger.info("lazysync::action_rm() recursively rm '%s'", os.path.join(relative_dirpath, dirname))
-          self.action_rm(prefix, os.path.join(relative_dirpath, dirname))
-        for filename in filenames: 
-          logger.info("lazysync::action_rm() recursively rm '%s'", os.path.join(relative_dirpath, filename))
-          self.action_rm(prefix, os.path.join(relative_dirpath, filename))
+      # remove dir contents recursively, folders first
+      entries = backend.list_dir(original_path, False)
+      for name, is_dir, is_link, data in sorted(entries, key = lambda entry: not entry[1]):
+        logger.info("lazysync::action_rm() recursively rm '%s'", os.path.join(relative_path, name))
+        self.action_rm(prefix, os.path.join(relative_path, name))
       # remove dir
-      os.rmdir(original_path)
+      backend.rmdir(original_path)
       if relative_path in self.files: # check, b/c an old file can exist from a previous run, but no entry in self.files
         del self.files[relative_path]
-    elif(os.path.isfile(original_path)): # make sure file still exists and was not deleted recursively in a subdir
-      hash_input = relative_path + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-      hashed_filename = hashlib.sha1(hash_input.encode()).hexdigest()
-      backup_path = os.path.join(prefix, relative_backup_dir, hashed_filename)
+    elif(backend.isfile(original_path)): # make sure file still exists and was not deleted recursively in a subdir
+      # back up content-addressed, so identical contents are only kept once; the content hash is computed for local 
+      # files, but for remote files only used if cached, to avoid reading them over the network
+      data = backend.stat(original_path)
+      content_hash = self.content_hash(prefix, original_path, data)
       
-      logger.info("lazysync::action_rm() rm file, back up in '%s' (hash_input='%s')", backup_path, hash_input)
-      shutil.move(original_path, backup_path)
-
-      if prefix == self.config['remote']:
-        self.remote_backup_files[original_path].append(backupfiledata(backup_path))
-      else:
-        self.local_backup_files[original_path].append(backupfiledata(backup_path))
-      self.save_data()
+      with self.backup_lock: # make sure an existing backup file is not removed before it is used again
+        if content_hash is not None:
+          backup_path = os.path.join(prefix, relative_backup_dir, content_hash)
+        else:
+          hash_input = relative_path + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+          backup_path = os.path.join(prefix, relative_backup_dir, hashlib.sha1(hash_input.encode()).hexdigest())
+        if content_hash is not None and backend.isfile(backup_path):
+          logger.info("lazysync::action_rm() rm file, identical contents already backed up in '%s'", backup_path)
+          backend.remove(original_path)
+        else:
+          logger.info("lazysync::action_rm() rm file, back up in '%s'", backup_path)
+          backend.rename(original_path, backup_path)
+        
+        backup_file_data = backupfiledata(backup_path, content_hash)
+        if prefix == self.config['remote']:
+          self.remote_backup_files[original_path].append(backup_file_data)
+        else:
+          self.local_backup_files[original_path].append(backup_file_data)
+        self.backup_file_refs[backup_path] += 1
+        self.journal_backup_change(prefix, 'add', original_path, backup_file_data)
       
       if relative_path in self.files: # check, b/c an old file can exist from a previous run, but no entry in self.files
         del self.files[relative_path]
@@ -551,53 +2834,417 @@ class lazysync(ofnotify.event_processor):
     logger.info("lazysync::action_rm_remote() relative_path='%s'", relative_path)
     self.action_rm(self.config['remote'], relative_path)
     
+  # return the relative path of path, which is either relative or inside remote or local
+  def control_relative_path(self, path):
+    for prefix in (self.config['remote'], self.config['local']):
+      if(os.path.isabs(path) and (path == prefix or path.startswith(prefix + os.sep))):
+        path = os.path.relpath(path, prefix)
+    relative_path = os.path.normpath(path)
+    if(os.path.isabs(relative_path) or relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep)):
+      raise ValueError("path '%s' is not inside remote or local" % path)
+    if(relative_path != os.curdir and not self.ignore.filter(set([relative_path]))):
+      raise ValueError("path '%s' is ignored" % path)
+    return relative_path
+  
+  # return the metrics in the text format of prometheus, after setting the ones that are counted elsewhere
+  def metrics_text(self):
+    for priority in task_priorities:
+      self.metrics.set('lazysync_queue_tasks', self.queue.num_by_priority[priority], priority = priority.name)
+    self.metrics.set('lazysync_tracked_paths', len(self.files))
+    with self.transfers_lock:
+      self.metrics.set('lazysync_transfers', len(self.transfers))
+    if(self.config['lazy']):
+      self.metrics.set('lazysync_ofnotify_scans_total', self.notifier.num_scans)
+      self.metrics.set('lazysync_ofnotify_scan_seconds_total', self.notifier.scan_time)
+      self.metrics.set('lazysync_ofnotify_pids_scanned_total', self.notifier.num_pids_scanned)
+    if(self.prefetcher is not None):
+      self.metrics.set('lazysync_prefetch_hit_rate', self.prefetcher.hit_rate())
+    return self.metrics.text()
+  
+  # write the metrics to config['metrics_file'], atomically, so that a reader never sees a partial file
+  def write_metrics_file(self):
+    logger.trace("lazysync::write_metrics_file()")
+    try:
+      write_file_contents(self.config['metrics_file'] + '.tmp', self.metrics_text())
+      os.rename(self.config['metrics_file'] + '.tmp', self.config['metrics_file'])
+    except (IOError, OSError) as e:
+      logger.warning("lazysync::write_metrics_file() cannot write '%s': %s", self.config['metrics_file'], e)
+  
+  # handle a request of the control socket, in the thread of its connection; the state is only read, and rescans and 
+  # prefetches are queued, which is safe from other threads; return the response
+  def handle_control_request(self, request):
+    logger.debug("lazysync::handle_control_request() request=%s", request)
+    command = request.get('command')
+    if(command == 'status'):
+      with self.transfers_lock:
+        transfers = [dict(progress) for progress in self.transfers.values()]
+      return {'remote': self.config['remote'], 'local': self.config['local'], 'lazy': self.config['lazy'], 
+              'tracked_paths': len(self.files), 'queued_tasks': len(self.queue), 
+              'queued_tasks_by_priority': dict((priority.name, count) 
+                                               for priority, count in self.queue.num_by_priority.items() if count > 0), 
+              'transfers': transfers, 'scans': self.scan_count, 'rescans': list(self.rescan_requests), 
+              'next_scan_in': max(0, self.next_scan_time - timeit.default_timer()), 
+              'prefetch_hit_rate': self.prefetcher.hit_rate() if self.prefetcher is not None else None}
+    elif(command == 'rescan'): # done by the main loop before processing the next task
+      relative_path = self.control_relative_path(request.get('path') or os.curdir)
+      logger.info("lazysync::handle_control_request() '%s': rescan requested", relative_path)
+      self.rescan_requests.append(relative_path)
+      self.wake()
+      return {'rescan': relative_path}
+    elif(command == 'prefetch'): # symlinked files matching the pattern or inside folders matching it
+      pattern = self.control_relative_path(request.get('pattern') or os.curdir)
+      paths = set(self.files.paths())
+      matched = paths - ignore_matcher(['/' + pattern]).filter(paths) if pattern != os.curdir else paths
+      num_files = 0
+      num_bytes = 0
+      for relative_path in sorted(matched):
+        size = self.prefetch_size(relative_path)
+        if(size is None or relative_path in self.queue):
+          continue
+        logger.info("lazysync::handle_control_request() '%s': prefetch requested; task: cp remote local", relative_path)
+        self.queue_task(relative_path, self.syncactions.cp_remote, priority = task_priorities.small)
+        num_files += 1
+        num_bytes += size
+      self.wake()
+      return {'files': num_files, 'bytes': num_bytes}
+    elif(command == 'metrics'):
+      return {'metrics': self.metrics_text()}
+    elif(command == 'stop'):
+      global sigint
+      sigint = True
+      self.wake()
+      return {'stop': True}
+    raise ValueError("unknown command '%s'" % command)
+  
+  # take the next task from the queue; its path counts as running until release_task(), also while the task waits for a 
+  # worker, so that scans do not queue tasks on it that duplicate or contradict it; raises IndexError if the queue is 
+  # empty
+  def take_task(self):
+    with self.running_lock:
+      task = self.queue.popleft()
+      self.running_paths[task.relative_path] += 1
+    return task
+  
+  # undo take_task() for task when it finished, or queue it again if requeue is True
+  def release_task(self, task, requeue = False):
+    with self.running_lock:
+      if(requeue):
+        self.queue.requeue(task)
+      else:
+        self.task_finish_times[task.relative_path] = timeit.default_timer()
+      self.running_paths[task.relative_path] -= 1
+      if(self.running_paths[task.relative_path] == 0):
+        del self.running_paths[task.relative_path]
+  
   #
   def process_next_change(self):
     logger.debug("lazysync::process_next_change() queue.size=%s", len(self.queue))
-    task = self.queue.popleft()
-    if(task.action in self.syncaction_functions):
-      self.syncaction_functions[task.action](task.relative_path)
-    else:
-      logger.debug("lazysync::process_next_change() no action for task '%s'", task.action)
+    self.process_change(self.take_task())
+  
+  # process all queued changes (including changes queued meanwhile) with config['transfer_workers'] threads; tasks are 
+  # only taken from the queue when a worker is free, so that tasks queued meanwhile are processed by their priority; a 
+  # task is only started if no running task and no task taken before it is on the same path, or on a parent folder or a 
+  # child path of it, so that related tasks are processed in queue order (e.g. mkdir before cp of a file inside)
+  def process_changes(self):
+    logger.debug("lazysync::process_changes() queue.size=%s", len(self.queue))
+    pending = [] # tasks taken from the queue, but not started yet, in the order they were taken
+    running = {} # future -> synctask
+    while running or pending or (self.queue and not sigint): # on ctrl-c, only until the running tasks are finished
+      if sigint: # stop taking new tasks on ctrl-c, but finish the running ones
+        for task in pending:
+          self.release_task(task, requeue = True)
+        pending = []
+      
+      busy = set() # relative paths of running tasks and of pending tasks that are not started
+      busy_parents = set() # all parent folders of busy
+      for task in running.values():
+        add_busy_path(task.relative_path, busy, busy_parents)
+      not_started = [] # pending tasks that could not be started
+      for task in pending:
+        if len(running) < self.config['transfer_workers'] and not path_conflicts(task.relative_path, busy, busy_parents):
+          running[self.transfer_executor.submit(self.process_change, task)] = task
+        else:
+          not_started.append(task)
+        add_busy_path(task.relative_path, busy, busy_parents)
+      while len(running) < self.config['transfer_workers'] and self.queue and not sigint:
+        task = self.take_task()
+        if not path_conflicts(task.relative_path, busy, busy_parents):
+          running[self.transfer_executor.submit(self.process_change, task)] = task
+        else:
+          not_started.append(task)
+        add_busy_path(task.relative_path, busy, busy_parents)
+      pending = not_started
+        
+      if running:
+        done, not_done = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          del running[future]
+          future.result() # raise exceptions of the task
+          
+  # process task, which was taken with take_task()
+  def process_change(self, task):
+    logger.debug("lazysync::process_change() '%s' action=%s priority=%s waited %.3fs", task.relative_path, task.action, 
+                 task.priority.name, task.wait_time or 0)
+    self.metrics.observe('lazysync_task_wait_seconds', task.wait_time or 0, priority = task.priority.name)
+    try:
+      if(task.action in self.syncaction_functions):
+        with self.metrics.time('lazysync_task_seconds', action = task.action.name):
+          self.syncaction_functions[task.action](task.relative_path)
+      else:
+        logger.debug("lazysync::process_change() no action for task '%s'", task.action)
+    finally:
+      self.release_task(task)
+  
+  # wake up the scanning loop early, e.g. b/c of an ofnotify event or a control request; may be called from any thread
+  def wake(self):
+    self.wakeup.set()
+    if(self.event_loop is not None):
+      self.event_loop.call_soon_threadsafe(self.wakeup_event.set)
+  
+  # sleep until deadline, until woken up by an ofnotify event, or until sigint; a delay of min_sleep is tolerable to quit
+  def sleep_until(self, deadline):
+    logger.trace("lazysync::sleep_until() deadline=%f", deadline)
+    while(not sigint):
+      wait = deadline - timeit.default_timer()
+      if(wait <= 0):
+        return
+      if(self.wakeup.wait(min(wait, min_sleep))):
+        self.wakeup.clear()
+        # the user is active, don't wait longer than the reset interval for the next scan
+        self.next_scan_time = min(self.next_scan_time, timeit.default_timer() + self.scan_interval.interval)
+        return
+
+  # start the control server in a thread; return the path of its socket
+  def start_control_server(self):
+    logger.trace("lazysync::start_control_server()")
+    socket_path = self.config['socket'] or os.path.join(self.config['local'], relative_backup_dir, socket_file)
+    try:
+      self.control_server = control_server(socket_path, self)
+      thread = threading.Thread(target = self.control_server.serve_forever)
+      thread.daemon = True # does not keep the process alive if loop() ends without shutdown()
+      thread.start()
+      logger.info("lazysync::start_control_server() control socket at '%s'", socket_path)
+    except (OSError, socket.error) as e: # e.g. the path is too long for a unix socket
+      logger.warning("lazysync::start_control_server() cannot create control socket '%s': %s", socket_path, e)
+    return socket_path
   
-  # loop to detect sigint
+  # loop to detect sigint; on an exception, shuts down like on sigint before raising it
   def loop(self):
     logger.trace("lazysync::loop()")
+    remote_backup_dir = os.path.join(self.config['remote'], relative_backup_dir)
+    local_backup_dir = os.path.join(self.config['local'], relative_backup_dir)
+    socket_path = self.start_control_server()
+    try:
+      while(not sigint):
+        self.wait_for_paths_available([remote_backup_dir, local_backup_dir])
+        
+        while(self.rescan_requests and not sigint):
+          self.find_changes(self.rescan_requests.popleft())
+        start_time = timeit.default_timer()
+        
+        logger.trace("lazysync::loop() self.files.path=%s", self.files.keys())
+        if(start_time >= self.next_scan_time): # check filesystem if waiting time is up
+          self.find_changes()
+          interval = self.scan_interval.update(bool(self.queue))
+          # wait at least as long as the scan took, to not spend more than half of the time scanning a slow remote
+          scan_duration = timeit.default_timer() - start_time
+          self.next_scan_time = start_time + scan_duration + max(interval, scan_duration)
+          logger.debug("lazysync::loop() scan_duration=%f, next scan in %fs", scan_duration, 
+                       self.next_scan_time - start_time)
+          if(self.config['metrics_file']):
+            self.write_metrics_file()
+        if(self.queue and self.config['transfer_workers'] > 1): # process all changes concurrently
+          self.process_changes()
+        elif(self.queue): # process any changes that are left
+          self.process_next_change()
+          
+        self.files.commit() # make tracking changes of this round durable
+        self.hashes.commit()
+        
+        duration = timeit.default_timer() -  start_time
+        logger.debug("lazysync::loop() duration=%f", duration)
+
+        if(not self.queue and not self.cache_checked and self.config['lazy'] and self.config['cache_size'] > 0):
+          self.evict_cache() # after all downloads of this scan
+          self.cache_checked = True
+        if(not self.queue): # sleep to avoid 100% cpu load
+          self.sleep_until(self.next_scan_time)
+    finally:
+      if self.config['lazy']:
+        self.notifier.stop()
+      self.shutdown(socket_path)
+  
+  # stop the control server, log statistics, and wait for the threads and close the files; the notifier must be 
+  # stopped before
+  def shutdown(self, socket_path):
+    logger.trace("lazysync::shutdown()")
+    if self.control_server is not None:
+      self.control_server.shutdown()
+      self.control_server.server_close()
+      os.remove(socket_path)
+    if self.config['metrics_file']:
+      self.write_metrics_file()
+    for priority, (count, total, maximum) in sorted(self.queue.wait_stats.items(), key = lambda item: item[0].value):
+      logger.info("lazysync::shutdown() %d %s tasks waited %.3fs on average, at most %.3fs", count, priority.name, 
+                  total / count, maximum)
+    if self.prefetcher is not None:
+      logger.info("lazysync::shutdown() prefetch hit rate %.2f (%d of %d prefetched files accessed)", 
+                  self.prefetcher.hit_rate(), self.prefetcher.num_hits, self.prefetcher.num_prefetched)
+    self.transfer_executor.shutdown()
+    if self.reconcile_thread is not None:
+      self.reconcile_thread.join()
+    self.close_journals()
+    self.files.close()
+    self.hashes.close()
+  
+  # coroutine of the asyncio engine: scan_forever(), transfer_forever() and, in lazy mode, the notifier run as concurrent 
+  # tasks in the event loop, and all blocking calls run in executors, so that e.g. a long transfer does not delay the 
+  # next scan, and the download of an accessed file starts as soon as its open file event is processed
+  async def run_async(self):
+    logger.trace("lazysync::run_async()")
     global sigint
+    self.event_loop = asyncio.get_event_loop()
+    self.wakeup_event = asyncio.Event()
+    self.queued_event = asyncio.Event()
+    socket_path = await self.event_loop.run_in_executor(None, self.start_control_server)
+    tasks = [asyncio.ensure_future(self.scan_forever()), asyncio.ensure_future(self.transfer_forever())]
+    notifier_task = asyncio.ensure_future(self.notifier.run()) if self.config['lazy'] else None
+    try:
+      done, not_done = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+    finally: # on an exception, let the other task finish the running transfers
+      sigint = True
+      self.wakeup_event.set()
+      self.queued_event.set()
+      await asyncio.wait(tasks)
+      if notifier_task is not None:
+        self.notifier.stop()
+        await notifier_task
+      self.event_loop = None
+      await asyncio.get_event_loop().run_in_executor(None, self.shutdown, socket_path)
+    for task in tasks:
+      task.result() # raise exceptions of the tasks
+  
+  # like sleep_until(), but in the event loop
+  async def async_sleep_until(self, deadline):
+    while(not sigint):
+      wait = deadline - timeit.default_timer()
+      if(wait <= 0):
+        return
+      try:
+        await asyncio.wait_for(self.wakeup_event.wait(), min(wait, min_sleep))
+      except asyncio.TimeoutError:
+        continue
+      self.wakeup_event.clear()
+      # the user is active, don't wait longer than the reset interval for the next scan
+      self.next_scan_time = min(self.next_scan_time, timeit.default_timer() + self.scan_interval.interval)
+      return
+  
+  # like find_changes(), but remote and local are walked concurrently in executors; only the comparison queues tasks
+  async def find_changes_async(self, subtree = None):
+    logger.trace("lazysync::find_changes_async() subtree=%s", subtree)
+    start_time = timeit.default_timer()
+    remote_walk, local_walk = await asyncio.gather(self.event_loop.run_in_executor(None, self.walk_remote, subtree), 
+                                                   self.event_loop.run_in_executor(None, self.walk_local, subtree))
+    await self.event_loop.run_in_executor(None, self.compare_changes, subtree, remote_walk, local_walk, start_time)
+  
+  # coroutine of the asyncio engine that scans like loop(), while transfer_forever() processes the queued tasks
+  async def scan_forever(self):
+    logger.trace("lazysync::scan_forever()")
     remote_backup_dir = os.path.join(self.config['remote'], relative_backup_dir)
     local_backup_dir = os.path.join(self.config['local'], relative_backup_dir)
     while(not sigint):
-      self.wait_for_paths_available([remote_backup_dir, local_backup_dir])
+      await self.event_loop.run_in_executor(None, self.wait_for_paths_available, [remote_backup_dir, local_backup_dir])
       
+      while(self.rescan_requests and not sigint):
+        await self.find_changes_async(self.rescan_requests.popleft())
       start_time = timeit.default_timer()
       
-      logger.trace("lazysync::loop() self.files.path=%s", self.files.keys())
-      only_sleeping = not self.queue and self.sleep_time > 0 # save if we only sleep this round
-      if(self.sleep_time == 0): # check filesystem if waiting time is up
-        self.find_changes()
-      if(self.queue): # process any changes that are left
-        self.process_next_change()
-        
-      duration = timeit.default_timer() -  start_time
-      logger.debug("lazysync::loop() duration=%f", duration)
-      self.sleep_time += duration
-
-      if(not self.queue and self.sleep_time > 0): # sleep to avoid 100% cpu load; a small delay is tolerable to quit 
-        level = logging.DEBUG if(only_sleeping) else logging.INFO
-        logger.log(level, "lazysync::loop() sleep with sleep_time=%f", self.sleep_time)
-        time.sleep(min_sleep) # sleep fixed time to pace polling if duration is very short
-        self.sleep_time = max(0, self.sleep_time - min_sleep)
-        
-    if self.config['lazy']:
-      self.notifier.stop()
+      if(start_time >= self.next_scan_time and not sigint): # check filesystem if waiting time is up
+        await self.find_changes_async()
+        interval = self.scan_interval.update(bool(self.queue))
+        # wait at least as long as the scan took, to not spend more than half of the time scanning a slow remote
+        scan_duration = timeit.default_timer() - start_time
+        self.next_scan_time = start_time + scan_duration + max(interval, scan_duration)
+        logger.debug("lazysync::scan_forever() scan_duration=%f, next scan in %fs", scan_duration, 
+                     self.next_scan_time - start_time)
+        if(self.config['metrics_file']):
+          await self.event_loop.run_in_executor(None, self.write_metrics_file)
+      
+      if(not self.queue and not self.running_paths and not self.cache_checked and self.config['lazy'] 
+         and self.config['cache_size'] > 0):
+        await self.event_loop.run_in_executor(None, self.evict_cache) # after all downloads of this scan
+        self.cache_checked = True
+      await self.async_sleep_until(self.next_scan_time)
+  
+  # coroutine of the asyncio engine that processes queued tasks like process_changes(), but forever: it waits for new 
+  # tasks instead of returning when the queue is empty; an interactive task (the download of an accessed file) at the 
+  # head of the queue may use one more worker than config['transfer_workers'], so that it does not wait for a long 
+  # transfer to finish
+  async def transfer_forever(self):
+    logger.trace("lazysync::transfer_forever()")
+    pending = [] # tasks taken from the queue, but not started yet, in the order they were taken
+    running = {} # future -> synctask
+    while(not sigint or pending or running):
+      if sigint: # stop taking new tasks on ctrl-c, but finish the running ones
+        for task in pending:
+          self.release_task(task, requeue = True)
+        pending = []
+      
+      busy = set() # relative paths of running tasks and of pending tasks that are not started
+      busy_parents = set() # all parent folders of busy
+      for task in running.values():
+        add_busy_path(task.relative_path, busy, busy_parents)
+      not_started = [] # pending tasks that could not be started
+      for task in pending:
+        if len(running) < self.config['transfer_workers'] and not path_conflicts(task.relative_path, busy, busy_parents):
+          running[self.event_loop.run_in_executor(self.transfer_executor, self.process_change, task)] = task
+        else:
+          not_started.append(task)
+        add_busy_path(task.relative_path, busy, busy_parents)
+      while self.queue and not sigint:
+        num_workers = self.config['transfer_workers']
+        try:
+          if self.queue.peek().priority == task_priorities.interactive:
+            num_workers += 1
+        except IndexError: # taken by the control server meanwhile
+          break
+        if len(running) >= num_workers:
+          break
+        task = self.take_task()
+        if not path_conflicts(task.relative_path, busy, busy_parents):
+          running[self.event_loop.run_in_executor(self.transfer_executor, self.process_change, task)] = task
+        else:
+          not_started.append(task)
+        add_busy_path(task.relative_path, busy, busy_parents)
+      pending = not_started
+      
+      self.queued_event.clear()
+      queued = asyncio.ensure_future(self.queued_event.wait())
+      done, not_done = await asyncio.wait(list(running) + [queued], timeout = min_sleep, 
+                                          return_when = asyncio.FIRST_COMPLETED)
+      queued.cancel()
+      finished = [future for future in done if future in running]
+      for future in finished:
+        del running[future]
+        future.result() # raise exceptions of the task
+      if finished: # make tracking changes durable
+        await self.event_loop.run_in_executor(None, self.files.commit)
+        await self.event_loop.run_in_executor(None, self.hashes.commit)
   
 # main    
 if __name__ == "__main__":
   logger.trace("__main__()")
   signal.signal(signal.SIGINT, sigint_handler)
+  signal.signal(signal.SIGTERM, sigint_handler)
   # not needed, b/c syncfiledata.equal_without_atime() only uses the int part b/c remote fs only report int values
-  os.stat_float_times(True) 
+  if hasattr(os, 'stat_float_times'): # removed in python 3.7, where float times are always used
+    os.stat_float_times(True) 
   
   config = merge_two_dicts(parse_command_line(), get_default_config()) # cmd line first to overwrite default settings 
+  if config['daemon']: # before any thread is started
+    daemonize(os.path.join(config['local'], relative_backup_dir, log_file))
   sync = lazysync(config)
-  sync.loop()
+  if config['engine'] == 'asyncio':
+    asyncio.run(sync.run_async())
+  else:
+    sync.loop()
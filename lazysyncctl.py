@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse, os, sys, json, socket
+
+# same defaults as in lazysync.py, which is not imported to not set up its logging
+relative_backup_dir = '.lazysync'
+socket_file = 'socket'
+
+# send one request to the control socket at path and return the response
+def request(path, request):
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(path)
+    connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    response = b''
+    while not response.endswith(b'\n'):
+      data = connection.recv(65536)
+      if not data:
+        break
+      response += data
+  finally:
+    connection.close()
+  return json.loads(response.decode('utf-8'))
+
+#
+def print_status(status):
+  print("remote: %s" % status['remote'])
+  print("local: %s (%s)" % (status['local'], 'lazy' if status['lazy'] else 'not lazy'))
+  print("tracked paths: %d" % status['tracked_paths'])
+  print("queued tasks: %d %s" % (status['queued_tasks'], ' '.join('%s=%d' % item for item in
+                                                                   sorted(status['queued_tasks_by_priority'].items()))))
+  for transfer in status['transfers']:
+    print("%s: %s %d of %d bytes (%.0f%%)%s" % (transfer['direction'], transfer['path'], transfer['copied'],
+          transfer['size'], 100.0 * transfer['copied'] / transfer['size'] if transfer['size'] > 0 else 100,
+          ', delta transfer, %d bytes transferred' % transfer['transferred'] if 'transferred' in transfer else ''))
+  print("scans: %d, next scan in %.1fs%s" % (status['scans'], status['next_scan_in'],
+        ', requested rescans: %s' % ' '.join(status['rescans']) if status['rescans'] else ''))
+  if status['prefetch_hit_rate'] is not None:
+    print("prefetch hit rate: %.2f" % status['prefetch_hit_rate'])
+
+# main
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = 'Controls a running lazysync')
+  parser.add_argument('-l', '--local', metavar = 'LC', help = 'Path where the local data of lazysync is located')
+  parser.add_argument('-s', '--socket', metavar = 'PATH', help = 'Path of the control socket of lazysync (default: %s '
+                      'in the local folder)' % os.path.join(relative_backup_dir, socket_file))
+  subparsers = parser.add_subparsers(dest = 'command')
+  subparsers.add_parser('status', help = 'Show the queued tasks and the progress of running transfers')
+  rescan_parser = subparsers.add_parser('rescan', help = 'Scan a folder (or everything) for changes now')
+  rescan_parser.add_argument('path', nargs = '?', help = 'Path inside remote or local, or relative path')
+  prefetch_parser = subparsers.add_parser('prefetch', help = 'Download symlinked files before they are used')
+  prefetch_parser.add_argument('pattern', help = 'Path or pattern like in .gitignore (e.g. photos/2017, **/*.pdf) '
+                               'inside remote or local, or relative; files in matching folders are downloaded, too')
+  subparsers.add_parser('metrics', help = 'Show the metrics in the text format of prometheus')
+  subparsers.add_parser('stop', help = 'Stop lazysync after the running tasks')
+  args = parser.parse_args()
+  if not args.command:
+    parser.error("a command is required")
+  if not args.socket and not args.local:
+    parser.error("either -l or -s is required")
+
+  path = os.path.abspath(args.socket) if args.socket else os.path.join(os.path.abspath(args.local), relative_backup_dir,
+                                                                        socket_file)
+  message = {'command': args.command}
+  if args.command == 'rescan' and args.path:
+    message['path'] = os.path.abspath(args.path) if os.path.isabs(args.path) or os.path.exists(args.path) else args.path
+  elif args.command == 'prefetch':
+    message['pattern'] = args.pattern
+  try:
+    response = request(path, message)
+  except (OSError, socket.error) as e:
+    sys.exit("cannot connect to lazysync at '%s': %s" % (path, e))
+
+  if 'error' in response:
+    sys.exit("error: %s" % response['error'])
+  elif args.command == 'status':
+    print_status(response)
+  elif args.command == 'rescan':
+    print("rescan of '%s' requested" % response['rescan'])
+  elif args.command == 'prefetch':
+    print("prefetch of %d files (%d bytes) requested" % (response['files'], response['bytes']))
+  elif args.command == 'metrics':
+    sys.stdout.write(response['metrics'])
+  elif args.command == 'stop':
+    print("stop requested")
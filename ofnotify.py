@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 
 from collections import deque # implements atomic append() and popleft() that do not require locking
-import psutil, time, threading, enum # enum is enum34
+import os, time, timeit, threading, errno, enum
+import asyncio
+try:
+  import psutil # only needed if /proc/<pid>/fd is not available
+except ImportError:
+  psutil = None
 
 #
 event_types = enum.Enum('event_types', 'open close')
-default_sleep_time = 0.7
+default_min_sleep_time = 0.2 # seconds, while files are opened or open
+default_max_sleep_time = 0.7 # seconds, when idle; like the fixed sleep time before, so that no short access is missed
+default_sleep_time = default_max_sleep_time # the name of the fixed sleep time before
 
 # 
 class event:
@@ -20,70 +27,190 @@ class event_processor:
   def process_ofnotify_event(self, event):
     pass
 
+# polling interval that is reset to min_interval on activity and multiplied by factor up to max_interval when idle
+class adaptive_interval:
+  #
+  def __init__(self, min_interval, max_interval, factor = 2):
+    self.min_interval = min_interval
+    self.max_interval = max(min_interval, max_interval)
+    self.factor = factor
+    self.interval = min_interval
+
+  #
+  def reset(self):
+    self.interval = self.min_interval
+
+  #
+  def backoff(self):
+    self.interval = min(self.max_interval, self.interval * self.factor)
+
+  # reset or back off and return the interval until the next poll
+  def update(self, active):
+    if active:
+      self.reset()
+    else:
+      self.backoff()
+    return self.interval
+
+# finds open files below watch_paths by reading the links in /proc/<pid>/fd directly, without stat'ing the files; pids
+# whose fds cannot be read are remembered and skipped until they exit; a pid without open watched files is only scanned
+# again if its i/o counters in /proc/<pid>/io or the size of its address space in /proc/<pid>/statm changed, b/c it 
+# cannot have read or mapped a newly opened file otherwise; pids whose counters cannot be read are always scanned
+class procfs_scanner:
+  #
+  def __init__(self, watch_paths, proc_path = '/proc'):
+    self.watch_paths = tuple(watch_paths)
+    self.proc_path = proc_path
+    self.denied_pids = set()
+    self.pids = {} # pid -> (counters, set of open watched paths)
+    self.num_scanned = 0 # number of pids whose fds were read in the last scan
+
+  # return the contents of /proc/<pid>/io and the size of the address space in /proc/<pid>/statm, or None if they cannot 
+  # be read (e.g. without i/o accounting in the kernel); a mapped file is read without changing the i/o counters, but 
+  # mapping it changes the size
+  def _read_counters(self, pid):
+    try:
+      with open(os.path.join(self.proc_path, pid, 'io'), 'rb') as f:
+        io = f.read()
+      with open(os.path.join(self.proc_path, pid, 'statm'), 'rb') as f:
+        return io, f.read().split()[0]
+    except (IOError, OSError, IndexError):
+      return None
+
+  # return the set of open watched paths of pid; raises OSError if the fds cannot be read
+  def _read_open_paths(self, pid):
+    fd_path = os.path.join(self.proc_path, pid, 'fd')
+    paths = set()
+    for fd in os.listdir(fd_path):
+      try:
+        target = os.readlink(os.path.join(fd_path, fd))
+      except OSError: # fd was closed meanwhile
+        continue
+      if target.startswith(self.watch_paths): # also filters sockets, pipes, etc. without any further syscall
+        paths.add(target)
+    return paths
+
+  # return the set of (pid, path) of all open watched paths
+  def open_files(self):
+    open_files = set()
+    new_pids = {}
+    own_pid = str(os.getpid()) # own accesses (e.g. copying) are no events
+    current_pids = set(pid for pid in os.listdir(self.proc_path) if pid.isdigit() and pid != own_pid)
+    self.denied_pids &= current_pids # forget pids that exited, b/c they can be reused
+    self.num_scanned = 0
+    for pid in current_pids - self.denied_pids:
+      counters = self._read_counters(pid)
+      cached = self.pids.get(pid)
+      # pids with open watched files are always scanned, to not miss a close without further i/o, and so are pids 
+      # without counters
+      if counters is not None and cached is not None and cached[0] == counters and not cached[1]:
+        paths = cached[1]
+      else:
+        try:
+          paths = self._read_open_paths(pid)
+          self.num_scanned += 1
+        except OSError as e:
+          if e.errno in (errno.EACCES, errno.EPERM):
+            self.denied_pids.add(pid)
+          continue # or the process exited
+      new_pids[pid] = (counters, paths)
+      for path in paths:
+        open_files.add((pid, path))
+    self.pids = new_pids
+    return open_files
+
 #
 class notifier:
   #
-  def __init__(self, event_processor, watch_paths, sleep_time = default_sleep_time):
+  def __init__(self, event_processor, watch_paths, min_sleep_time = default_min_sleep_time, 
+               max_sleep_time = default_max_sleep_time):
     self.event_processor = event_processor
     self.watch_paths = watch_paths
-    self.sleep_time = sleep_time
+    self.sleep_time = adaptive_interval(min_sleep_time, max_sleep_time)
     self.queue = deque()
     self.tracked_files = set()
+    self.scanner = procfs_scanner(watch_paths) if os.path.isdir('/proc/self/fd') else None
+    self.num_scans = 0
+    self.scan_time = 0.0 # seconds spent in all scans
+    self.num_pids_scanned = 0 # number of pids whose open files were read in all scans
 
-  #
-  def _find_changes(self):
-    # find all currently open files
-    new_tracked_files = set()
+  # return the set of (pid, path) of all open files in watch_paths, with psutil if /proc is not available
+  def _open_files(self):
+    if self.scanner is not None:
+      open_files = self.scanner.open_files()
+      self.num_pids_scanned += self.scanner.num_scanned
+      return open_files
+
+    open_files = set()
     for pid in psutil.pids():
+      if pid == os.getpid(): # own accesses (e.g. copying) are no events
+        continue
+      self.num_pids_scanned += 1
       try:
         current_pid = psutil.Process(pid) # inside try-except to catch psutil.NoSuchProcess
         for open_file in current_pid.open_files(): # catch psutil.AccessDenied
           for watch_path in self.watch_paths:
             if open_file.path.startswith(watch_path):
-              new_tracked_files.add(open_file)
+              open_files.add((pid, open_file.path))
       except (psutil.NoSuchProcess, psutil.AccessDenied):
         pass
       except:
         raise
+    return open_files
+
+  #
+  def _find_changes(self):
+    # find all currently open files
+    start_time = timeit.default_timer()
+    new_tracked_files = self._open_files()
+    self.scan_time += timeit.default_timer() - start_time
+    self.num_scans += 1
       
     # create open events for newly opened files
     opened_files = new_tracked_files - self.tracked_files
-    for opened_file in opened_files:
-      self.queue.append(event(open_file.path, event_types.open))
+    for pid, path in opened_files:
+      self.queue.append(event(path, event_types.open))
       
     # create close events for closed files
     closed_files = self.tracked_files - new_tracked_files
-    for closed_file in closed_files:
-      self.queue.append(event(closed_file.path, event_types.close))
+    for pid, path in closed_files:
+      self.queue.append(event(path, event_types.close))
     
     self.tracked_files = new_tracked_files # update
+
+  # return the time to sleep until the next scan: short while files are opened or open, longer the longer it is idle
+  def _next_sleep_time(self):
+    return self.sleep_time.update(bool(self.queue) or bool(self.tracked_files))
   
   #
   def loop(self):
     while 1:
       try:
         self._find_changes()
+        sleep_time = self._next_sleep_time()
         while self.queue:
           self.event_processor.process_ofnotify_event(self.queue.popleft())
-        time.sleep(self.sleep_time)
+        time.sleep(sleep_time)
       except KeyboardInterrupt:
         break
   
 #
 class threaded_notifier(threading.Thread, notifier):
   #
-  def __init__(self, event_processor, watch_paths, sleep_time = default_sleep_time):
+  def __init__(self, event_processor, watch_paths, min_sleep_time = default_min_sleep_time, 
+               max_sleep_time = default_max_sleep_time):
     threading.Thread.__init__(self) # initialize threading base class
     self._stop_event = threading.Event() # stop condition
-    notifier.__init__(self, event_processor, watch_paths, sleep_time) # initialize notifier base class
+    notifier.__init__(self, event_processor, watch_paths, min_sleep_time, max_sleep_time) # initialize notifier base class
   
   #
   def loop(self):
     while not self._stop_event.is_set():
       self._find_changes()
+      sleep_time = self._next_sleep_time()
       while self.queue:
         self.event_processor.process_ofnotify_event(self.queue.popleft())
-      time.sleep(self.sleep_time)
+      self._stop_event.wait(sleep_time) # returns early on stop()
   
   #
   def stop(self):
@@ -93,3 +220,33 @@ class threaded_notifier(threading.Thread, notifier):
   #
   def run(self):
     self.loop()
+
+# notifier for an asyncio event loop: open files are found in an executor, b/c reading them blocks, and the events are 
+# processed in the event loop
+class asyncio_notifier(notifier):
+  #
+  def __init__(self, event_processor, watch_paths, min_sleep_time = default_min_sleep_time, 
+               max_sleep_time = default_max_sleep_time):
+    notifier.__init__(self, event_processor, watch_paths, min_sleep_time, max_sleep_time)
+    self._stopped = False
+    self._stop_event = None # created by run(), b/c it belongs to the event loop
+
+  # coroutine that runs until stop() is called
+  async def run(self, executor = None):
+    loop = asyncio.get_event_loop()
+    self._stop_event = asyncio.Event()
+    while not self._stopped:
+      await loop.run_in_executor(executor, self._find_changes)
+      sleep_time = self._next_sleep_time()
+      while self.queue:
+        self.event_processor.process_ofnotify_event(self.queue.popleft())
+      try:
+        await asyncio.wait_for(self._stop_event.wait(), sleep_time) # returns early on stop()
+      except asyncio.TimeoutError:
+        pass
+
+  # must be called in the event loop
+  def stop(self):
+    self._stopped = True
+    if self._stop_event is not None:
+      self._stop_event.set()
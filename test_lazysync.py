@@ -0,0 +1,885 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import unittest, os, re, shutil, tempfile, threading, logging, random, time, timeit, asyncio, subprocess
+import lazysync, lazysyncctl, ofnotify
+
+lazysync.logger.setLevel(logging.WARNING)
+
+# a lazysync on new temporary folders remote and local; the notifier is not started
+class synctestcase(unittest.TestCase):
+  #
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix = 'lazysync-test-')
+    self.remote = os.path.join(self.root, 'remote')
+    self.local = os.path.join(self.root, 'local')
+    os.makedirs(self.remote)
+    os.makedirs(self.local)
+    self.syncs = []
+    lazysync.sigint = False
+
+  #
+  def tearDown(self):
+    lazysync.sigint = False
+    for sync in self.syncs:
+      sync.files.close()
+      sync.transfer_executor.shutdown()
+    shutil.rmtree(self.root)
+
+  # return a new lazysync on remote and local with config on top of the default config
+  def new_sync(self, lazy = False, **config):
+    config.update({'remote': self.remote, 'local': self.local, 'lazy': lazy})
+    sync = lazysync.lazysync(lazysync.merge_two_dicts(config, lazysync.get_default_config()))
+    if lazy and config.get('engine') != 'asyncio': # the asyncio notifier is only started by run_async()
+      sync.notifier.stop()
+    self.syncs.append(sync)
+    return sync
+
+  # write contents to the file at path, creating its folders
+  def write(self, path, contents = 'x'):
+    lazysync.make_sure_path_exists(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(contents)
+
+  # process all queued tasks
+  def drain(self, sync):
+    while sync.queue:
+      sync.process_next_change()
+
+  # run function in a thread and fail if it does not return within timeout seconds
+  def assert_returns(self, function, timeout = 10):
+    thread = threading.Thread(target = function)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    self.assertFalse(thread.is_alive(), "%s() did not return within %ds" % (function.__name__, timeout))
+
+#
+class test_syncqueue(unittest.TestCase):
+  #
+  def test_priority_order(self):
+    queue = lazysync.syncqueue(aging = 60)
+    for relative_path, priority in [('a', 'bulk'), ('b', 'small'), ('c', 'interactive'), ('d', 'upload')]:
+      queue.append(lazysync.synctask(relative_path, None, lazysync.task_priorities[priority]))
+    self.assertEqual([task.relative_path for task in queue], ['c', 'd', 'b', 'a'])
+    self.assertEqual([queue.popleft().relative_path for i in range(4)], ['c', 'd', 'b', 'a'])
+    self.assertFalse(queue)
+
+  # a task on a path inside a folder is not taken before a task on the folder that was queued before it
+  def test_related_tasks_keep_order(self):
+    queue = lazysync.syncqueue(aging = 60)
+    queue.append(lazysync.synctask('folder', None, lazysync.task_priorities.bulk))
+    queue.append(lazysync.synctask('folder/file', None, lazysync.task_priorities.interactive))
+    queue.append(lazysync.synctask('other', None, lazysync.task_priorities.small))
+    self.assertEqual([queue.popleft().relative_path for i in range(3)], ['folder', 'folder/file', 'other'])
+
+  # an upgraded task is taken by its new priority, and listed and counted once
+  def test_upgrade(self):
+    queue = lazysync.syncqueue(aging = 60)
+    queue.append(lazysync.synctask('a', 'cp', lazysync.task_priorities.small))
+    queue.append(lazysync.synctask('b', 'cp', lazysync.task_priorities.bulk))
+    self.assertTrue(queue.upgrade('b', 'cp', lazysync.task_priorities.interactive))
+    self.assertFalse(queue.upgrade('b', 'rm', lazysync.task_priorities.interactive))
+    self.assertFalse(queue.upgrade('c', 'cp', lazysync.task_priorities.interactive))
+    self.assertEqual([task.relative_path for task in queue], ['b', 'a'])
+    self.assertEqual(queue.num_by_priority[lazysync.task_priorities.bulk], 0)
+    self.assertEqual([queue.popleft().relative_path for i in range(2)], ['b', 'a'])
+    self.assertFalse(queue)
+
+  # a requeued task is listed and taken once, in its old order
+  def test_requeue(self):
+    queue = lazysync.syncqueue(aging = 60)
+    queue.append(lazysync.synctask('a', None, lazysync.task_priorities.bulk))
+    queue.append(lazysync.synctask('b', None, lazysync.task_priorities.interactive))
+    task = queue.popleft()
+    queue.requeue(task)
+    self.assertEqual(len(queue), 2)
+    self.assertEqual([task.relative_path for task in queue], ['b', 'a'])
+    self.assertEqual([queue.popleft().relative_path for i in range(2)], ['b', 'a'])
+    self.assertFalse(queue)
+    self.assertRaises(IndexError, queue.popleft)
+
+#
+class test_process_changes(synctestcase):
+  # on ctrl-c, process_changes() returns without taking queued tasks, which stay queued
+  def test_sigint_with_queued_task(self):
+    sync = self.new_sync(transfer_workers = 2)
+    sync.queue_task('file', sync.syncactions.cp_local)
+    lazysync.sigint = True
+    self.assert_returns(sync.process_changes)
+    self.assertIn('file', sync.queue)
+
+  #
+  def test_processes_all_tasks(self):
+    for i in range(10):
+      self.write(os.path.join(self.local, 'folder', 'file%d' % i), str(i))
+    sync = self.new_sync(transfer_workers = 4)
+    sync.find_changes()
+    sync.process_changes()
+    self.assertFalse(sync.queue)
+    for i in range(10):
+      with open(os.path.join(self.remote, 'folder', 'file%d' % i)) as f:
+        self.assertEqual(f.read(), str(i))
+
+  # a task taken from the queue is pending until it is released, also while it waits for a worker, so that scans do 
+  # not queue tasks on its path or inside it
+  def test_taken_task_is_pending(self):
+    sync = self.new_sync()
+    since = timeit.default_timer()
+    sync.queue_task('folder', sync.syncactions.rm_remote)
+    task = sync.take_task()
+    self.assertNotIn('folder', sync.queue)
+    self.assertTrue(sync.task_pending('folder', since))
+    self.assertTrue(sync.task_pending('folder/file', since))
+    sync.release_task(task, requeue = True)
+    self.assertIn('folder', sync.queue)
+    self.assertFalse(sync.running_paths)
+    sync.release_task(sync.take_task())
+    self.assertFalse(sync.running_paths)
+    self.assertTrue(sync.task_pending('folder/file', since)) # finished after since
+
+  # an exception in loop() stops the control server and closes the index, so that the process can exit
+  def test_loop_shuts_down_on_exception(self):
+    sync = self.new_sync()
+    def find_changes(subtree = None):
+      raise RuntimeError('scan failed')
+    sync.find_changes = find_changes
+    self.assertRaises(RuntimeError, sync.loop)
+    self.assertFalse(os.path.exists(os.path.join(self.local, lazysync.relative_backup_dir, lazysync.socket_file)))
+    self.assertIsNone(sync.files.connection)
+    self.assertFalse(any(thread.is_alive() and not thread.daemon for thread in threading.enumerate() 
+                         if thread is not threading.current_thread()))
+
+
+# the asyncio engine (-E asyncio)
+class test_asyncio_engine(synctestcase):
+  # wait until condition() is true, or fail after timeout seconds
+  def wait_for(self, condition, timeout = 10):
+    deadline = time.time() + timeout
+    while not condition():
+      self.assertLess(time.time(), deadline, "%s was not true within %ds" % (condition.__name__, timeout))
+      time.sleep(0.05)
+
+  # run_async() links new remote files, uploads new local files, downloads a symlink after another process closed it 
+  # (found by the asyncio notifier, which ignores this process) and returns on ctrl-c
+  def test_lazy_sync(self):
+    self.write(os.path.join(self.remote, 'folder', 'remote_file'), 'remote')
+    self.write(os.path.join(self.local, 'local_file'), 'local')
+    sync = self.new_sync(True, engine = 'asyncio', min_interval = 0.1, max_interval = 0.2)
+    thread = threading.Thread(target = asyncio.run, args = (sync.run_async(),))
+    thread.daemon = True
+    thread.start()
+    path_local = os.path.join(self.local, 'folder', 'remote_file')
+    try:
+      self.wait_for(lambda: os.path.islink(path_local))
+      self.wait_for(lambda: os.path.isfile(os.path.join(self.remote, 'local_file')))
+      with open(path_local) as f:
+        opener = subprocess.Popen(['sleep', '10'], stdin = f)
+      try:
+        self.wait_for(lambda: sync.notifier.tracked_files)
+      finally:
+        opener.kill()
+        opener.wait()
+      self.wait_for(lambda: not os.path.islink(path_local))
+      with open(path_local) as f:
+        self.assertEqual(f.read(), 'remote')
+    finally:
+      lazysync.sigint = True
+      sync.wake()
+      thread.join(10)
+    self.assertFalse(thread.is_alive())
+    self.assertIsNone(sync.files.connection)
+
+
+# prefetching in lazy mode
+class test_prefetch(synctestcase):
+  #
+  def setUp(self):
+    synctestcase.setUp(self)
+    for i in range(5):
+      self.write(os.path.join(self.remote, 'folder', 'file%d' % i), str(i))
+    self.sync = self.new_sync(lazy = True, prefetch_count = 2)
+    self.sync.find_changes()
+    self.drain(self.sync)
+
+  # simulate an access of the symlinked file relative_path
+  def access(self, relative_path):
+    self.sync.process_ofnotify_event(ofnotify.event(os.path.join(self.remote, relative_path), 
+                                                    ofnotify.event_types.close))
+
+  #
+  def queued(self):
+    return [(task.relative_path, task.priority.name) for task in self.sync.queue]
+
+  # an access of a file whose prefetch is queued makes the prefetch interactive
+  def test_access_of_queued_prefetch(self):
+    self.access('folder/file0')
+    self.assertEqual(self.queued(), [('folder/file0', 'interactive'), ('folder/file1', 'bulk'), 
+                                     ('folder/file2', 'bulk')])
+    self.access('folder/file2')
+    self.assertEqual(self.queued()[:2], [('folder/file0', 'interactive'), ('folder/file2', 'interactive')])
+    self.assertEqual(sorted(path for path, priority in self.queued()), ['folder/file%d' % i for i in range(5)])
+    self.drain(self.sync)
+    for i in range(5):
+      self.assertFalse(os.path.islink(os.path.join(self.local, 'folder', 'file%d' % i)))
+
+  # an access of a prefetched file that was turned back into a symlink downloads it again
+  def test_access_after_relink(self):
+    self.access('folder/file0')
+    self.drain(self.sync)
+    self.assertIn('folder/file1', self.sync.prefetcher.prefetched)
+    self.sync.config['lazy'] = True
+    self.sync.action_ln_remote('folder/file1')
+    self.assertTrue(os.path.islink(os.path.join(self.local, 'folder', 'file1')))
+    self.assertNotIn('folder/file1', self.sync.prefetcher.prefetched)
+    self.access('folder/file1')
+    self.assertEqual(self.queued()[0], ('folder/file1', 'interactive'))
+    self.drain(self.sync)
+    self.assertFalse(os.path.islink(os.path.join(self.local, 'folder', 'file1')))
+
+
+#
+class test_ofnotify(unittest.TestCase):
+  # the idle interval of the notifier is at most the fixed sleep time before, unless a larger maximum is given
+  def test_default_interval(self):
+    interval = ofnotify.adaptive_interval(ofnotify.default_min_sleep_time, ofnotify.default_max_sleep_time)
+    self.assertEqual([interval.update(False) for i in range(3)], [0.4, 0.7, 0.7])
+    self.assertEqual(interval.update(True), ofnotify.default_min_sleep_time)
+    self.assertEqual(ofnotify.default_sleep_time, 0.7)
+
+  # write the file name in the folder of pid in the fake /proc at proc_path
+  def write_proc(self, proc_path, pid, name, contents):
+    with open(os.path.join(proc_path, pid, name), 'w') as f:
+      f.write(contents)
+
+  # a pid without open watched files is only scanned again if its counters changed, or if they cannot be read
+  def test_procfs_scanner_counters(self):
+    root = tempfile.mkdtemp(prefix = 'lazysync-test-')
+    self.addCleanup(shutil.rmtree, root)
+    proc_path = os.path.join(root, 'proc')
+    watched = os.path.join(root, 'watched') + os.sep
+    for pid in ['4000000001', '4000000002']:
+      os.makedirs(os.path.join(proc_path, pid, 'fd'))
+      self.write_proc(proc_path, pid, 'statm', '100 50 20 5 0 30 0\n')
+      os.symlink(os.path.join(root, 'other'), os.path.join(proc_path, pid, 'fd', '3'))
+    self.write_proc(proc_path, '4000000001', 'io', 'rchar: 1\n')
+    scanner = ofnotify.procfs_scanner([watched], proc_path)
+    self.assertEqual(scanner.open_files(), set())
+    self.assertEqual(scanner.num_scanned, 2)
+    self.assertEqual(scanner.open_files(), set())
+    self.assertEqual(scanner.num_scanned, 1) # 4000000002 has no /proc/<pid>/io
+    for pid in ['4000000001', '4000000002']:
+      os.symlink(watched + pid, os.path.join(proc_path, pid, 'fd', '4'))
+    self.assertEqual(scanner.open_files(), set([('4000000002', watched + '4000000002')]))
+    self.write_proc(proc_path, '4000000001', 'statm', '200 50 20 5 0 30 0\n') # mapped the file
+    self.assertEqual(scanner.open_files(), set([('4000000001', watched + '4000000001'), 
+                                                ('4000000002', watched + '4000000002')]))
+
+
+# state that is kept across restarts
+class test_persistence(synctestcase):
+  # return a dict relative path -> tracked values of remote and local
+  def tracked(self, sync):
+    pairs = dict((relative_path, sync.files[relative_path]) for relative_path in sync.files)
+    return dict((relative_path, (pair.syncfiledata_remote.values(), pair.syncfiledata_local.values())) 
+                for relative_path, pair in pairs.items())
+
+  # the tracked paths are loaded on start, so that a restart does not sync anything again
+  def test_index(self):
+    for i in range(3):
+      self.write(os.path.join(self.local, 'folder', 'file%d' % i), str(i))
+    sync = self.new_sync()
+    sync.find_changes()
+    self.drain(sync)
+    tracked = self.tracked(sync)
+    sync.shutdown(None)
+    sync = self.new_sync()
+    self.assertEqual(self.tracked(sync), tracked)
+    sync.find_changes()
+    self.assertFalse(sync.queue)
+
+  # all values of a syncfilepair, including device, inode and mode, are kept in memory and in the database
+  def test_record_round_trip(self):
+    path = os.path.join(self.root, 'index')
+    remote_data = lazysync.syncfiledata(self.remote)
+    local_data = lazysync.syncfiledata.from_values(False, True, False, 1.5e9, 1.25e9, 123) # device, inode, mode unknown
+    index = lazysync.syncindex(path)
+    index.open()
+    index['path'] = lazysync.syncfilepair(remote_data, local_data)
+    index.close()
+    for index in [index, lazysync.syncindex(path)]:
+      index.open()
+      pair = index['path']
+      self.assertEqual(pair.syncfiledata_remote.values(), remote_data.values())
+      self.assertEqual(pair.syncfiledata_local.values(), local_data.values())
+      self.assertEqual(index.remote_data('path').values(), remote_data.values())
+      index.close()
+
+  # backup files are recorded in the journal, which is replayed on start and saved into the data every 
+  # journal_compaction_interval records
+  def test_journal(self):
+    self.addCleanup(setattr, lazysync, 'journal_compaction_interval', lazysync.journal_compaction_interval)
+    lazysync.journal_compaction_interval = 3
+    for i in range(4):
+      self.write(os.path.join(self.local, 'file%d' % i), str(i))
+    sync = self.new_sync()
+    sync.find_changes()
+    self.drain(sync)
+    journal_path = os.path.join(self.remote, lazysync.relative_backup_dir, lazysync.journal_file)
+    for i in range(4):
+      os.remove(os.path.join(self.local, 'file%d' % i))
+      sync.find_changes()
+      self.drain(sync)
+      self.assertEqual(len(lazysync.read_file_contents(journal_path).splitlines()), (i + 1) % 3)
+    sync.shutdown(None)
+    with open(journal_path, 'a') as f:
+      f.write('["add", "incomplete') # of a crash while appending
+    sync = self.new_sync()
+    for i in range(4):
+      versions = sync.remote_backup_files[os.path.join(self.remote, 'file%d' % i)]
+      self.assertEqual(len(versions), 1)
+      self.assertEqual(lazysync.read_file_contents(versions[0].path), str(i))
+
+
+# the backups of removed and replaced files
+class test_backups(synctestcase):
+  # remove the local files at relative_paths, which have the same contents, and return their backed up versions
+  def remove_local(self, sync, relative_paths, contents = 'same'):
+    versions = []
+    for relative_path in relative_paths:
+      self.write(os.path.join(self.local, relative_path), contents)
+      sync.action_rm_local(relative_path)
+      self.assertFalse(os.path.exists(os.path.join(self.local, relative_path)))
+      versions.append(sync.get_last_backup_file_data(os.path.join(self.local, relative_path)))
+    return versions
+
+  # identical versions are backed up once, and the backup file is removed with the last version using it
+  def test_content_addressed(self):
+    sync = self.new_sync()
+    versions = self.remove_local(sync, ['a', 'b', 'a'])
+    other = self.remove_local(sync, ['c'], 'other')[0]
+    self.assertEqual(set(version.path for version in versions), set([versions[0].path]))
+    self.assertEqual(versions[0].content_hash, lazysync.hashlib.sha256(b'same').hexdigest())
+    self.assertNotEqual(other.path, versions[0].path)
+    self.assertEqual(len(sync.local_backup_files[os.path.join(self.local, 'a')]), 2)
+    for version, relative_path in zip(versions, ['a', 'b', 'a']):
+      self.assertTrue(os.path.isfile(version.path))
+      sync.remove_backup_file(os.path.join(self.local, relative_path), version)
+    self.assertFalse(os.path.exists(versions[0].path))
+    self.assertEqual(lazysync.read_file_contents(other.path), 'other')
+
+  # on start, backup files without versions and versions without backup files are removed, also in the background
+  def test_reconcile(self):
+    for background_reconcile in [False, True]:
+      sync = self.new_sync()
+      kept, missing = self.remove_local(sync, ['kept', 'missing'], 'kept'), self.remove_local(sync, ['missing'], 'x')
+      sync.shutdown(None)
+      backup_dir = os.path.join(self.local, lazysync.relative_backup_dir)
+      orphan = os.path.join(backup_dir, 'orphan')
+      self.write(orphan)
+      os.remove(missing[0].path)
+      sync = self.new_sync(background_reconcile = background_reconcile)
+      if background_reconcile:
+        sync.reconcile_thread.join()
+      self.assertFalse(os.path.exists(orphan))
+      self.assertTrue(os.path.isfile(kept[0].path))
+      self.assertTrue(os.path.isfile(os.path.join(backup_dir, lazysync.data_file)))
+      self.assertEqual([version.path for version in sync.local_backup_files[os.path.join(self.local, 'missing')]], 
+                       [kept[1].path])
+      self.assertEqual(sync.backup_file_refs[kept[0].path], 2)
+      self.assertNotIn(missing[0].path, sync.backup_file_refs)
+      sync.shutdown(None)
+      shutil.rmtree(backup_dir)
+
+# the control socket of lazysyncctl
+class test_control(synctestcase):
+  #
+  def test_requests(self):
+    self.write(os.path.join(self.local, 'file'))
+    sync = self.new_sync()
+    sync.find_changes()
+    socket_path = sync.start_control_server()
+    self.addCleanup(sync.control_server.server_close)
+    self.addCleanup(sync.control_server.shutdown)
+    status = lazysyncctl.request(socket_path, {'command': 'status'})
+    self.assertEqual((status['local'], status['queued_tasks'], status['tracked_paths']), (self.local, 1, 0))
+    request = {'command': 'rescan', 'path': os.path.join(self.local, 'folder')}
+    self.assertEqual(lazysyncctl.request(socket_path, request), {'rescan': 'folder'})
+    self.assertEqual(list(sync.rescan_requests), ['folder'])
+    self.assertIn('error', lazysyncctl.request(socket_path, {'command': 'unknown'}))
+    self.assertEqual(lazysyncctl.request(socket_path, {'command': 'stop'}), {'stop': True})
+    self.assertTrue(lazysync.sigint)
+
+
+# detection of moved files
+class test_moves(synctestcase):
+  #
+  def read(self, path):
+    with open(path) as f:
+      return f.read()
+
+  #
+  def downloaded_files(self, sync):
+    return sync.metrics.values['lazysync_transfer_files_total'].get((('direction', 'download'),), 0)
+
+  # a symlink local -> remote moved locally is moved on remote, and pointed to the new remote path
+  def test_relink_moved_symlink(self):
+    self.write(os.path.join(self.remote, 'a', 'file'), 'contents')
+    sync = self.new_sync(lazy = True)
+    sync.find_changes()
+    self.drain(sync)
+    lazysync.make_sure_path_exists(os.path.join(self.local, 'b'))
+    os.rename(os.path.join(self.local, 'a', 'file'), os.path.join(self.local, 'b', 'file'))
+    sync.find_changes()
+    self.assertEqual(sorted((task.relative_path, task.action.name) for task in sync.queue), 
+                     [('b', 'cp_local'), ('b/file', 'mv_remote')])
+    self.drain(sync)
+    self.assertFalse(os.path.lexists(os.path.join(self.remote, 'a', 'file')))
+    self.assertEqual(self.read(os.path.join(self.remote, 'b', 'file')), 'contents')
+    self.assertEqual(os.readlink(os.path.join(self.local, 'b', 'file')), os.path.join(self.remote, 'b', 'file'))
+    self.assertEqual(self.downloaded_files(sync), 0)
+
+  # a file that changed on the other side after the scan found the move is copied instead of moved
+  def test_changed_source_is_copied(self):
+    self.write(os.path.join(self.local, 'x'), 'local')
+    sync = self.new_sync()
+    sync.find_changes()
+    self.drain(sync)
+    os.rename(os.path.join(self.local, 'x'), os.path.join(self.local, 'y'))
+    sync.find_changes()
+    self.assertEqual([(task.relative_path, task.action.name) for task in sync.queue], [('y', 'mv_remote')])
+    self.write(os.path.join(self.remote, 'x'), 'remote')
+    mtime = os.stat(os.path.join(self.remote, 'x')).st_mtime + 10
+    os.utime(os.path.join(self.remote, 'x'), (mtime, mtime))
+    self.drain(sync)
+    self.assertEqual(self.read(os.path.join(self.remote, 'y')), 'local')
+    self.assertEqual(self.read(os.path.join(self.remote, 'x')), 'remote')
+
+  # the folders files were moved out of are only removed by the next scan, after the files were moved
+  def test_parent_folders_removed_later(self):
+    for i in range(3):
+      self.write(os.path.join(self.local, 'a', 'sub', 'file%d' % i), str(i))
+    sync = self.new_sync()
+    sync.find_changes()
+    self.drain(sync)
+    shutil.move(os.path.join(self.local, 'a'), os.path.join(self.local, 'b'))
+    sync.find_changes()
+    self.assertEqual(sorted((task.relative_path, task.action.name) for task in sync.queue), 
+                     [('b', 'cp_local'), ('b/sub', 'cp_local')] + 
+                     [('b/sub/file%d' % i, 'mv_remote') for i in range(3)])
+    self.drain(sync)
+    for i in range(3):
+      self.assertEqual(self.read(os.path.join(self.remote, 'b', 'sub', 'file%d' % i)), str(i))
+    self.assertTrue(os.path.isdir(os.path.join(self.remote, 'a', 'sub')))
+    sync.find_changes()
+    self.drain(sync)
+    self.assertFalse(os.path.exists(os.path.join(self.remote, 'a')))
+    self.assertEqual([path for path, versions in sync.remote_backup_files.items() if versions], [])
+
+
+# eviction of local files in lazy mode
+class test_evict(synctestcase):
+  # an evicted file is replaced with a symlink through a temporary link that cannot collide with a file of the user
+  def test_evict_relinks(self):
+    self.write(os.path.join(self.remote, 'folder', 'file'), 'remote')
+    self.write(os.path.join(self.local, 'folder', 'file.lazysync-link'), 'user')
+    sync = self.new_sync(lazy = True, cache_size = 1)
+    sync.find_changes()
+    self.drain(sync)
+    path_local = os.path.join(self.local, 'folder', 'file')
+    sync.action_cp_remote('folder/file')
+    self.assertFalse(os.path.islink(path_local))
+    sync.evict_cache()
+    self.assertEqual(os.readlink(path_local), os.path.join(self.remote, 'folder', 'file'))
+    with open(os.path.join(self.local, 'folder', 'file.lazysync-link')) as f:
+      self.assertEqual(f.read(), 'user')
+    partial_dir = os.path.join(self.local, lazysync.relative_partial_dir)
+    self.assertEqual([name for name in os.listdir(partial_dir) if name.endswith('.link')], [])
+
+
+# copies of files in chunks
+class test_copy(unittest.TestCase):
+  #
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix = 'lazysync-test-')
+    size = 3 * lazysync.copy_chunk_size + 1000
+    self.contents = random.Random(1).getrandbits(8 * size).to_bytes(size, 'little')
+    self.path = os.path.join(self.root, 'file')
+    with open(self.path, 'wb') as f:
+      f.write(self.contents)
+    self.partial_path = os.path.join(self.root, 'partial', 'file')
+
+  #
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  # an interrupted copy of the same version is resumed after its last complete chunk
+  def test_resume(self):
+    lazysync.make_sure_path_exists(os.path.dirname(self.partial_path))
+    with open(self.partial_path, 'wb') as f:
+      f.write(self.contents[:lazysync.copy_chunk_size + 1000])
+    statinfo = os.stat(self.path)
+    with open(self.partial_path + '.source', 'wb') as f:
+      f.write(lazysync.jsonpickle.encode([statinfo.st_size, statinfo.st_mtime]).encode('utf-8'))
+    offsets = []
+    content_hash = lazysync.copy_file_resumable(self.path, self.partial_path, progress = offsets.append)
+    self.assertEqual(offsets[0], lazysync.copy_chunk_size)
+    self.assertEqual(content_hash, lazysync.hashlib.sha256(self.contents).hexdigest())
+    with open(self.partial_path, 'rb') as f:
+      self.assertEqual(f.read(), self.contents)
+    self.assertFalse(os.path.exists(self.partial_path + '.source'))
+
+  # reads of a file opened by shaped_backend are transferred, and a read at another offset is another operation
+  def test_shaped_reads(self):
+    backend = lazysync.shaped_backend(latency = 0.5)
+    operations = []
+    backend.delay = lambda num_operations = 1: operations.append(num_operations)
+    self.assertEqual(lazysync.hashcache(None).hash_file(self.path, backend = backend), 
+                     lazysync.hashlib.sha256(self.contents).hexdigest())
+    self.assertEqual(backend.transferred, len(self.contents))
+    self.assertEqual(len(operations), 2) # stat and open
+    with backend.open_read(self.path) as f:
+      f.seek(1000)
+      self.assertEqual(f.read(10), self.contents[1000:1010])
+    self.assertEqual(len(operations), 4)
+
+
+# the cache of content hashes
+class test_hashcache(synctestcase):
+  #
+  def setUp(self):
+    synctestcase.setUp(self)
+    self.hashes = lazysync.hashcache(os.path.join(self.root, 'hashes.db'))
+    self.hashes.open()
+    self.path = os.path.join(self.root, 'file')
+
+  #
+  def tearDown(self):
+    self.hashes.close()
+    synctestcase.tearDown(self)
+
+  # write contents to the file, with the given mtime, and return its hash computed with the cache
+  def hash_contents(self, contents, mtime, path = None):
+    self.write(path or self.path, contents)
+    os.utime(path or self.path, (mtime, mtime))
+    if path is not None:
+      os.replace(path, self.path)
+    return self.hashes.hash_file(self.path)
+
+  # the cached hash is only used for the same device, inode, size and mtime
+  def test_invalidation(self):
+    expected = dict((contents, lazysync.hashlib.sha256(contents.encode()).hexdigest()) 
+                    for contents in ['a', 'b', 'cc', 'dd'])
+    self.assertEqual(self.hash_contents('a', 1000000), expected['a'])
+    self.assertEqual(self.hash_contents('b', 2000000), expected['b']) # mtime changed
+    self.assertEqual(self.hash_contents('cc', 2000000), expected['cc']) # size changed
+    self.assertEqual(self.hash_contents('dd', 2000000, os.path.join(self.root, 'new')), expected['dd']) # inode changed
+    data = lazysync.syncfiledata(self.path)
+    self.assertEqual(self.hashes.get(data), expected['dd'])
+    for changed in [{'device': data.device + 1}, {'inode': data.inode + 1}, {'size': 3}, {'mtime': 2000001}]:
+      values = dict(zip(['is_dir', 'is_file', 'is_link', 'atime', 'mtime', 'size', 'device', 'inode', 'mode'], 
+                        data.values()))
+      values.update(changed)
+      self.assertIsNone(self.hashes.get(lazysync.syncfiledata.from_values(**values)), changed)
+
+# the ranges of delta transfers
+class test_delta_ranges(unittest.TestCase):
+  #
+  def setUp(self):
+    self.old = random.Random(2).getrandbits(8 * 300000).to_bytes(300000, 'little')
+
+  # return the file rebuilt from the delta of new against old, and the number of bytes copied from old
+  def rebuild(self, new, block_size = 4096):
+    signature = lazysync.blocksignature(block_size)
+    signature.update(self.old)
+    signature.finish()
+    read = lambda offset, size: new[offset:offset + size]
+    updated = []
+    parts = []
+    copied = 0
+    for delta in lazysync.delta_ranges(read, signature, updated.append):
+      if isinstance(delta, tuple):
+        parts.append(self.old[delta[0]:delta[0] + delta[1]])
+        copied += delta[1]
+      else:
+        parts.append(delta)
+    self.assertEqual(b''.join(updated), new)
+    return b''.join(parts), copied
+
+  # the delta of each edit rebuilds the new version, and the unchanged blocks are copied (the shorter last block only 
+  # at the end); with and without numpy
+  def test_round_trips(self):
+    old = self.old
+    edits = [('unchanged', old, len(old)), ('changed byte', old[:5000] + b'x' + old[5001:], len(old) - 4096), 
+             ('inserted bytes', old[:100000] + b'inserted' + old[100000:], len(old) - 4096), 
+             ('removed bytes', old[:100000] + old[100017:], len(old) - 2 * 4096), 
+             ('appended', old + b'appended', len(old) // 4096 * 4096), ('prepended', b'prepended' + old, len(old)), 
+             ('truncated', old[:123456], 123456 // 4096 * 4096), ('rewritten', old[::-1], 0), ('empty', b'', 0)]
+    for use_numpy in [False, True] if lazysync.numpy is not None else [False]:
+      saved_numpy = lazysync.numpy
+      if not use_numpy:
+        lazysync.numpy = None
+      try:
+        for name, new, min_copied in edits:
+          rebuilt, copied = self.rebuild(new)
+          self.assertEqual(rebuilt, new, "%s (numpy: %s)" % (name, use_numpy))
+          self.assertGreaterEqual(copied, min_copied, "%s (numpy: %s)" % (name, use_numpy))
+      finally:
+        lazysync.numpy = saved_numpy
+
+  # a signature is the same after it is stored and loaded
+  def test_signature_values(self):
+    signature = lazysync.blocksignature(4096)
+    signature.update(self.old)
+    loaded = lazysync.blocksignature.from_values(*signature.values())
+    self.assertEqual((loaded.size, list(loaded.weak), loaded.strong), 
+                     (signature.size, list(signature.weak), signature.strong))
+
+
+# delta transfers of uploads
+class test_delta(synctestcase):
+  #
+  def setUp(self):
+    synctestcase.setUp(self)
+    size = 2 * lazysync.delta_min_size
+    self.contents = random.Random(0).getrandbits(8 * size).to_bytes(size, 'little')
+    self.path_local = os.path.join(self.local, 'file')
+    self.path_remote = os.path.join(self.remote, 'file')
+    with open(self.path_local, 'wb') as f:
+      f.write(self.contents)
+    self.uploads = 0
+    self.sync = self.new_sync(delta = True, remote_server_side_copy = True)
+    self.sync.find_changes()
+    self.drain(self.sync)
+
+  # change the local file relative_path, with a new mtime in another second than before, and sync it
+  def upload(self, contents, relative_path = 'file'):
+    path_local = os.path.join(self.local, relative_path)
+    with open(path_local, 'wb') as f:
+      f.write(contents)
+    self.uploads += 1
+    mtime = os.stat(path_local).st_mtime + 10 * self.uploads
+    os.utime(path_local, (mtime, mtime))
+    self.sync.find_changes()
+    self.drain(self.sync)
+    with open(os.path.join(self.remote, relative_path), 'rb') as f:
+      self.assertEqual(f.read(), contents)
+
+  #
+  def uploaded_bytes(self):
+    return self.sync.metrics.values['lazysync_transfer_bytes_total'][(('direction', 'upload'),)]
+
+  #
+  def test_upload_changed_byte(self):
+    uploaded = self.uploaded_bytes()
+    self.upload(self.contents[:1000] + b'x' + self.contents[1001:])
+    self.assertLessEqual(self.uploaded_bytes() - uploaded, lazysync.delta_block_size(len(self.contents)))
+
+  # the signature of the old version is kept for other files with the same contents
+  def test_shared_signature(self):
+    self.upload(self.contents, 'copy')
+    self.upload(self.contents[:1000] + b'x' + self.contents[1001:])
+    uploaded = self.uploaded_bytes()
+    self.upload(self.contents[:2000] + b'x' + self.contents[2001:], 'copy')
+    self.assertLessEqual(self.uploaded_bytes() - uploaded, lazysync.delta_block_size(len(self.contents)))
+
+  # signatures that were not used for signature_max_age are removed on close
+  def test_compact_signatures(self):
+    hashes = self.sync.hashes
+    content_hash = hashes.hash_file(self.path_local)
+    self.assertIsNotNone(hashes.get_signature(content_hash))
+    hashes.connection.execute("UPDATE signatures SET used = ?", (time.time() - lazysync.signature_max_age - 1,))
+    hashes.compact_signatures()
+    self.assertIsNone(hashes.get_signature(content_hash))
+
+  # the metric counts the bytes that go over the link to remote
+  def test_transferred_bytes(self):
+    self.sync.remote_backend = lazysync.shaped_backend(server_side_copy = True)
+    uploaded = self.uploaded_bytes()
+    self.upload(self.contents[:1000] + b'x' + self.contents[1001:] + b'appended')
+    self.assertEqual(self.uploaded_bytes() - uploaded, self.sync.remote_backend.transferred)
+    self.assertLess(self.sync.remote_backend.transferred, len(self.contents))
+
+  # without server-side copies, the blocks copied from the old version would go over the network twice, so files are 
+  # copied completely
+  def test_no_server_side_copy(self):
+    self.sync.remote_backend = lazysync.shaped_backend()
+    uploaded = self.uploaded_bytes()
+    self.upload(self.contents[:1000] + b'x' + self.contents[1001:])
+    self.assertEqual(self.uploaded_bytes() - uploaded, len(self.contents))
+    self.assertNotIn('lazysync_transfer_delta_saved_bytes_total', self.sync.metrics.values)
+
+# rate limiting of transfers
+class test_tokenbucket(unittest.TestCase):
+  # interactive consumption does not wait, but only borrows tokens down to -capacity
+  def test_interactive(self):
+    bucket = lazysync.tokenbucket(1000, capacity = 100000)
+    start = timeit.default_timer()
+    bucket.consume(150000, interactive = True)
+    self.assertAlmostEqual(bucket.tokens, -50000, delta = 1000)
+    bucket.consume(150000, interactive = True)
+    self.assertAlmostEqual(bucket.tokens, -100000, delta = 1000)
+    self.assertLess(timeit.default_timer() - start, 1)
+
+  # background consumption waits until the tokens would have been available, also for tokens borrowed before
+  def test_background_waits(self):
+    bucket = lazysync.tokenbucket(1000000, capacity = 100000)
+    start = timeit.default_timer()
+    bucket.consume(100000)
+    self.assertLess(timeit.default_timer() - start, 0.05)
+    bucket.consume(100000)
+    self.assertGreaterEqual(timeit.default_timer() - start, 0.09)
+    bucket.consume(100000, interactive = True)
+    start = timeit.default_timer()
+    bucket.consume(100000)
+    self.assertGreaterEqual(timeit.default_timer() - start, 0.19)
+
+# the metrics in the text format of prometheus
+class test_metrics(unittest.TestCase):
+  # each metric has its help and type, each value its labels, and label values are escaped
+  def test_text(self):
+    metrics = lazysync.metrics([('requests_total', 'counter', 'Requests.'), ('size_bytes', 'gauge', 'Size.'), 
+                                ('duration_seconds', 'summary', 'Duration.')])
+    metrics.inc('requests_total', path = 'a\\b "c"\nd')
+    metrics.inc('requests_total', 2, path = 'a\\b "c"\nd')
+    metrics.set('size_bytes', 5)
+    metrics.observe('duration_seconds', 0.5, kind = 'x')
+    metrics.observe('duration_seconds', 1, kind = 'x')
+    self.assertEqual(metrics.text(), 
+                     '# HELP requests_total Requests.\n'
+                     '# TYPE requests_total counter\n'
+                     'requests_total{path="a\\\\b \\"c\\"\\nd"} 3.0\n'
+                     '# HELP size_bytes Size.\n'
+                     '# TYPE size_bytes gauge\n'
+                     'size_bytes 5.0\n'
+                     '# HELP duration_seconds Duration.\n'
+                     '# TYPE duration_seconds summary\n'
+                     'duration_seconds_count{kind="x"} 2\n'
+                     'duration_seconds_sum{kind="x"} 1.5\n')
+
+# the metrics of a sync
+class test_sync_metrics(synctestcase):
+  # every line of the metrics of a sync is a comment or a sample in the exposition format
+  def test_exposition_format(self):
+    self.write(os.path.join(self.local, 'file'))
+    sync = self.new_sync()
+    sync.find_changes()
+    self.drain(sync)
+    sample = re.compile(r'^[a-z_]+(\{[a-z_]+="(?:[^"\\]|\\.)*"(?:,[a-z_]+="(?:[^"\\]|\\.)*")*\})? \S+$')
+    lines = sync.metrics_text().splitlines()
+    self.assertIn('lazysync_transfer_files_total{direction="upload"} 1.0', lines)
+    for line in lines:
+      self.assertTrue(line.startswith('# HELP ') or line.startswith('# TYPE ') or sample.match(line), line)
+      if not line.startswith('#'):
+        float(line.rsplit(' ', 1)[1])
+
+# gitignore semantics of the ignore patterns
+class test_ignore(unittest.TestCase):
+  # a pattern with a '/' is anchored to the root, one without matches a name at any depth
+  def test_anchoring(self):
+    matcher = lazysync.ignore_matcher(['/build', 'doc/*.txt', 'tmp'])
+    self.assertTrue(matcher.ignored('build', True))
+    self.assertFalse(matcher.ignored('src/build', True))
+    self.assertTrue(matcher.ignored('doc/a.txt'))
+    self.assertFalse(matcher.ignored('src/doc/a.txt'))
+    self.assertFalse(matcher.ignored('doc/x/a.txt'))
+    self.assertTrue(matcher.ignored('tmp'))
+    self.assertTrue(matcher.ignored('src/deeper/tmp', True))
+
+  # '**' matches any number of folders, '*' and '?' do not match '/'
+  def test_wildcards(self):
+    matcher = lazysync.ignore_matcher(['a/**/b', 'logs/**', '*.o', 'c?'])
+    for relative_path in ['a/b', 'a/x/b', 'a/x/y/b', 'logs/x', 'logs/x/y', 'x.o', 'src/x.o', 'c1']:
+      self.assertTrue(matcher.ignored(relative_path), relative_path)
+    for relative_path in ['a/xb', 'b', 'logs', 'x.o.c', 'c/1', 'c12']:
+      self.assertFalse(matcher.ignored(relative_path), relative_path)
+
+  # a pattern ending with '/' only matches folders
+  def test_only_folders(self):
+    matcher = lazysync.ignore_matcher(['cache/'])
+    self.assertTrue(matcher.ignored('cache', True))
+    self.assertTrue(matcher.ignored('src/cache', True))
+    self.assertFalse(matcher.ignored('cache'))
+    self.assertEqual(matcher.filter(['cache', 'cache/file', 'src/cache/file']), {'cache'})
+
+  # the last matching pattern decides, and a '!' pattern does not include paths in an ignored folder again
+  def test_negation(self):
+    matcher = lazysync.ignore_matcher(['*.log', '!keep.log', 'build/', '!build/keep.log'])
+    self.assertTrue(matcher.ignored('a.log'))
+    self.assertFalse(matcher.ignored('keep.log'))
+    self.assertFalse(matcher.ignored('src/keep.log'))
+    self.assertEqual(matcher.filter(['a.log', 'keep.log', 'src/keep.log', 'build/keep.log', 'file']), 
+                     {'keep.log', 'src/keep.log', 'file'})
+    self.assertTrue(lazysync.ignore_matcher(['!keep.log', '*.log']).ignored('keep.log'))
+
+  # by default, only the .lazysync folder in the root is ignored
+  def test_default(self):
+    matcher = lazysync.ignore_matcher(lazysync.get_default_config()['ignore'])
+    self.assertTrue(matcher.ignored(lazysync.relative_backup_dir, True))
+    self.assertFalse(matcher.ignored(os.path.join('folder', lazysync.relative_backup_dir), True))
+
+# walking the synced folders
+class test_walk(synctestcase):
+  #
+  def setUp(self):
+    synctestcase.setUp(self)
+    for relative_path in ['a/file1', 'a/b/file2', 'c/file3', 'file4']:
+      self.write(os.path.join(self.remote, relative_path))
+
+  # set the mtime of the folder relative_dirpath in remote to another second than before
+  def touch_dir(self, relative_dirpath):
+    path = os.path.join(self.remote, relative_dirpath)
+    mtime = os.stat(path).st_mtime + 10
+    os.utime(path, (mtime, mtime))
+
+  # a folder is listed again only if its mtime changed since it was seen with the same mtime in two walks
+  def test_incremental_walker(self):
+    walker = lazysync.incremental_walker(self.remote)
+    all_dirs = set(['.', 'a', 'a/b', 'c'])
+    folders, files, listed_dirs = walker.walk()
+    self.assertEqual(folders, set(['a', 'a/b', 'c']))
+    self.assertEqual(files, set(['a/file1', 'a/b/file2', 'c/file3', 'file4']))
+    self.assertEqual(listed_dirs, all_dirs)
+    self.assertEqual(walker.walk()[2], all_dirs) # the mtimes are not stable yet
+    self.assertEqual(walker.walk(), (folders, files, set()))
+    self.write(os.path.join(self.remote, 'a', 'file5'))
+    self.touch_dir('a')
+    folders, files, listed_dirs = walker.walk()
+    self.assertEqual(listed_dirs, set(['a']))
+    self.assertIn('a/file5', files)
+    self.assertEqual(walker.walk(full = True)[2], all_dirs)
+
+  # relative_scan() returns the lstat of each path (without the atime, which changes when a folder is listed), and does 
+  # not list ignored folders
+  def test_relative_scan(self):
+    os.symlink('file4', os.path.join(self.remote, 'link'))
+    backend = lazysync.posix_backend()
+    listed = []
+    list_dir = backend.list_dir
+    def list_dir_logged(path, with_stat = True, skip = None):
+      listed.append(os.path.relpath(path, self.remote))
+      return list_dir(path, with_stat, skip)
+    backend.list_dir = list_dir_logged
+    folders, files = lazysync.relative_scan(self.remote, ignore = lazysync.ignore_matcher(['/a/b/']), backend = backend)
+    self.assertEqual(set(folders), set(['a', 'c']))
+    self.assertEqual(set(files), set(['a/file1', 'c/file3', 'file4', 'link']))
+    for relative_path, data in list(folders.items()) + list(files.items()):
+      values = lazysync.syncfiledata(os.path.join(self.remote, relative_path)).values()
+      self.assertEqual(data.values()[:3] + data.values()[4:], values[:3] + values[4:])
+    self.assertEqual(files['link'].link_target, 'file4')
+    self.assertEqual(sorted(listed), ['.', 'a', 'c'])
+
+  # a walk with several workers finds the same paths as one with a single worker
+  def test_workers(self):
+    for i in range(20):
+      self.write(os.path.join(self.remote, 'd%d' % (i % 4), 'e%d' % (i % 3), 'file%d' % i))
+    scans = [lazysync.relative_scan(self.remote, workers = workers) for workers in [1, 4]]
+    self.assertEqual(set(scans[0][0]), set(scans[1][0]))
+    self.assertEqual(set(scans[0][1]), set(scans[1][1]))
+    self.assertEqual(len(scans[1][1]), 24)
+    walks = [lazysync.incremental_walker(self.remote).walk(workers = workers) for workers in [1, 4]]
+    self.assertEqual(walks[0], walks[1])
+
+# main
+if __name__ == "__main__":
+  unittest.main()